@@ -0,0 +1,76 @@
+"""
+Benchmark the incremental quarter-to-quarter co-holding network against rebuilding it.
+
+Run from the repository root on a holdings file with several report quarters (or a
+parquet dataset folder):
+python benchmarks/bench_coholding.py dash_app/data/filingsEnd2019.csv
+
+For every quarter the rebuild computes coholding_edges from that quarter's rows,
+the incremental path applies the changed positions to the previous quarter's
+network (coholding.incremental_coholding). Both get the same positions from a
+timeseries.quarter_store, the edges are checked to be the same, then the time of
+each path per quarter is printed.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dash_app'))
+from timeseries import load_quarters
+from coholding import coholding_edges, incremental_coholding
+
+
+def quarter_frame(store, i):
+    """ Positions of one quarter as a DataFrame coholding_edges can read """
+    node, security, value = store.positions_of(i)
+    return pd.DataFrame({store.node: store.nodes[node], store.on: store.securities[security], 'value': value})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help="holdings csv file or parquet dataset folder")
+    parser.add_argument('--node', default='owner', help="investor column")
+    parser.add_argument('--on', default='cusip', help="security column")
+    parser.add_argument('--values', action='store_true', help="weight edges by the product of the values")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    store = load_quarters(args.path, args.node, args.on)
+    print(f"{len(store.value)} positions of {store.shape[0]} investors in {len(store.quarters)} quarters, "
+          f"loaded in {time.perf_counter() - start:.2f}s")
+
+    engine = incremental_coholding(store, values=args.values)
+    print(f"{'quarter':8} {'changed':>8} {'edges':>9} {'rebuild':>9} {'incremental':>12}")
+    rebuild_total = incremental_total = 0
+    for i, quarter in enumerate(store.quarters):
+        start = time.perf_counter()
+        expected = coholding_edges(quarter_frame(store, i), on=args.on, node=args.node,
+                                   values='value' if args.values else None)
+        rebuild = time.perf_counter() - start
+
+        start = time.perf_counter()
+        engine.advance(i)
+        incremental = time.perf_counter() - start
+
+        edges = engine.edges()
+        if len(edges) != len(expected) or not np.allclose(edges['weight'], expected['weight']):
+            sys.exit(f"The edges of {quarter} differ")
+        changed = 0 if i == 0 else len(store.changes(i - 1, i))
+        print(f"{str(quarter):8} {changed:8} {len(edges):9} {rebuild:8.2f}s {incremental:11.2f}s")
+        if i:
+            # the first quarter is a full build in both paths
+            rebuild_total += rebuild
+            incremental_total += incremental
+
+    if len(store.quarters) > 1:
+        print(f"after the first quarter: rebuild {rebuild_total:.2f}s, incremental {incremental_total:.2f}s "
+              f"({rebuild_total / incremental_total:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
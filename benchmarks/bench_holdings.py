@@ -0,0 +1,107 @@
+"""
+Benchmark the compact holdings loader against the object-column path it replaces.
+
+Run from the repository root on a full-year file (or a parquet dataset folder):
+python benchmarks/bench_holdings.py dash_app/data/filingsEnd2019.csv
+
+Both paths load the analysis columns and build the normalized (cik, issuer)
+positions and the issuer labels (the first filed name, or the security master
+saved next to the holdings for the compact path), each in a fresh process so its
+peak resident memory can be measured (pyarrow-backed strings are not seen by
+tracemalloc). The normalized values are checked to be the same and every issuer
+to have a label, then the time and peak memory of each path are printed.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dash_app'))
+from holdings import read_holdings, normalize_positions
+from security_master import load_security_master
+from instrument import peak_rss
+
+COLUMNS = ['filed name', 'issuer', 'value', 'owner', 'cik']
+
+
+def legacy(path):
+    """ Object columns, per-row issuer labels and a merge to normalize, as clmap/netmap used to do """
+    data = read_holdings(path, COLUMNS)
+    totalValue = data.groupby('owner')['value'].sum()
+    data = data.merge(totalValue, how='left', left_on='owner', right_index=True)
+    data['norm_value'] = data['value_x'] / data['value_y']
+    data = data.loc[~(data['value_x'] == 0)]
+    issuers = data.drop_duplicates(subset='issuer')
+    issuers['label'] = issuers['filed name'].apply(lambda x: ' '.join(x[:].split(' ')[:3]))
+    positions = data.groupby(['cik', 'issuer']).agg({'norm_value': 'sum'}).reset_index()
+    return data, positions, issuers[['label', 'issuer']]
+
+
+def compact(path):
+    """ Categorical columns, groupby-transform normalization and labels from the security master """
+    data = read_holdings(path, COLUMNS, compact=True)
+    positions = normalize_positions(data)
+    labels = load_security_master(path).labels(positions['issuer'].unique().astype(str))
+    return data, positions, pd.DataFrame({'label': list(labels.values()), 'issuer': list(labels)})
+
+
+def run(name, path, output):
+    """ Child process: run one path, store its result in output and print its measurements """
+    before = peak_rss()
+    start = time.perf_counter()
+    data, positions, labels = {'legacy': legacy, 'compact': compact}[name](path)
+    elapsed = time.perf_counter() - start
+    peak = peak_rss() - before
+
+    key = positions['cik'].astype(str) + '\t' + positions['issuer'].astype(str)
+    labels = pd.Series(labels['label'].to_numpy(), index=labels['issuer'].astype(str).to_numpy())
+    pd.to_pickle((positions.set_index(key)['norm_value'].sort_index(), labels.sort_index()), output)
+    print(json.dumps({'time': elapsed, 'peak': peak, 'table': int(data.memory_usage(deep=True).sum()),
+                      'rows': len(data), 'positions': len(positions)}))
+
+
+def measure(name, path, folder):
+    """ Run one path in a fresh process, returns (measurements, positions, labels) """
+    output = os.path.join(folder, name + '.pkl')
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), path, '--run', name, '--output', output],
+                            check=True, capture_output=True, text=True)
+    return (json.loads(result.stdout.splitlines()[-1]),) + pd.read_pickle(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help="holdings csv file or parquet dataset folder")
+    parser.add_argument('--run', choices=['legacy', 'compact'], help=argparse.SUPPRESS)
+    parser.add_argument('--output', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        return run(args.run, args.path, args.output)
+
+    with tempfile.TemporaryDirectory() as folder:
+        old, expected, expected_labels = measure('legacy', args.path, folder)
+        new, result, labels = measure('compact', args.path, folder)
+
+    if not expected.index.equals(result.index) or not np.allclose(expected.to_numpy(), result.to_numpy()):
+        sys.exit("The normalized positions differ")
+    if not expected_labels.index.equals(labels.index):
+        sys.exit("The labelled issuers differ")
+
+    mb = 1 / 2 ** 20
+    print(f"{new['rows']} holdings, {new['positions']} positions")
+    print(f"{'':8} {'time':>8} {'peak':>10} {'table':>10}")
+    for name, m in (('legacy', old), ('compact', new)):
+        print(f"{name:8} {m['time']:7.2f}s {m['peak'] * mb:7.1f} MB {m['table'] * mb:7.1f} MB")
+    if new['peak'] > 0:
+        print(f"peak memory {old['peak'] / new['peak']:.1f}x lower")
+
+
+if __name__ == "__main__":
+    main()
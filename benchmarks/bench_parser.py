@@ -0,0 +1,71 @@
+"""
+Benchmark the Filing13F parser engines against each other.
+
+Run from the repository root, pointing at a folder of downloaded filings:
+python benchmarks/bench_parser.py test/sec-edgar-filings --num 50
+
+Every filing is parsed with both engines, the resulting DataFrames are checked
+to be identical and the total parse time per engine is printed.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'notebooks'))
+from helpers import Filing13F
+
+
+def find_filings(path, num):
+    """ Collect up to num full-submission.txt files below path """
+    filings = []
+    for pathnames, dirnames, filenames in os.walk(path):
+        for file in sorted(filenames):
+            if file == 'full-submission.txt':
+                filings.append(os.path.join(pathnames, file))
+                if len(filings) == num:
+                    return filings
+    return filings
+
+
+def time_engine(filings, engine):
+    """ Parse all filings with one engine, returns (seconds, list of DataFrames) """
+    dfs = []
+    start = time.perf_counter()
+    for filepath in filings:
+        filing = Filing13F()
+        filing.parse_file(filepath, engine=engine)
+        dfs.append(filing.data)
+    return time.perf_counter() - start, dfs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help="folder containing full-submission.txt files, e.g. 'sec-edgar-filings'")
+    parser.add_argument('--num', type=int, default=100, help="maximum number of filings to parse")
+    args = parser.parse_args()
+
+    filings = find_filings(args.path, args.num)
+    if not filings:
+        sys.exit(f"No full-submission.txt files found in {args.path}")
+
+    bs4_time, bs4_dfs = time_engine(filings, 'bs4')
+    lxml_time, lxml_dfs = time_engine(filings, 'lxml')
+
+    for filepath, expected, result in zip(filings, bs4_dfs, lxml_dfs):
+        try:
+            pd.testing.assert_frame_equal(expected, result)
+        except AssertionError as e:
+            sys.exit(f"Engines disagree on {filepath}:\n{e}")
+
+    rows = sum(len(df) for df in bs4_dfs)
+    print(f"Parsed {len(filings)} filings, {rows} holdings")
+    print(f"bs4:  {bs4_time:8.3f} s")
+    print(f"lxml: {lxml_time:8.3f} s  ({bs4_time / lxml_time:.1f}x faster)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Benchmark the approximate top-k similar investors against the exact correlation.
+
+Run from the repository root on a full-year file (or a parquet dataset folder):
+python benchmarks/bench_similarity.py dash_app/data/filingsEnd2019.csv --k 10
+
+All holdings are used (no sampling). The exact top-k comes from
+feature_map.top_correlations, the approximate one from similarity.lsh_index with
+the given number of bands and hashes per band. Prints the time of both and the
+recall of the approximate answer, overall and for strongly correlated pairs.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dash_app'))
+from holdings import read_holdings, normalize_positions
+from feature_map import top_correlations
+from similarity import approximate_top_correlations, recall
+
+COLUMNS = ['issuer', 'value', 'owner', 'cik']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help="holdings csv file or parquet dataset folder")
+    parser.add_argument('--year', type=int, help="report year to use from a dataset")
+    parser.add_argument('--k', type=int, default=10, help="similar investors per investor")
+    parser.add_argument('--bands', type=int, nargs='+', default=[32, 64])
+    parser.add_argument('--rows', type=int, default=2, help="hashes per band")
+    parser.add_argument('--strong', type=float, default=0.5, help="correlation of a strongly correlated pair")
+    args = parser.parse_args()
+
+    positions = normalize_positions(read_holdings(args.path, COLUMNS, year=args.year, compact=True))
+    print(f"{positions['cik'].nunique()} investors, {positions['issuer'].nunique()} issuers, {len(positions)} positions")
+
+    start = time.perf_counter()
+    exact = top_correlations(positions, args.k)
+    exact_time = time.perf_counter() - start
+    strong = exact[exact['correlation'] >= args.strong]
+    print(f"{'exact':12} {exact_time:8.2f} s")
+
+    for bands in args.bands:
+        start = time.perf_counter()
+        approximate = approximate_top_correlations(positions, args.k, bands=bands, rows=args.rows)
+        elapsed = time.perf_counter() - start
+        print(f"{f'lsh {bands}x{args.rows}':12} {elapsed:8.2f} s  recall@{args.k} {recall(exact, approximate):.3f}"
+              f"  (>= {args.strong}: {recall(strong, approximate):.3f})  {exact_time / elapsed:.1f}x faster")
+
+
+if __name__ == "__main__":
+    main()
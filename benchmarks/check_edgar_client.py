@@ -0,0 +1,182 @@
+"""
+Check the concurrent EDGAR downloader against a local stub server.
+
+Run from the repository root:
+python benchmarks/check_edgar_client.py --workers 8
+
+A threaded http server on localhost stands in for data.sec.gov and the EDGAR
+archives, and edgar_client is pointed at it. The server answers like the SEC:
+
+- CIK's with a few 13F-HR filings, one with its older filings on an extra page
+- a CIK the server doesn't know (404, a permanent failure)
+- a CIK whose requests fail with 503 a few times before they succeed (retried)
+
+Checked are the downloaded files, the succeeded and failed CIK's, the retries,
+that no second of requests goes over the rate limit, and that a second fetch
+with the same record file only asks for the CIK's that failed. The script exits
+with an error on the first check that fails.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'notebooks'))
+from edgar_client import edgar_client, rate_limiter, SEC_RATE
+
+FORM = '13F-HR'
+AFTER, BEFORE = '2019-01-01', '2019-12-31'
+# CIK -> filings (accession number, form, filing date), the first list is 'recent'
+FILINGS = {
+    '1000001': [[('0001000001-19-000001', FORM, '2019-02-14'), ('0001000001-19-000002', '10-K', '2019-03-01'),
+                 ('0001000001-19-000003', FORM, '2019-05-15')]],
+    '1000002': [[('0001000002-19-000001', FORM, '2019-11-14')],
+                # older page, overlaps the dates
+                [('0001000002-19-000000', FORM, '2019-02-13'), ('0001000002-18-000000', FORM, '2018-11-14')]],
+    '1000003': [[('0001000003-20-000001', FORM, '2020-02-14')]],
+    '1000004': [[('0001000004-19-000001', FORM, '2019-08-14')]],
+}
+UNKNOWN = '1000009'
+FLAKY = '1000004'
+# requests of the flaky CIK answered with 503 before it works
+FLAKY_FAILURES = 2
+
+
+def page(filings):
+    return {'accessionNumber': [f[0] for f in filings], 'form': [f[1] for f in filings],
+            'filingDate': [f[2] for f in filings]}
+
+
+def submission(accession):
+    return f"<SEC-DOCUMENT>{accession}.txt\n<TYPE>{FORM}\n</SEC-DOCUMENT>\n".encode()
+
+
+class stub_sec:
+    """ Stub server with the requests it received: (time, path, status) """
+    def __init__(self):
+        self.requests = []
+        self.lock = threading.Lock()
+        self.failures = {}
+        stub = self
+
+        class handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                status, body = stub.answer(self.path)
+                with stub.lock:
+                    stub.requests.append((time.monotonic(), self.path, status))
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def answer(self, path):
+        """ Status and body of a GET of path """
+        parts = path.strip('/').split('/')
+        cik = None
+        if parts[0] == 'submissions':
+            name = parts[1]
+            cik = name[3:13].lstrip('0') if name.startswith('CIK') else name.split('-')[0]
+        elif parts[0] == 'archives' and len(parts) == 4:
+            cik = parts[1]
+        if cik not in FILINGS:
+            return 404, b'Not Found'
+
+        if cik == FLAKY:
+            with self.lock:
+                self.failures[path] = self.failures.get(path, 0) + 1
+                if self.failures[path] <= FLAKY_FAILURES:
+                    return 503, b'Service Unavailable'
+
+        pages = FILINGS[cik]
+        if parts[0] == 'submissions' and name.startswith('CIK'):
+            files = [{'name': f'{cik}-page{i}.json', 'filingFrom': min(f[2] for f in p),
+                      'filingTo': max(f[2] for f in p)} for i, p in enumerate(pages[1:], 1)]
+            return 200, json.dumps({'filings': {'recent': page(pages[0]), 'files': files}}).encode()
+        if parts[0] == 'submissions':
+            return 200, json.dumps(page(pages[int(name.split('page')[1].split('.')[0])])).encode()
+        return 200, submission(parts[3][:-len('.txt')])
+
+    def paths(self, since=0):
+        with self.lock:
+            return [path for _, path, _ in self.requests[since:]]
+
+
+def check(condition, message):
+    if not condition:
+        sys.exit(f"FAILED: {message}")
+    print(f"ok      {message}")
+
+
+def expected_files(folder):
+    """ Paths and contents of the filings that fetch should have saved """
+    files = {}
+    for cik, pages in FILINGS.items():
+        for filings in pages:
+            for accession, form, date in filings:
+                if form == FORM and AFTER <= date <= BEFORE:
+                    files[os.path.join(folder, 'sec-edgar-filings', cik, FORM, accession, 'full-submission.txt')] = \
+                        submission(accession)
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rate', type=float, default=SEC_RATE, help="requests per second of the client")
+    parser.add_argument('--workers', type=int, default=8, help="download threads")
+    args = parser.parse_args()
+
+    stub = stub_sec()
+    codes = sorted(FILINGS) + [UNKNOWN]
+    with tempfile.TemporaryDirectory() as folder:
+        record = os.path.join(folder, 'fetch_record.jsonl')
+        client = edgar_client(folder, 'check admin@example.com', workers=args.workers,
+                              limiter=rate_limiter(args.rate), backoff=0.01,
+                              submissions_url=stub.url + '/submissions/', archives_url=stub.url + '/archives/')
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            success, fail = client.fetch(codes, FORM, AFTER, BEFORE, record=record)
+        check(sorted(success) == sorted(FILINGS) and fail == [UNKNOWN],
+              f"{len(success)} CIK's downloaded, the unknown one failed")
+
+        expected = expected_files(folder)
+        saved = {}
+        for root, _, names in os.walk(os.path.join(folder, 'sec-edgar-filings')):
+            for name in names:
+                with open(os.path.join(root, name), 'rb') as f:
+                    saved[os.path.join(root, name)] = f.read()
+        check(saved == expected, f"{len(expected)} filings saved, none outside the dates or forms")
+        check(all(count == FLAKY_FAILURES + 1 for count in stub.failures.values()),
+              f"503 answers retried until they succeed ({len(stub.failures)} urls)")
+        check(sum(path.endswith(f'CIK{UNKNOWN.zfill(10)}.json') for path in stub.paths()) == 1,
+              "a 404 is not retried")
+
+        # most requests in any window of one second, the bucket allows one more at its start
+        times = [stamp for stamp, _, _ in stub.requests]
+        busiest = max(sum(1 for t in times if start <= t < start + 1) for start in times)
+        check(busiest <= args.rate + 1, f"at most {busiest} requests in a second at a rate of {args.rate:g}")
+
+        seen = len(stub.requests)
+        with contextlib.redirect_stdout(io.StringIO()):
+            success, fail = client.fetch(codes, FORM, AFTER, BEFORE, record=record)
+        again = stub.paths(seen)
+        check(success == [] and fail == [UNKNOWN] and again == [f'/submissions/CIK{UNKNOWN.zfill(10)}.json'],
+              "a second fetch with the record only asks for the CIK that failed")
+    stub.server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
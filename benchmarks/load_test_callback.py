@@ -0,0 +1,69 @@
+"""
+Load test of the Dash correlation callback from a thread pool.
+
+Run from the repository root:
+python benchmarks/load_test_callback.py --years 2017 2018 --workers 8
+
+The figure caches are bypassed so every request renders. The script checks that
+parallel requests return the same correlation matrix as a serial run, that every
+answer is a png, and that no pyplot figures are left open afterwards.
+"""
+
+import argparse
+import base64
+import itertools
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DASH_APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dash_app')
+sys.path.insert(0, DASH_APP)
+# the app reads its data relative to the dash_app folder
+os.chdir(DASH_APP)
+
+import matplotlib.pyplot as plt
+import investor_correlation as ic
+
+PNG = b'\x89PNG'
+
+
+def render(args):
+    year, threshold, linkage = args
+    # skip the figure caches, the per-year preparation stays cached
+    network = ic.network_figure.__wrapped__(year, threshold)
+    matrix = ic.correlation_matrix_figure.__wrapped__(year, linkage)
+    return network, matrix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--years', type=int, nargs='+', default=[2017])
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[0.05, 0.1])
+    parser.add_argument('--linkages', nargs='+', default=['ward', 'single'])
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=2, help="times every request is sent")
+    args = parser.parse_args()
+
+    requests = list(itertools.product(args.years, args.thresholds, args.linkages)) * args.repeat
+
+    # warm the per-year cache and get reference matrices
+    expected = {(year, linkage): ic.correlation_matrix_figure.__wrapped__(year, linkage)
+                for year in args.years for linkage in args.linkages}
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.workers) as pool:
+        results = list(pool.map(render, requests))
+    elapsed = time.perf_counter() - start
+
+    for (year, threshold, linkage), (network, matrix) in zip(requests, results):
+        assert base64.b64decode(network).startswith(PNG), "network is not a png"
+        assert matrix == expected[(year, linkage)], f"matrix of {year} {linkage} differs from the serial render"
+    assert not plt.get_fignums(), f"{len(plt.get_fignums())} pyplot figures left open"
+
+    print(f"{len(requests)} requests on {args.workers} threads in {elapsed:.2f} s "
+          f"({len(requests) / elapsed:.2f} requests/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+Benchmark suite: time and peak memory of every pipeline stage on synthetic data of growing size.
+
+Run from the repository root:
+python benchmarks/run_benchmarks.py --sizes 50 200 800 --output benchmarks/results.jsonl
+
+For every size (number of filers) synthetic_13f writes four quarters of 13F-HR
+filings, the holdings table xml_parser makes of them, and the co-holding edges
+of four years. Every stage then runs in a fresh process, so its peak resident
+memory can be measured and no cache is warm:
+
+- parse_file   Filing13F.parse_file over all the filings
+- xml_parser   xml_parser.parse of the filings folder to csv (checked against the generated table)
+- clmap        clmap.calculate('ward') on the holdings table
+- netmap       netmap.calculate on the holdings table
+- temporal     make_temporal_plot from the edges (layout of every year included, needs
+               more filers than plotly_network_temporal.MIN_DEGREE)
+- callback     the Dash correlation callback (create_correlation_network) on a cold app
+
+Every measurement is appended to the output file as one JSON line (stage, filers,
+rows the stage went through, seconds, peak memory in bytes above the imports and
+of the whole process, commit, time), so runs of different commits
+can be compared; --baseline prints the ratio to the last matching result of an
+earlier output file.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, os.path.join(ROOT, 'notebooks'))
+sys.path.insert(0, os.path.join(ROOT, 'dash_app'))
+sys.path.insert(0, HERE)
+from instrument import peak_rss
+
+STAGES = ['parse_file', 'xml_parser', 'clmap', 'netmap', 'temporal', 'callback']
+YEAR = 2019
+QUARTERS = ['2019Q1', '2019Q2', '2019Q3', '2019Q4']
+TEMPORAL_QUARTERS = ['2016Q4', '2017Q4', '2018Q4', '2019Q4']
+# more filings than any run writes, xml_parser stops after num filings
+ALL = 10 ** 9
+
+
+def generate(folder, filers, securities, seed):
+    """ Filings, holdings table and temporal edges of one size in folder """
+    import pandas as pd
+    import synthetic_13f
+    from coholding import temporal_coholding_edges
+
+    rows = synthetic_13f.holdings(filers, securities, QUARTERS, seed=seed)
+    synthetic_13f.write_filings(rows, folder, seed=seed)
+    os.makedirs(os.path.join(folder, 'data'), exist_ok=True)
+    synthetic_13f.write_tables(rows, os.path.join(folder, 'data'))
+
+    years = synthetic_13f.holdings_table(synthetic_13f.holdings(filers, securities, TEMPORAL_QUARTERS, seed=seed))
+    edges = temporal_coholding_edges(years, on='cusip', node='owner', top_k=10)
+    edges.to_csv(os.path.join(folder, 'temporal_edges.csv'), index=False)
+    return len(pd.read_csv(os.path.join(folder, 'data', f'filingsEnd{YEAR}.csv'), usecols=['cusip']))
+
+
+def _filings(folder):
+    from helpers import xml_parser
+    return xml_parser(os.path.join(folder, 'sec-edgar-filings')).find_filings(ALL)
+
+
+def stage_parse_file(folder):
+    from helpers import Filing13F
+    rows = 0
+    for path in _filings(folder):
+        filing = Filing13F()
+        filing.parse_file(path)
+        rows += len(filing.data)
+    return rows
+
+
+def stage_xml_parser(folder):
+    import contextlib
+    import io
+    import pandas as pd
+    from helpers import xml_parser
+    output = os.path.join(folder, 'parsed.csv')
+    if os.path.exists(output):
+        os.remove(output)
+    with contextlib.redirect_stdout(io.StringIO()):
+        xml_parser(os.path.join(folder, 'sec-edgar-filings')).parse(ALL, output)
+    parsed = pd.read_csv(output, index_col=0, dtype={'cusip': str})
+    expected = pd.read_csv(os.path.join(folder, 'data', f'filingsEnd{YEAR}.csv'), index_col=0, dtype={'cusip': str})
+    pd.testing.assert_frame_equal(parsed, expected)
+    return len(parsed)
+
+
+def stage_clmap(folder):
+    import matplotlib.pyplot as plt
+    from helpers import clmap
+    cl = clmap(os.path.join(folder, 'data', f'filingsEnd{YEAR}.csv'))
+    cl.calculate('ward', (10, 10))
+    plt.close('all')
+    return len(cl.correlation)
+
+
+def stage_netmap(folder):
+    import contextlib
+    import io
+    import matplotlib.pyplot as plt
+    from helpers import netmap
+    nm = netmap(os.path.join(folder, 'data', f'filingsEnd{YEAR}.csv'))
+    with contextlib.redirect_stdout(io.StringIO()):
+        nm.calculate(0.05, 0.4, 20, (10, 10))
+    plt.close('all')
+    return len(nm.data)
+
+
+def stage_temporal(folder):
+    import plotly_network_temporal as temporal
+    # no payload folder and an empty layout cache, so the graphs and layouts are computed from the edges
+    path = os.path.join(folder, 'temporal_edges.csv')
+    with tempfile.TemporaryDirectory() as temporal.LAYOUT_DIR:
+        temporal.make_temporal_plot(path, payload_dir=os.path.join(folder, 'no-payload'))
+    with open(path) as f:
+        return sum(1 for _ in f) - 1
+
+
+def stage_callback(folder):
+    # the app reads data/ relative to its working directory
+    os.chdir(folder)
+    import investor_correlation as ic
+    with tempfile.TemporaryDirectory() as ic.LAYOUT_DIR:
+        ic.create_correlation_network(YEAR, 0.05, 'ward')
+    df, securities, correlation = ic.prepare_year(YEAR)
+    return len(df)
+
+
+def run(stage, folder):
+    """ Child process: run one stage and print its measurements """
+    # imports are not part of the measurement
+    import helpers, investor_correlation, plotly_network_temporal  # noqa: F401
+    before = peak_rss()
+    start = time.perf_counter()
+    rows = globals()['stage_' + stage](folder)
+    elapsed = time.perf_counter() - start
+    # peak is the growth above the imported modules, rss the peak of the whole process
+    print(json.dumps({'seconds': elapsed, 'peak': peak_rss() - before, 'rss': peak_rss(), 'rows': rows}))
+
+
+def measure(stage, folder):
+    """ Run one stage in a fresh process, returns its measurements """
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), '--run', stage, '--data', folder],
+                            capture_output=True, text=True)
+    if result.returncode:
+        return {'error': result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'failed'}
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def commit():
+    """ Current git commit of the repository, None outside a checkout """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_baseline(path):
+    """ Last result of every (stage, filers) of an earlier output file """
+    baseline = {}
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if 'seconds' in record:
+                baseline[record['stage'], record['filers']] = record
+    return baseline
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 200], help="numbers of filers")
+    parser.add_argument('--securities', type=int, default=3000, help="number of securities")
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--seed', type=int, default=13)
+    parser.add_argument('--output', help="JSON lines file the results are appended to")
+    parser.add_argument('--baseline', help="earlier output file to compare with")
+    parser.add_argument('--keep', help="folder to keep the synthetic data in (a temporary folder otherwise)")
+    parser.add_argument('--run', choices=STAGES, help=argparse.SUPPRESS)
+    parser.add_argument('--data', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        return run(args.run, args.data)
+
+    baseline = load_baseline(args.baseline) if args.baseline else {}
+    revision = commit()
+    mb = 1 / 2 ** 20
+    print(f"{'stage':11} {'filers':>7} {'rows':>9} {'time':>9} {'peak':>10} {'vs base':>8}")
+    with tempfile.TemporaryDirectory() as scratch:
+        for filers in args.sizes:
+            folder = os.path.join(args.keep or scratch, f'filers{filers}')
+            holdings = generate(folder, filers, args.securities, args.seed)
+            for stage in args.stages:
+                record = {'stage': stage, 'filers': filers, 'securities': args.securities, 'holdings': holdings,
+                          **measure(stage, folder), 'commit': revision,
+                          'time': datetime.datetime.now().isoformat(timespec='seconds')}
+                if args.output:
+                    with open(args.output, 'a') as f:
+                        f.write(json.dumps(record) + '\n')
+                if 'error' in record:
+                    print(f"{stage:11} {filers:7} failed: {record['error']}")
+                    continue
+                base = baseline.get((stage, filers))
+                ratio = f"{record['seconds'] / base['seconds']:7.2f}x" if base else ''
+                print(f"{stage:11} {filers:7} {record['rows']:9} {record['seconds']:8.2f}s "
+                      f"{record['peak'] * mb:7.1f} MB {ratio:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+"""
+Generate synthetic 13F-HR filings and holdings tables of any size.
+
+Run from the repository root:
+python benchmarks/synthetic_13f.py /tmp/synthetic --filers 200 --quarters 2019Q1 2019Q2 2019Q3 2019Q4
+
+writes sec-edgar-filings/<cik>/13F-HR/<accession>/full-submission.txt for every
+filer and quarter (the layout xml_parser reads) and filingsEnd<year>.csv with
+the holdings xml_parser would parse from them (with their security master).
+
+The data is made to look like the real filings where it matters for speed:
+security popularity and portfolio sizes are heavy tailed (a few securities are
+held by most filers, a few filers hold thousands of positions), portfolios are
+mostly kept from one quarter to the next, some issuers have several share
+classes, a few rows are put/call options, and about half of the information
+tables use the 'ns1:' namespace prefix.
+"""
+
+import argparse
+import os
+import string
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dash_app'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'notebooks'))
+from security_master import security_master, security_master_path
+from helpers import HOLDING_COLUMNS
+
+WORDS = ['ACME', 'APEX', 'ATLAS', 'BLUE', 'CEDAR', 'DELTA', 'EAGLE', 'FIRST', 'GLOBAL', 'GRANITE',
+         'HARBOR', 'IRON', 'LIBERTY', 'MERIDIAN', 'NORTH', 'OAK', 'PACIFIC', 'PINE', 'QUANTUM',
+         'RIVER', 'SUMMIT', 'TITAN', 'UNION', 'VALLEY', 'VERTEX', 'WEST', 'ZENITH']
+ISSUER_SUFFIXES = ['INC', 'CORP', 'CO', 'HLDGS INC', 'GROUP INC', 'LTD', 'PLC', 'N.V.', 'INC.', '& CO']
+FILER_SUFFIXES = ['CAPITAL MANAGEMENT LLC', 'ADVISORS LLC', 'ASSET MANAGEMENT', 'PARTNERS LP',
+                  'INVESTMENT CO', 'WEALTH MANAGEMENT', '& ASSOCIATES LLC', 'TRUST CO']
+CLASSES = ['CL A', 'CL B', 'CL C']
+
+PRIMARY_DOC = """<?xml version="1.0" encoding="UTF-8"?>
+<edgarSubmission xmlns="http://www.sec.gov/edgar/thirteenffiler" xmlns:com="http://www.sec.gov/edgar/common">
+  <headerData>
+    <submissionType>13F-HR</submissionType>
+    <filerInfo>
+      <liveTestFlag>LIVE</liveTestFlag>
+      <filer>
+        <credentials>
+          <cik>{cik}</cik>
+          <ccc>XXXXXXXX</ccc>
+        </credentials>
+      </filer>
+      <periodOfReport>{period}</periodOfReport>
+    </filerInfo>
+  </headerData>
+  <formData>
+    <coverPage>
+      <reportCalendarOrQuarter>{period}</reportCalendarOrQuarter>
+      <filingManager>
+        <name>{owner}</name>
+        <address><com:street1>1 Main St</com:street1></address>
+      </filingManager>
+      <reportType>13F HOLDINGS REPORT</reportType>
+      <form13FFileNumber>028-{file_number:05d}</form13FFileNumber>
+    </coverPage>
+    <signatureBlock>
+      <name>Jane Doe</name>
+      <signatureDate>{signed}</signatureDate>
+    </signatureBlock>
+  </formData>
+</edgarSubmission>
+"""
+
+INFO_TABLE = """  <{p}infoTable>
+    <{p}nameOfIssuer>{name}</{p}nameOfIssuer>
+    <{p}titleOfClass>{title}</{p}titleOfClass>
+    <{p}cusip>{cusip}</{p}cusip>
+    <{p}value>{value}</{p}value>
+    <{p}shrsOrPrnAmt><{p}sshPrnamt>{amount}</{p}sshPrnamt><{p}sshPrnamtType>SH</{p}sshPrnamtType></{p}shrsOrPrnAmt>
+{putcall}    <{p}investmentDiscretion>SOLE</{p}investmentDiscretion>
+    <{p}votingAuthority><{p}Sole>{amount}</{p}Sole><{p}Shared>0</{p}Shared><{p}None>0</{p}None></{p}votingAuthority>
+  </{p}infoTable>
+"""
+
+
+def cusip_check_digit(code):
+    """ Check digit of the first 8 characters of a CUSIP """
+    total = 0
+    for i, char in enumerate(code):
+        v = int(char) if char.isdigit() else ord(char) - 55
+        if i % 2:
+            v *= 2
+        total += v // 10 + v % 10
+    return str((10 - total % 10) % 10)
+
+
+def securities(n, seed=13):
+    """
+    Security master: issuer (6 characters), cusip, issuer name, class title and popularity
+
+    About 10% of the issuers have a second share class. Popularity follows a Zipf law.
+    """
+    rng = np.random.default_rng(seed)
+    alphabet = np.array(list(string.digits + string.ascii_uppercase))
+    rows = []
+    issuers = set()
+    while len(rows) < n:
+        issuer = ''.join(rng.choice(alphabet, 6))
+        if issuer in issuers:
+            continue
+        issuers.add(issuer)
+        name = ' '.join(rng.choice(WORDS, rng.integers(1, 3))) + ' ' + rng.choice(ISSUER_SUFFIXES)
+        titles = ['COM'] if rng.random() > 0.1 else list(rng.choice(CLASSES, 2, replace=False))
+        for issue, title in enumerate(titles):
+            code = issuer + f'{10 * (issue + 1):02d}'
+            rows.append((issuer, code + cusip_check_digit(code), name, title))
+    table = pd.DataFrame(rows[:n], columns=['issuer', 'cusip', 'name', 'title'])
+    popularity = 1 / np.arange(1, n + 1) ** 1.1
+    table['popularity'] = rng.permutation(popularity / popularity.sum())
+    return table
+
+
+def filers(n, seed=13):
+    """ Filers: 10 digit CIK, name and portfolio size (number of positions, heavy tailed) """
+    rng = np.random.default_rng(seed + 1)
+    cik = (1000000 + np.sort(rng.choice(8000000, n, replace=False))).astype(str)
+    names = [' '.join(rng.choice(WORDS, 2)) + ' ' + rng.choice(FILER_SUFFIXES) for _ in range(n)]
+    size = np.clip(rng.lognormal(np.log(80), 1.0, n), 5, 5000).astype(int)
+    return pd.DataFrame({'cik': np.char.zfill(cik, 10), 'owner': names, 'size': size})
+
+
+def holdings(n_filers, n_securities, quarters, turnover=0.15, option_share=0.02, seed=13):
+    """
+    Positions of every filer in every quarter, with the fields of the information table
+
+    Each quarter a filer sells about turnover of its positions and buys new ones, the
+    other positions are kept and their value drifts. option_share of the rows are put
+    or call options on a held security. Returns one row per position with cik, owner,
+    quarter, name, title, cusip, value, amount and putcall (None for shares).
+    """
+    rng = np.random.default_rng(seed + 2)
+    master = securities(n_securities, seed)
+    managers = filers(n_filers, seed)
+    quarters = [pd.Period(q, freq='Q') for q in quarters]
+    p = master['popularity'].to_numpy()
+
+    frames = []
+    for cik, owner, size in managers.itertuples(index=False):
+        size = min(size, n_securities)
+        held = rng.choice(n_securities, size, replace=False, p=p)
+        value = rng.lognormal(np.log(2000), 1.5, size)
+        for quarter in quarters:
+            sold = rng.random(size) < turnover
+            if sold.any():
+                candidates = np.setdiff1d(np.arange(n_securities), held[~sold])
+                weights = p[candidates] / p[candidates].sum()
+                held[sold] = rng.choice(candidates, sold.sum(), replace=False, p=weights)
+                value[sold] = rng.lognormal(np.log(2000), 1.5, sold.sum())
+            value *= rng.lognormal(0, 0.1, size)
+            frames.append(pd.DataFrame({'cik': cik, 'owner': owner, 'quarter': quarter,
+                                        'security': held.copy(), 'value': value.round().astype(np.int64)}))
+
+    rows = pd.concat(frames, ignore_index=True)
+    options = rows.sample(frac=option_share, random_state=seed)
+    options = options.assign(putcall=rng.choice(['Put', 'Call'], len(options)),
+                             value=(options['value'] // 20).astype(np.int64))
+    rows = pd.concat([rows.assign(putcall=None), options]).sort_index(kind='stable').reset_index(drop=True)
+
+    security = master.iloc[rows['security'].to_numpy()].reset_index(drop=True)
+    rows['name'] = security['name']
+    rows['title'] = np.where(rows['putcall'].isna(), security['title'], rows['putcall'].str.upper())
+    rows['cusip'] = security['cusip']
+    price = rng.lognormal(np.log(50), 1.0, len(rows))
+    rows['amount'] = np.maximum(1, (rows['value'] * 1000 / price).round()).astype(np.int64)
+    return rows.drop(columns='security')
+
+
+def _escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _submission(cik, owner, quarter, positions, prefix, file_number):
+    """ Text of one full-submission.txt """
+    period = quarter.end_time.strftime('%m-%d-%Y')
+    signed = (quarter.end_time + pd.Timedelta(days=40)).strftime('%m-%d-%Y')
+    primary = PRIMARY_DOC.format(cik=cik, period=period, owner=_escape(owner), file_number=file_number, signed=signed)
+
+    p = 'ns1:' if prefix else ''
+    namespace = 'xmlns:ns1' if prefix else 'xmlns'
+    tables = []
+    for name, title, cusip, value, amount, putcall in positions:
+        option = f"    <{p}putCall>{putcall}</{p}putCall>\n" if putcall else ''
+        tables.append(INFO_TABLE.format(p=p, name=_escape(name), title=title, cusip=cusip, value=value,
+                                        amount=amount, putcall=option))
+    information = (f'<?xml version="1.0" encoding="UTF-8"?>\n'
+                   f'<{p}informationTable {namespace}="http://www.sec.gov/edgar/document/thirteenf/informationtable">\n'
+                   + ''.join(tables) + f'</{p}informationTable>\n')
+
+    return (f"<SEC-DOCUMENT>\n<SEC-HEADER>\nCONFORMED SUBMISSION TYPE:\t13F-HR\n</SEC-HEADER>\n"
+            f"<DOCUMENT>\n<TYPE>13F-HR\n<SEQUENCE>1\n<FILENAME>primary_doc.xml\n<TEXT>\n<XML>\n{primary}</XML>\n</TEXT>\n</DOCUMENT>\n"
+            f"<DOCUMENT>\n<TYPE>INFORMATION TABLE\n<SEQUENCE>2\n<FILENAME>infotable.xml\n<TEXT>\n<XML>\n{information}</XML>\n</TEXT>\n</DOCUMENT>\n"
+            f"</SEC-DOCUMENT>\n")
+
+
+def write_filings(rows, folder, prefix_share=0.5, seed=13):
+    """
+    Write every (filer, quarter) of holdings() as sec-edgar-filings/<cik>/13F-HR/<accession>/full-submission.txt
+
+    Returns the paths of the written files, in the order xml_parser walks them.
+    """
+    rng = np.random.default_rng(seed + 3)
+    paths = []
+    quarters = sorted(rows['quarter'].unique())
+    for file_number, (cik, filings) in enumerate(rows.groupby('cik', sort=True)):
+        owner = filings['owner'].iloc[0]
+        prefix = rng.random() < prefix_share
+        for sequence, quarter in enumerate(quarters, start=1):
+            positions = filings[filings['quarter'] == quarter]
+            if positions.empty:
+                continue
+            filed = (quarter.end_time + pd.Timedelta(days=40)).year % 100
+            accession = f"{cik}-{filed:02d}-{sequence:06d}"
+            folder_path = os.path.join(folder, 'sec-edgar-filings', cik, '13F-HR', accession)
+            os.makedirs(folder_path, exist_ok=True)
+            path = os.path.join(folder_path, 'full-submission.txt')
+            fields = positions[['name', 'title', 'cusip', 'value', 'amount', 'putcall']].itertuples(index=False)
+            with open(path, 'w') as f:
+                f.write(_submission(cik, owner, quarter, fields, prefix, file_number))
+            paths.append(path)
+    return paths
+
+
+def holdings_table(rows):
+    """
+    The holdings xml_parser parses from the filings of rows (option rows are dropped like Filing13F does)
+    """
+    shares = rows[rows['putcall'].isna()]
+    name = shares['name'].str.replace('.', '', regex=False)
+    filed_name = np.where(shares['title'] == 'COM', name, name + ' (' + shares['title'] + ')')
+    return pd.DataFrame({'filed name': filed_name, 'cusip': shares['cusip'], 'value': shares['value'],
+                         'amount': shares['amount'], 'put_or_call': 'No', 'owner': shares['owner'],
+                         'cik': shares['cik'], 'report_date': shares['quarter'].map(lambda q: q.end_time.date())},
+                        columns=HOLDING_COLUMNS).reset_index(drop=True)
+
+
+def write_tables(rows, folder):
+    """
+    Write filingsEnd<year>.csv and its security master for every report year of rows, like
+    xml_parser.parse does. Returns the paths of the tables.
+    """
+    table = holdings_table(rows)
+    paths = []
+    years = pd.to_datetime(table['report_date']).dt.year
+    for year, part in table.groupby(years):
+        path = os.path.join(folder, f'filingsEnd{year}.csv')
+        part.reset_index(drop=True).to_csv(path)
+        security_master().update(part).save(security_master_path(path))
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('folder', help="output folder")
+    parser.add_argument('--filers', type=int, default=100, help="number of filers")
+    parser.add_argument('--securities', type=int, default=3000, help="number of securities")
+    parser.add_argument('--quarters', nargs='+', default=['2019Q1', '2019Q2', '2019Q3', '2019Q4'])
+    parser.add_argument('--seed', type=int, default=13)
+    parser.add_argument('--no-filings', action='store_true', help="only write the holdings tables")
+    args = parser.parse_args()
+
+    os.makedirs(args.folder, exist_ok=True)
+    rows = holdings(args.filers, args.securities, args.quarters, seed=args.seed)
+    if not args.no_filings:
+        paths = write_filings(rows, args.folder, seed=args.seed)
+        print(f"{len(paths)} filings written to {os.path.join(args.folder, 'sec-edgar-filings')}")
+    for path in write_tables(rows, args.folder):
+        print(f"{path} written")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,55 @@
+"""
+Module to build the investor-issuer (bipartite) graph
+
+Edges are selected with a boolean mask on the aggregated positions and added to
+the graph in one call, node lists and degree centrality are computed with pandas
+on the edge arrays instead of walking the DataFrame row by row.
+"""
+
+import numpy as np
+import pandas as pd
+import networkx as nx
+
+from instrument import traced
+
+
+def bipartite_edges(df, threshold, source='cik', target='issuer', weight='norm_value'):
+    """
+    Positions with weight above threshold, one row per (source, target) pair
+    """
+    mask = df[weight].to_numpy() > threshold
+    edges = df.loc[mask, [source, target, weight]]
+    # a repeated pair would only overwrite the same edge in the graph, keep the last like add_edge
+    return edges.drop_duplicates(subset=[source, target], keep='last')
+
+
+def degree_centrality(edges, source='cik', target='issuer'):
+    """
+    Degree centrality of every node of an edge list, same as nx.degree_centrality
+
+    The Series is indexed by node in the order the nodes enter the graph.
+    """
+    endpoints = np.column_stack([edges[source].to_numpy(dtype=object), edges[target].to_numpy(dtype=object)]).ravel()
+    nodes = pd.unique(endpoints)
+    degree = pd.Series(endpoints).value_counts().reindex(nodes)
+    if len(nodes) <= 1:
+        return pd.Series(1.0, index=nodes)
+    return degree / (len(nodes) - 1)
+
+
+@traced('graph', rows=lambda result: result[0].number_of_edges())
+def bipartite_graph(df, threshold, gravity, source='cik', target='issuer', weight='norm_value'):
+    """
+    Investor-issuer graph of all positions with weight above threshold
+
+    Edge weights are weight ** (1/gravity). Returns the graph, the investor and issuer
+    nodes (each once, in order of appearance) and the degree centrality of every node.
+    """
+    edges = bipartite_edges(df, threshold, source, target, weight)
+
+    G = nx.Graph()
+    G.add_weighted_edges_from(zip(edges[source], edges[target], edges[weight].to_numpy() ** (1 / gravity)))
+
+    investors = pd.unique(edges[source].to_numpy(dtype=object)).tolist()
+    companies = pd.unique(edges[target].to_numpy(dtype=object)).tolist()
+    return G, investors, companies, degree_centrality(edges, source, target)
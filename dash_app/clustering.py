@@ -0,0 +1,113 @@
+"""
+Module to cluster the investor correlation matrix and draw it
+
+sns.clustermap computes a linkage from scratch on every call (for the rows and
+again for the columns) and draws every cell of the n x n matrix. Here the
+condensed distance matrix is computed once, the linkage of each method is
+built from it (the matrix is symmetric, so rows and columns share one linkage),
+and the heatmap is drawn in cluster order, averaged down to a fixed number of
+cells.
+
+The distances are the euclidean distances between the rows of the correlation
+matrix, the same clustering sns.clustermap(correlation, method=...) does.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.cluster import hierarchy
+from scipy.spatial.distance import pdist
+from matplotlib.figure import Figure
+
+from instrument import traced
+
+# linkage methods offered in the app
+METHODS = ['single', 'complete', 'centroid', 'ward']
+# largest number of cells per side of a drawn heatmap
+HEATMAP_SIZE = 300
+
+
+@traced('distance', rows=len)
+def condensed_distance(correlation):
+    """
+    Condensed euclidean distances between the rows of a correlation matrix (array or DataFrame)
+
+    Undefined correlations (investors without variance) count as 0.
+    """
+    return pdist(np.nan_to_num(np.asarray(correlation, dtype=float)), 'euclidean')
+
+
+@traced('cluster', rows=lambda linkage: len(linkage) + 1)
+def linkage_matrix(distance, method):
+    """
+    Hierarchical clustering of a condensed euclidean distance matrix, fastcluster if installed
+    """
+    try:
+        import fastcluster
+        return fastcluster.linkage(distance, method=method)
+    except ImportError:
+        return hierarchy.linkage(distance, method=method)
+
+
+def cluster_order(linkage):
+    """ Positions of the rows in dendrogram (leaf) order """
+    return hierarchy.leaves_list(linkage)
+
+
+def flat_clusters(linkage, clusters, labels=None):
+    """
+    Cut the tree into at most clusters flat clusters
+
+    Returns a Series with the cluster number (from 1) of every row, indexed by labels.
+    """
+    return pd.Series(hierarchy.fcluster(linkage, clusters, criterion='maxclust'), index=labels, name='cluster')
+
+
+def downsample(matrix, size=HEATMAP_SIZE):
+    """
+    Average a square matrix over blocks so that it has at most size rows and columns
+
+    Returns the smaller matrix and the first row of every block.
+    """
+    matrix = np.nan_to_num(np.asarray(matrix, dtype=float))
+    n = len(matrix)
+    if n <= size:
+        return matrix, np.arange(n)
+    edges = np.linspace(0, n, size + 1).astype(int)
+    starts = edges[:-1]
+    counts = np.diff(edges)
+    blocks = np.add.reduceat(np.add.reduceat(matrix, starts, axis=0), starts, axis=1)
+    return blocks / np.outer(counts, counts), starts
+
+
+@traced('render heatmap')
+def heatmap_figure(correlation, linkage, clusters=None, size=HEATMAP_SIZE, figsize=(10, 10)):
+    """
+    Heatmap of the correlation matrix in cluster order, at most size x size cells
+
+    With clusters the borders of that many flat clusters are drawn. The figure is
+    not registered with pyplot, so it can be drawn from several threads.
+    """
+    # seaborn takes most of a second to import, only load it when drawing
+    from seaborn.cm import rocket
+
+    order = cluster_order(linkage)
+    values = np.asarray(correlation, dtype=float)[np.ix_(order, order)]
+    cells, starts = downsample(values, size)
+
+    fig = Figure(figsize=figsize)
+    ax = fig.add_subplot()
+    image = ax.imshow(cells, cmap=rocket, vmin=-1, vmax=1, interpolation='nearest')
+    fig.colorbar(image, ax=ax, shrink=0.8, label='correlation')
+
+    if clusters:
+        # clusters are contiguous in leaf order, draw a line where the next one starts
+        members = flat_clusters(linkage, clusters).to_numpy()[order]
+        borders = np.flatnonzero(members[1:] != members[:-1]) + 1
+        for border in np.searchsorted(starts, borders) - 0.5:
+            ax.axhline(border, color='w', linewidth=0.8)
+            ax.axvline(border, color='w', linewidth=0.8)
+
+    ax.set_xticks([])
+    ax.set_yticks([])
+    ax.set_xlabel(f'{len(order)} investors in cluster order')
+    return fig
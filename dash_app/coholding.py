@@ -0,0 +1,224 @@
+"""
+Module to build the investor-investor (co-holding) network
+
+Two investors are connected when they hold the same security in the same period.
+Instead of merging the holdings with themselves (which creates one row per pair
+of holders of every security), the weighted one-mode projection P = B @ B.T of
+the sparse investor x security matrix B is accumulated over chunks of
+securities, and only its upper triangle is kept.
+
+incremental_coholding keeps P for a sliding window of report quarters of a
+timeseries.quarter_store. Moving to the next quarter changes B by the sparse
+matrix D of new, exited and resized positions, and P by
+D @ B.T + B @ D.T + D @ D.T, which only involves the holders of the securities
+that changed (computed as Y + Y.T with Y = D @ (B + B').T / 2). Degrees and weighted degrees are updated for the investors whose
+edges changed, and eigenvector centrality restarts from the previous quarter's
+vector.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from metrics import eigenvector_centrality
+
+
+def coholding_edges(df, on='cusip', node='owner', values=None, chunk_size=2000,
+                    min_weight=None, top_k=None):
+    """
+    Co-holding edges of one period
+
+    Weight is the number of shared securities (`on`, the CUSIP or 'issuer' to count shared
+    companies), or with values the sum over shared securities of the product of both
+    investors' values. Every pair appears once with
+    source < target. Edges below min_weight are dropped; with top_k an edge is kept only
+    if it is among the top_k strongest edges of one of its two investors.
+    Returns a DataFrame with columns source, target and weight.
+    """
+    df = df.dropna(subset=[node, on])
+    rows, nodes = pd.factorize(df[node], sort=True)
+    cols, keys = pd.factorize(df[on])
+    data = np.ones(len(df)) if values is None else df[values].to_numpy(dtype=float)
+
+    B = sparse.csc_matrix((data, (rows, cols)), shape=(len(nodes), len(keys)))
+    B.sum_duplicates()
+    if values is None:
+        # holding a security in several rows still counts once
+        B.data[:] = 1
+
+    P = sparse.csr_matrix((len(nodes), len(nodes)))
+    for start in range(0, len(keys), chunk_size):
+        part = B[:, start:start + chunk_size]
+        P = P + sparse.triu(part @ part.T, k=1, format='csr')
+
+    P = P.tocoo()
+    edges = pd.DataFrame({'source': P.row, 'target': P.col, 'weight': P.data})
+    if min_weight is not None:
+        edges = edges[edges['weight'] >= min_weight]
+    if top_k is not None:
+        edges = _top_k(edges, top_k)
+
+    edges = edges.sort_values(['source', 'target'], ignore_index=True)
+    edges['source'] = nodes[edges['source'].to_numpy()]
+    edges['target'] = nodes[edges['target'].to_numpy()]
+    return edges
+
+
+def _top_k(edges, k):
+    """ Edges that are among the k heaviest of their source or of their target """
+    source_rank = edges.groupby('source')['weight'].rank(method='first', ascending=False)
+    target_rank = edges.groupby('target')['weight'].rank(method='first', ascending=False)
+    return edges[(source_rank <= k) | (target_rank <= k)]
+
+
+def temporal_coholding_edges(df, period='year', **kwargs):
+    """
+    Co-holding edges of every period of a holdings table
+
+    Period is a column of df, or 'year' which is taken from report_date. The other keyword
+    arguments go to coholding_edges. Returns source, target, weight and the period column,
+    which can be read by make_temporal_plot.
+    """
+    if period == 'year' and 'year' not in df:
+        df = df.assign(year=df['report_date'].astype(str).str[:4].astype(int))
+
+    frames = []
+    for value, group in df.groupby(period, sort=True):
+        edges = coholding_edges(group, **kwargs)
+        edges[period] = value
+        frames.append(edges)
+    if not frames:
+        return pd.DataFrame(columns=['source', 'target', 'weight', period])
+    return pd.concat(frames, ignore_index=True)
+
+
+class incremental_coholding:
+    """
+    Co-holding network of a quarter_store that moves from one quarter to the next
+
+    The weight of two investors is the number of securities both held in the last window
+    quarters, or with values the sum over shared securities of the product of their values
+    (summed over the window), like coholding_edges on the same positions.
+    """
+    def __init__(self, store, window=1, values=False):
+        self.store = store
+        self.window = window
+        self.values = values
+        n, m = store.shape
+        # sum over the window of the quarter matrices, and the resulting investor x security matrix
+        self.held = sparse.csr_matrix((n, m))
+        self.B = sparse.csr_matrix((n, m))
+        self.P = sparse.csr_matrix((n, n))
+        self.delta = sparse.csr_matrix((n, n))
+        self.degree = np.zeros(n, dtype=np.int64)
+        self.strength = np.zeros(n)
+        self.window_quarters = []
+        self._eigenvector = None
+
+    @property
+    def quarter(self):
+        """ Last quarter applied, None before the first advance """
+        return self.store.quarters[self.window_quarters[-1]] if self.window_quarters else None
+
+    def advance(self, quarter=None):
+        """
+        Apply the positions of a quarter (by default the one after the last applied quarter)
+
+        The quarter leaving the window is taken out in the same step. Returns self.
+        """
+        if quarter is None:
+            i = self.window_quarters[-1] + 1 if self.window_quarters else 0
+        else:
+            i = self.store._index(quarter)
+        change = self.store.matrix(i, self.values)
+        self.window_quarters.append(i)
+        if len(self.window_quarters) > self.window:
+            change = change - self.store.matrix(self.window_quarters.pop(0), self.values)
+
+        held = self.held + change
+        held.eliminate_zeros()
+        if self.values:
+            B = held
+        else:
+            # held in at least one quarter of the window
+            B = held.copy()
+            B.data = (B.data > 0).astype(float)
+        D = B - self.B
+        D.eliminate_zeros()
+
+        # P' - P = D B.T + B D.T + D D.T = Y + Y.T with Y = D (B + B').T / 2
+        Y = (D @ (self.B + B).T) * 0.5
+        delta = (Y + Y.T).tocsr()
+        # without the diagonal (an investor and itself)
+        rows = np.repeat(np.arange(delta.shape[0]), np.diff(delta.indptr))
+        delta.data[rows == delta.indices] = 0
+        delta.eliminate_zeros()
+
+        P = self.P + delta
+        if self.values:
+            # rounding leaves tiny weights where a pair stopped sharing a security
+            P.data[np.abs(P.data) <= 1e-9 * np.abs(P.data).max(initial=0)] = 0
+        P.eliminate_zeros()
+
+        rows = np.flatnonzero(np.diff(delta.indptr))
+        self.degree[rows] = np.diff(P.indptr)[rows]
+        self.strength += np.asarray(delta.sum(axis=1)).ravel()
+        self.held, self.B, self.P, self.delta = held, B, P, delta
+        return self
+
+    def walk(self):
+        """ Advance through all quarters of the store, yielding every quarter once it is applied """
+        for i in range(len(self.store.quarters)):
+            yield self.advance(i).quarter
+
+    def _frame(self, M, columns):
+        """ Upper triangle of a node x node matrix as source, target and the given columns """
+        M = sparse.triu(M, k=1, format='coo')
+        order = np.lexsort((M.col, M.row))
+        row, col = M.row[order], M.col[order]
+        frame = pd.DataFrame({'source': self.store.nodes[row], 'target': self.store.nodes[col]})
+        for name, matrix in columns.items():
+            frame[name] = np.asarray(matrix[row, col]).ravel() if len(row) else np.empty(0)
+        return frame
+
+    def edges(self, min_weight=None):
+        """
+        Edges of the current window as source, target and weight (source < target), like coholding_edges
+        """
+        edges = self._frame(self.P, {'weight': self.P})
+        if min_weight is not None:
+            edges = edges[edges['weight'] >= min_weight].reset_index(drop=True)
+        return edges
+
+    def changed_edges(self):
+        """
+        Edges whose weight changed in the last advance, with weight_before and weight_after
+
+        An edge that appeared has weight_before 0, one that disappeared weight_after 0.
+        """
+        P = self.P.tocsr()
+        return self._frame(self.delta, {'weight_before': P - self.delta, 'weight_after': P})
+
+    def degree_centrality(self):
+        """
+        Degree centrality of the investors with at least one edge, as a Series (like nx.degree_centrality)
+        """
+        connected = np.flatnonzero(self.degree)
+        scale = 1 / (len(connected) - 1) if len(connected) > 1 else 1
+        return pd.Series(self.degree[connected] * scale, index=self.store.nodes[connected], name='degree')
+
+    def eigenvector_centrality(self, tol=1e-6, max_iter=100, workers=1):
+        """
+        Weighted eigenvector centrality of the investors with at least one edge, as a Series
+
+        Power iteration (metrics.eigenvector_centrality) started from the previous result, so
+        after a quarter with few changes it converges in a few iterations. Returns the Series
+        and the convergence report.
+        """
+        connected = np.flatnonzero(self.degree)
+        start = None if self._eigenvector is None else self._eigenvector[connected]
+        P = self.P[connected][:, connected]
+        scores, report = eigenvector_centrality(P, self.store.nodes[connected], start, tol, max_iter, workers)
+        self._eigenvector = np.zeros(self.P.shape[0])
+        self._eigenvector[connected] = scores.to_numpy()
+        return scores, report
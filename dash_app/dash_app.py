@@ -22,67 +22,184 @@ heroku logs --tail
 for logs
 """
 
-import pandas as pd
 import numpy as np
-from pathlib import Path
-import operator
 import base64
+from functools import lru_cache
 
 import dash
+import flask
 import dash_core_components as dcc
 import dash_html_components as html
 from dash.dependencies import Input, Output
-import networkx as nx
+try:
+    from dash import Patch
+except ImportError:  # dash < 2.9, the whole figure is sent
+    Patch = None
 
-from plotly_network_temporal import make_temporal_plot
-from investor_correlation import create_correlation_network
+from plotly_network_temporal import make_year_plot, serve_year, temporal_years, year_title
+from instrument import span, summary
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
 server = app.server
 
+
+@server.route('/metrics')
+def metrics():
+    """
+    Totals of every instrumented stage since the worker started (see instrument.py, set INSTRUMENT to turn it on)
+    """
+    return flask.jsonify(summary())
+
 # Init figures
 corr_matrix = "data/corr_matrix.png"
-encoded_matrix = base64.b64encode(open(corr_matrix, 'rb').read())
 corr_net = "data/corr_network.png"
-encoded_net = base64.b64encode(open(corr_net, 'rb').read())
-
-fig_temporal = make_temporal_plot()
-
-app.layout = html.Div([
-    html.H1(children = 'Uncovering the Network', style={'text-align': 'center'}),
-    html.P(children = 'Investment firms with over 100M $ under management are required by law to file a 13F report on a quarterly basis, where they disclose their holdings to the Securities and Exchange Commission (SEC). Such a report includes information about the investment manager, the firm, and the positions the firm holds including the total value, the number of shares, the type of asset, etc. The goal of this project is to perform network analysis on the US financial market and examine the connectivity of the market and how it evolves over time, to the extent possible.', style={'text-align': 'center', 'margin-top': "15px"}),
-    html.P(children = 'In this figure the user can perform a basic exploratory analysis of the network connectivity for a limited set of investment managers for 2017-2020. While no conclusions can be drawn, it is intended to give a general idea of the connectivty between investment managers. In the slider below the figure, the year can be selected.', style={'text-align': 'center', 'margin-top': "15px"}),
-    dcc.Graph(figure=fig_temporal, style={'width': '50%'}),
-    html.P(children = "Hierarchical clustering is then applied to the correlation matrix of the US financial market investors. The correlation matrix is based on an investment feature map, calculated assuming each investor is an observation and each possible investment is a feature. For a given investor, the feature vector's values are the normalized investments, i.e. the value of the position divided by the total value of all positions of the investor.", style={'text-align': 'center', 'margin-top. For the interactive options below, it will take approxmately 20 seconds for the figures to update.': "15px"}),
-    html.H3(children = 'Select the year of reported 13F data you are interested in analyzing', style={'text-align': 'center', 'margin-top': "30"}),
-    dcc.Slider(
-        id='year-slider',
-        min=2017,
-        max=2020,
-        value=2017,
-        marks={year: year for year in ["2017", "2018", "2019", "2020"]},
-        step=None),
-    html.H2(children = 'Select the Agglomerative clustering linkage criterion', style={'text-align': 'center'}),
-    html.Div([
-        dcc.Dropdown(
-                id='cluster-dropdown',
-                options=[{'label': method, 'value': method} for method in ['single', 'complete', 'centroid', 'ward']],
-                value='ward')
+# rows of the holdings drill-down table
+DRILL_DOWN_ROWS = 15
+
+
+@lru_cache(maxsize=None)
+def encode_image(path):
+    """
+    Base64 encoded png, read on first use
+    """
+    with open(path, 'rb') as f:
+        return base64.b64encode(f.read())
+
+
+@lru_cache(maxsize=1)
+def temporal_figure():
+    """
+    Temporal network figure of the first year, built once per worker from the prebuilt payload
+    (see plotly_network_temporal). The temporal slider sends the other years one at a time.
+    """
+    year = temporal_years()[0]
+    return make_year_plot(serve_year(year), year)
+
+
+def serve_layout():
+    """
+    Page layout, the figures in it are cached so serving it for every page load is cheap
+    """
+    encoded_matrix = encode_image(corr_matrix)
+    encoded_net = encode_image(corr_net)
+    fig_temporal = temporal_figure()
+    return html.Div([
+        html.H1(children = 'Uncovering the Network', style={'text-align': 'center'}),
+        html.P(children = 'Investment firms with over 100M $ under management are required by law to file a 13F report on a quarterly basis, where they disclose their holdings to the Securities and Exchange Commission (SEC). Such a report includes information about the investment manager, the firm, and the positions the firm holds including the total value, the number of shares, the type of asset, etc. The goal of this project is to perform network analysis on the US financial market and examine the connectivity of the market and how it evolves over time, to the extent possible.', style={'text-align': 'center', 'margin-top': "15px"}),
+        html.P(children = 'In this figure the user can perform a basic exploratory analysis of the network connectivity for a limited set of investment managers for 2017-2020. While no conclusions can be drawn, it is intended to give a general idea of the connectivty between investment managers. In the slider below the figure, the year can be selected.', style={'text-align': 'center', 'margin-top': "15px"}),
+        dcc.Graph(figure=fig_temporal, id='temporal-network', style={'width': '50%'}),
+        html.Div([
+            dcc.Slider(
+                id='temporal-year',
+                min=min(temporal_years()),
+                max=max(temporal_years()),
+                value=temporal_years()[0],
+                marks={year: str(year) for year in temporal_years()},
+                step=None)
                 ],
                 style={"width": "50%"}),
-    html.Img(src='data:image/png;base64,{}'.format(encoded_matrix.decode()), id='corr-matrix'),
-    html.P(children = "Next, the network analysis of the US financial market is illustrated using a bipartite graph. Each investor (red node) is only connected to security issuers (blue nodes). An edge is included only if the normalized value of the position is larger than a predetermined threshold. Degree centrality is used for calculating node importance, with the assumption that the most important security issuers will be the ones that attract the highest number of important positions. This figure is affected by both the year slider above and the threshold slider below. The threshold slider will set the normalized position threshold for which any 2 nodes are determined to be connected. This figure is also affected by the linkage dropdown menu and year slider.", style={'text-align': 'center', 'margin-top': "15px"}),
-    html.H3(children = 'Select the threshold', style={'text-align': 'center'}),
-    dcc.Slider(
-        id='threshold-slider',
-        min=0.05,
-        max=1,
-        value=.05,
-        marks={str(round(t,2)): str(round(t, 2)) for t in np.arange(0.05,1.01,0.05)},
-        step=.05),
-    html.Img(src='data:image/png;base64,{}'.format(encoded_net.decode()), id='corr-network'),
-])
+        html.P(children = "Hierarchical clustering is then applied to the correlation matrix of the US financial market investors. The correlation matrix is based on an investment feature map, calculated assuming each investor is an observation and each possible investment is a feature. For a given investor, the feature vector's values are the normalized investments, i.e. the value of the position divided by the total value of all positions of the investor.", style={'text-align': 'center', 'margin-top. For the interactive options below, it will take approxmately 20 seconds for the figures to update.': "15px"}),
+        html.H3(children = 'Select the year of reported 13F data you are interested in analyzing', style={'text-align': 'center', 'margin-top': "30"}),
+        dcc.Slider(
+            id='year-slider',
+            min=2017,
+            max=2020,
+            value=2017,
+            marks={year: year for year in ["2017", "2018", "2019", "2020"]},
+            step=None),
+        html.H2(children = 'Select the Agglomerative clustering linkage criterion', style={'text-align': 'center'}),
+        html.Div([
+            dcc.Dropdown(
+                    id='cluster-dropdown',
+                    options=[{'label': method, 'value': method} for method in ['single', 'complete', 'centroid', 'ward']],
+                    value='ward')
+                    ],
+                    style={"width": "50%"}),
+        html.Img(src='data:image/png;base64,{}'.format(encoded_matrix.decode()), id='corr-matrix'),
+        html.P(children = "Next, the network analysis of the US financial market is illustrated using a bipartite graph. Each investor (red node) is only connected to security issuers (blue nodes). An edge is included only if the normalized value of the position is larger than a predetermined threshold. Degree centrality is used for calculating node importance, with the assumption that the most important security issuers will be the ones that attract the highest number of important positions. This figure is affected by both the year slider above and the threshold slider below. The threshold slider will set the normalized position threshold for which any 2 nodes are determined to be connected. This figure is also affected by the linkage dropdown menu and year slider.", style={'text-align': 'center', 'margin-top': "15px"}),
+        html.H3(children = 'Select the threshold', style={'text-align': 'center'}),
+        dcc.Slider(
+            id='threshold-slider',
+            min=0.05,
+            max=1,
+            value=.05,
+            marks={str(round(t,2)): str(round(t, 2)) for t in np.arange(0.05,1.01,0.05)},
+            step=.05),
+        html.Img(src='data:image/png;base64,{}'.format(encoded_net.decode()), id='corr-network'),
+        html.H3(children = 'Look up the largest holders of an issuer, or the largest positions of an investor', style={'text-align': 'center'}),
+        html.P(children = 'Enter an issuer (the first 6 characters of its CUSIP) or the CIK of an investment manager. The table shows the last quarter of the year selected above.', style={'text-align': 'center'}),
+        dcc.Input(id='holdings-query', type='text', placeholder='issuer or CIK', debounce=True),
+        html.Div(id='holdings-table'),
+    ])
+
+
+app.layout = serve_layout
+
+@app.callback(Output('temporal-network', 'figure'), Input('temporal-year', 'value'), prevent_initial_call=True)
+def update_temporal_figure(year):
+    """
+    Show another year of the temporal network
+
+    Only the trace data of that year is sent (a Patch of the figure), from the server cache.
+    """
+    with span('temporal callback', year=year):
+        traces = serve_year(year)
+    if Patch is None:
+        return make_year_plot(traces, year)
+    fig = Patch()
+    fig['data'][0]['x'] = traces['edge_x']
+    fig['data'][0]['y'] = traces['edge_y']
+    fig['data'][1]['x'] = traces['node_x']
+    fig['data'][1]['y'] = traces['node_y']
+    fig['data'][1]['text'] = traces['text']
+    fig['data'][1]['hovertext'] = traces['hovertext']
+    fig['data'][1]['marker']['color'] = traces['degree']
+    fig['layout']['title']['text'] = year_title(year)
+    return fig
+
+
+def html_table(frame):
+    """
+    Plain html table of a query result, values in thousands of dollars and shares in percent
+    """
+    def cell(column, value):
+        if column in ('share', 'weight'):
+            return '{:.1%}'.format(value)
+        if column == 'value':
+            return '{:,.0f}'.format(value)
+        return str(value)
+
+    header = html.Tr([html.Th(column) for column in frame.columns])
+    rows = [html.Tr([html.Td(cell(column, value)) for column, value in zip(frame.columns, row)])
+            for row in frame.itertuples(index=False)]
+    return html.Table([header] + rows)
+
+
+@app.callback(Output('holdings-table', 'children'), Input('holdings-query', 'value'), Input('year-slider', 'value'),
+              prevent_initial_call=True)
+def update_holdings_table(query, year):
+    """
+    Drill-down: top holders of an issuer, or else the largest positions of a CIK
+
+    Answered from the posting lists of the year (see holdings_index), not from the correlation pipeline.
+    """
+    if not query:
+        return None
+    # imported here, the analysis stack is only needed once a query is made
+    from investor_correlation import year_index
+    query = query.strip().upper()
+    with span('holdings query', year=year, query=query):
+        index = year_index(int(year))
+        try:
+            frame = index.top_holders(query, n=DRILL_DOWN_ROWS)
+        except KeyError:
+            try:
+                frame = index.portfolio(query).head(DRILL_DOWN_ROWS)
+            except KeyError:
+                return html.P(children = 'No issuer or CIK {} in {}'.format(query, year), style={'text-align': 'center'})
+    return html_table(frame)
+
 
 # https://community.plotly.com/t/multiple-outputs-in-dash-now-available/19437
 @app.callback(
@@ -95,7 +212,10 @@ def update_corr_figure(year, threshold, linkage):
     https://github.com/plotly/dash/issues/71
     https://community.plotly.com/t/using-html-img-as-filter-in-callback/18046/2
     """
-    corr_network, corr_matrix = create_correlation_network(year, threshold, linkage)
+    # imported here, the analysis stack is only needed once a figure is requested
+    from investor_correlation import create_correlation_network
+    with span('correlation callback', year=year, threshold=threshold, linkage=linkage):
+        corr_network, corr_matrix = create_correlation_network(year, threshold, linkage)
     #
     return 'data:image/png;base64,{}'.format(corr_network.decode()), 'data:image/png;base64,{}'.format(corr_matrix.decode())
 
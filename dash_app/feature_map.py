@@ -0,0 +1,129 @@
+"""
+Module to build the investor x issuer feature map and correlate investors
+
+The feature map is stored as a sparse CSR matrix (one row per CIK, one column
+per issuer), since almost every investor holds only a tiny part of all issuers.
+Pearson correlations between rows are computed from sparse Gram products and
+the row means and norms, without ever making the centred matrix dense.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from instrument import traced
+
+
+@traced('pivot', rows=lambda result: result[0].nnz)
+def feature_map(df, index='cik', columns='issuer', values='norm_value'):
+    """
+    Sparse feature map of a long DataFrame, duplicate (index, columns) pairs are summed
+
+    Returns the CSR matrix and the row and column labels, sorted like DataFrame.pivot
+    """
+    rows, row_labels = pd.factorize(df[index], sort=True)
+    cols, col_labels = pd.factorize(df[columns], sort=True)
+    # missing labels get code -1, pivot drops them as well
+    keep = (rows >= 0) & (cols >= 0)
+    X = sparse.csr_matrix(
+        (df[values].to_numpy(dtype=float)[keep], (rows[keep], cols[keep])),
+        shape=(len(row_labels), len(col_labels)))
+    X.sum_duplicates()
+    return X, pd.Index(row_labels, name=index), pd.Index(col_labels, name=columns)
+
+
+def _row_stats(X):
+    """ Mean and centred norm of every row of X, zero columns included """
+    m = X.shape[1]
+    mean = np.asarray(X.sum(axis=1)).ravel() / m
+    squares = np.asarray(X.multiply(X).sum(axis=1)).ravel()
+    norm = np.sqrt(np.maximum(squares - m * mean ** 2, 0))
+    return mean, norm
+
+
+def _correlation_block(X, XT, start, stop, mean, norm):
+    """ Correlations of rows start:stop of X with all rows, as a dense array """
+    m = X.shape[1]
+    gram = (X[start:stop] @ XT).toarray()
+    cov = gram - m * np.outer(mean[start:stop], mean)
+    scale = np.outer(norm[start:stop], norm)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = np.where(scale > 0, cov / scale, np.nan)
+    np.clip(corr, -1, 1, out=corr)
+    # rounding can leave the diagonal slightly off 1
+    diagonal = np.arange(start, stop)
+    corr[diagonal - start, diagonal] = np.where(norm[start:stop] > 0, 1.0, np.nan)
+    return corr
+
+
+@traced('correlate', rows=len)
+def correlation(X, block_size=None):
+    """
+    Pearson correlation between the rows of the sparse matrix X
+
+    Same result as DataFrame.corr on the dense transpose, rows with zero variance get NaN.
+    With block_size the Gram product is computed that many rows at a time, which bounds
+    the temporary memory next to the n x n result.
+    """
+    n = X.shape[0]
+    X = sparse.csr_matrix(X, dtype=float)
+    XT = X.T.tocsc()
+    mean, norm = _row_stats(X)
+
+    block_size = block_size or n
+    corr = np.empty((n, n))
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        corr[start:stop] = _correlation_block(X, XT, start, stop, mean, norm)
+    return corr
+
+
+def correlation_frame(df, index='cik', columns='issuer', values='norm_value', block_size=None):
+    """
+    Correlation between the index labels of a long DataFrame
+
+    Equivalent to df.pivot(index, columns, values).fillna(0).transpose().corr()
+    """
+    X, labels, _ = feature_map(df, index, columns, values)
+    corr = correlation(X, block_size)
+    return pd.DataFrame(corr, index=labels, columns=labels.copy())
+
+
+def top_correlations(df, k, index='cik', columns='issuer', values='norm_value', block_size=1000):
+    """
+    The k most correlated other investors of every investor
+
+    Only one block of block_size rows is correlated at a time, so the full n x n matrix
+    is never held in memory. Returns a long DataFrame with columns source, target and correlation.
+    """
+    X, labels, _ = feature_map(df, index, columns, values)
+    n = X.shape[0]
+    k = min(k, n - 1)
+    if k < 1:
+        return pd.DataFrame({'source': labels[:0], 'target': labels[:0], 'correlation': np.empty(0)})
+    XT = X.T.tocsc()
+    mean, norm = _row_stats(X)
+
+    sources, targets, correlations = [], [], []
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        corr = _correlation_block(X, XT, start, stop, mean, norm)
+        # never pick the row itself or an undefined correlation
+        corr[np.arange(stop - start), np.arange(start, stop)] = -np.inf
+        corr[np.isnan(corr)] = -np.inf
+
+        top = np.argpartition(-corr, k - 1, axis=1)[:, :k]
+        best = np.take_along_axis(corr, top, axis=1)
+        order = np.argsort(-best, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        best = np.take_along_axis(best, order, axis=1)
+
+        valid = np.isfinite(best)
+        sources.append(np.broadcast_to(np.arange(start, stop)[:, None], top.shape)[valid])
+        targets.append(top[valid])
+        correlations.append(best[valid])
+
+    return pd.DataFrame({
+        'source': labels[np.concatenate(sources)],
+        'target': labels[np.concatenate(targets)],
+        'correlation': np.concatenate(correlations)})
@@ -0,0 +1,189 @@
+"""
+Module to read and write the holdings table
+
+The holdings are either a csv file written by xml_parser (e.g. filingsEnd2019.csv)
+or a parquet dataset partitioned by report year and quarter:
+holdings/year=2019/quarter=4/part-00000-0.parquet
+In the dataset the text columns are dictionary encoded and an issuer column
+(first 6 characters of the CUSIP) is stored next to the CUSIP. The CIK is a
+number in both, whatever the storage (datasets written with a zero-padded text
+CIK are converted when they are read).
+
+With compact=True the table is loaded with categorical text columns and the
+smallest integer types that hold the values, normalize_positions then works
+on it without going back to object columns.
+"""
+
+import os
+import glob
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from instrument import traced
+
+# text columns that are stored dictionary encoded in the parquet dataset
+DICTIONARY_COLUMNS = ['filed name', 'cusip', 'issuer', 'put_or_call', 'owner']
+# hive partitions of the dataset
+PARTITION_COLUMNS = ['year', 'quarter']
+# integer columns downcast by a compact read, and the rows of csv converted at a time
+INTEGER_COLUMNS = ['value', 'amount', 'cik', 'year', 'quarter']
+COMPACT_CHUNK_ROWS = 200000
+
+
+def _schema():
+    import pyarrow as pa
+    text = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema([(col, text) for col in DICTIONARY_COLUMNS] + [
+        ('cik', pa.int64()),
+        ('value', pa.int64()),
+        ('amount', pa.int64()),
+        ('report_date', pa.date32()),
+        ('year', pa.int16()),
+        ('quarter', pa.int8()),
+    ])
+
+
+def clear_holdings(root):
+    """
+    Remove the parquet files written by write_holdings below root
+    """
+    for path in glob.glob(os.path.join(root, 'year=*', 'quarter=*', 'part-*.parquet')):
+        os.remove(path)
+
+
+def write_holdings(df, root, basename):
+    """
+    Append a DataFrame of holdings (xml_parser columns) to the parquet dataset at root
+
+    Every call writes one new file per year/quarter partition, named after basename.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    report_date = pd.to_datetime(df['report_date'])
+    df = df.assign(
+        issuer=df['cusip'].str[:6],
+        cik=pd.to_numeric(df['cik']),
+        report_date=report_date.dt.date,
+        year=report_date.dt.year,
+        quarter=report_date.dt.quarter)
+
+    table = pa.Table.from_pandas(df, schema=_schema(), preserve_index=False)
+    pq.write_to_dataset(table, root, partition_cols=PARTITION_COLUMNS,
+                        basename_template=basename + '-{i}.parquet')
+
+
+@traced('read holdings', rows=len)
+def read_holdings(path, columns=None, year=None, quarter=None, compact=False):
+    """
+    Read holdings from a csv file or a parquet dataset folder
+
+    Only the given columns are loaded, 'issuer' is derived from the CUSIP when the
+    source does not have it. Year and quarter select report periods; on a dataset
+    only the matching partitions are read. Compact loads the text columns as
+    categoricals and downcasts the integer columns.
+    """
+    if os.path.isdir(path):
+        import pyarrow.dataset as ds
+
+        dataset = ds.dataset(path, format='parquet', partitioning='hive')
+        selection = None
+        for col, wanted in (('year', year), ('quarter', quarter)):
+            if wanted is not None:
+                condition = ds.field(col) == int(wanted)
+                selection = condition if selection is None else selection & condition
+        df = _numeric_cik(dataset.to_table(columns=columns, filter=selection).to_pandas())
+        return _downcast(df) if compact else df
+
+    derive_issuer = columns is not None and 'issuer' in columns
+    usecols = None
+    if columns is not None:
+        usecols = [col for col in columns if col != 'issuer']
+        if derive_issuer and 'cusip' not in usecols:
+            usecols.append('cusip')
+        if (year is not None or quarter is not None) and 'report_date' not in usecols:
+            usecols.append('report_date')
+
+    reader = pd.read_csv(path, usecols=usecols, dtype={'cusip': str},
+                         chunksize=COMPACT_CHUNK_ROWS if compact else None)
+    if not compact:
+        return _select(reader, columns, year, quarter, derive_issuer)
+
+    # one chunk at a time as categoricals, so the object columns of the whole file never exist at once
+    chunks = []
+    for chunk in reader:
+        chunk = _select(chunk, columns, year, quarter, derive_issuer)
+        for col in chunk.columns:
+            if col in DICTIONARY_COLUMNS:
+                chunk[col] = chunk[col].astype('category')
+        chunks.append(chunk)
+    return _downcast(_concat_categorical(chunks))
+
+
+def _numeric_cik(df):
+    """ CIK as a number, like in the csv, for datasets written with the CIK as text """
+    if 'cik' in df and not pd.api.types.is_integer_dtype(df['cik']):
+        if isinstance(df['cik'].dtype, pd.CategoricalDtype):
+            # convert the categories, not every row
+            categories = pd.to_numeric(df['cik'].cat.categories.astype(str)).to_numpy()
+            df['cik'] = categories[df['cik'].cat.codes.to_numpy()]
+        else:
+            df['cik'] = pd.to_numeric(df['cik'].astype(str))
+    return df
+
+
+def _select(df, columns, year, quarter, derive_issuer):
+    """ Report periods, issuer column and column order of a csv read """
+    if year is not None or quarter is not None:
+        report_date = pd.to_datetime(df['report_date'])
+        mask = pd.Series(True, index=df.index)
+        if year is not None:
+            mask &= report_date.dt.year == int(year)
+        if quarter is not None:
+            mask &= report_date.dt.quarter == int(quarter)
+        df = df.loc[mask].reset_index(drop=True)
+
+    if derive_issuer:
+        df['issuer'] = df['cusip'].str[:6]
+    if columns is not None:
+        df = df[columns]
+    return df
+
+
+def _concat_categorical(chunks):
+    """ Concatenate frames whose categorical columns have different categories """
+    if len(chunks) == 1:
+        return chunks[0]
+    df = {}
+    for col in chunks[0].columns:
+        if isinstance(chunks[0][col].dtype, pd.CategoricalDtype):
+            # sorted like the categories of a single chunk, so groupby order doesn't depend on chunking
+            df[col] = union_categoricals([chunk[col] for chunk in chunks], sort_categories=True)
+        else:
+            df[col] = np.concatenate([chunk[col].to_numpy() for chunk in chunks])
+    return pd.DataFrame(df)
+
+
+def _downcast(df):
+    """ Integer columns in the smallest type that holds them """
+    for col in INTEGER_COLUMNS:
+        if col in df and pd.api.types.is_integer_dtype(df[col]):
+            df[col] = pd.to_numeric(df[col], downcast='integer')
+    return df
+
+
+@traced('normalize', rows=len)
+def normalize_positions(df, by='owner'):
+    """
+    Value of every position as a fraction of the total value of its owner, summed per (cik, issuer)
+
+    Positions with a zero value are left out. Returns cik, issuer and norm_value.
+    """
+    total = df.groupby(by, observed=True)['value'].transform('sum')
+    mask = df['value'].to_numpy() != 0
+    positions = df.loc[mask, ['cik', 'issuer']]
+    positions['norm_value'] = df['value'].to_numpy()[mask] / total.to_numpy()[mask]
+    return positions.groupby(['cik', 'issuer'], observed=True).agg({'norm_value': 'sum'}).reset_index()
+
@@ -0,0 +1,181 @@
+"""
+Module to answer who holds a security and what an investor holds
+
+holdings_index keeps the positions of every report quarter of a
+timeseries.quarter_store twice: as a CSR matrix, whose rows are the portfolio
+of every investor (the codes of its securities, sorted), and as a CSC matrix,
+whose columns are the holders of every security (sorted). Investors and
+securities are numbered once over all quarters, so a query is a hash lookup of
+a code and a slice of one posting list, instead of reloading and filtering a
+holdings table:
+
+- holders(security) and top_holders(security, n): who holds it and for how much,
+- portfolio(investor): what an investor holds and its weight in the portfolio,
+- overlap(a, b): the securities two investors share, their Jaccard index and
+  the overlap of their portfolio weights,
+- similar(investor, n): the investors with the largest Jaccard index, from the
+  holders of its securities.
+
+Every query takes the quarter (a Period, 'YYYYQn' or its position), the last
+one by default.
+"""
+
+import numpy as np
+import pandas as pd
+
+from holdings import read_holdings
+from timeseries import quarter_store
+
+
+def _code(labels, key, kind):
+    """ Position of key in labels, also for a CIK given as text or a number """
+    code = labels.get_indexer([key])[0]
+    if code < 0 and isinstance(key, str) and key.isdigit():
+        code = labels.get_indexer([int(key)])[0]
+    if code < 0 and isinstance(key, (int, np.integer)):
+        code = labels.get_indexer([str(key)])[0]
+    if code < 0:
+        raise KeyError(f"Unknown {kind}: {key}")
+    return code
+
+
+class holdings_index:
+    """
+    Posting lists of the positions of a quarter_store, by investor and by security
+
+    Securities is an optional security_master and names an optional Series with the
+    display name of every investor (e.g. the owner of every CIK), both used to label
+    the query results.
+    """
+    def __init__(self, store, securities=None, names=None):
+        self.store = store
+        self.securities = securities
+        self.names = names
+        self.portfolios = []
+        self.holders_of = []
+        for i in range(len(store.quarters)):
+            by_node = store.matrix(i)
+            by_node.sort_indices()
+            by_security = by_node.tocsc()
+            by_security.sort_indices()
+            self.portfolios.append(by_node)
+            self.holders_of.append(by_security)
+
+    def __repr__(self):
+        n, m = self.store.shape
+        return f"holdings index of {n} {self.store.node} and {m} {self.store.on} in {len(self.store.quarters)} quarters"
+
+    def _quarter(self, quarter):
+        return len(self.store.quarters) - 1 if quarter is None else self.store._index(quarter)
+
+    def _postings(self, matrix, code):
+        """ Codes and values of one row of a csr (or column of a csc) matrix """
+        part = slice(matrix.indptr[code], matrix.indptr[code + 1])
+        return matrix.indices[part], matrix.data[part]
+
+    def _node_frame(self, nodes, values, total):
+        frame = pd.DataFrame({self.store.node: self.store.nodes[nodes], 'value': values,
+                              'share': values / total if total else np.zeros(len(values))})
+        if self.names is not None:
+            frame['name'] = self.names.reindex(frame[self.store.node]).to_numpy()
+        return frame
+
+    def _security_names(self, codes):
+        if self.store.on == 'cusip':
+            return self.securities.cusip_names(codes).to_numpy()
+        return self.securities.issuer_names(codes).to_numpy()
+
+    def holders(self, security, quarter=None):
+        """
+        Holders of a security in a quarter, largest position first
+
+        Returns the investor, the value and its share of the value held by all holders.
+        """
+        j = _code(self.store.securities, security, self.store.on)
+        nodes, values = self._postings(self.holders_of[self._quarter(quarter)], j)
+        order = np.argsort(-values, kind='stable')
+        return self._node_frame(nodes[order], values[order], values.sum())
+
+    def top_holders(self, security, n=10, quarter=None):
+        """ The n largest holders of a security in a quarter, like holders(security).head(n) """
+        j = _code(self.store.securities, security, self.store.on)
+        nodes, values = self._postings(self.holders_of[self._quarter(quarter)], j)
+        if len(values) > n:
+            top = np.argpartition(-values, n - 1)[:n]
+        else:
+            top = np.arange(len(values))
+        top = top[np.lexsort((top, -values[top]))]
+        return self._node_frame(nodes[top], values[top], values.sum())
+
+    def portfolio(self, node, quarter=None):
+        """
+        Positions of an investor in a quarter, largest first, with their weight in the portfolio
+        """
+        i = _code(self.store.nodes, node, self.store.node)
+        securities, values = self._postings(self.portfolios[self._quarter(quarter)], i)
+        order = np.argsort(-values, kind='stable')
+        securities, values = securities[order], values[order]
+        total = values.sum()
+        frame = pd.DataFrame({self.store.on: self.store.securities[securities], 'value': values,
+                              'weight': values / total if total else np.zeros(len(values))})
+        if self.securities is not None and self.store.on in ('cusip', 'issuer'):
+            frame['name'] = self._security_names(frame[self.store.on])
+        return frame
+
+    def overlap(self, a, b, quarter=None):
+        """
+        What two investors have in common in a quarter
+
+        Returns a dict with the number of shared securities and of securities only one of them
+        holds, the Jaccard index, the weighted overlap (sum over shared securities of the
+        smaller portfolio weight, 1 for identical portfolios) and the shared securities.
+        """
+        q = self._quarter(quarter)
+        held_a, values_a = self._postings(self.portfolios[q], _code(self.store.nodes, a, self.store.node))
+        held_b, values_b = self._postings(self.portfolios[q], _code(self.store.nodes, b, self.store.node))
+        # posting lists are sorted and unique
+        shared, in_a, in_b = np.intersect1d(held_a, held_b, assume_unique=True, return_indices=True)
+        union = len(held_a) + len(held_b) - len(shared)
+        weights_a = values_a / values_a.sum() if values_a.sum() else np.zeros(len(values_a))
+        weights_b = values_b / values_b.sum() if values_b.sum() else np.zeros(len(values_b))
+        return {'shared': len(shared), 'only_a': len(held_a) - len(shared), 'only_b': len(held_b) - len(shared),
+                'jaccard': len(shared) / union if union else 0.0,
+                'weighted': float(np.minimum(weights_a[in_a], weights_b[in_b]).sum()),
+                'securities': self.store.securities[shared]}
+
+    def similar(self, node, n=10, quarter=None):
+        """
+        The n investors whose portfolio in a quarter overlaps most with node's (by Jaccard index)
+        """
+        q = self._quarter(quarter)
+        i = _code(self.store.nodes, node, self.store.node)
+        held, _ = self._postings(self.portfolios[q], i)
+        # every holder of every security of node, once per shared security
+        holders = self.holders_of[q][:, held].indices
+        shared = np.bincount(holders, minlength=self.store.shape[0])
+        shared[i] = 0
+        sizes = np.diff(self.portfolios[q].indptr)
+        candidates = np.flatnonzero(shared)
+        jaccard = shared[candidates] / (sizes[candidates] + len(held) - shared[candidates])
+        top = np.lexsort((candidates, -jaccard))[:n]
+        frame = pd.DataFrame({self.store.node: self.store.nodes[candidates[top]], 'shared': shared[candidates[top]],
+                              'jaccard': jaccard[top]})
+        if self.names is not None:
+            frame['name'] = self.names.reindex(frame[self.store.node]).to_numpy()
+        return frame
+
+
+def load_index(path, node='cik', on='issuer', year=None, securities=None):
+    """
+    holdings_index of a holdings csv file or parquet dataset (see holdings.read_holdings)
+
+    On is 'issuer' (the first 6 characters of the CUSIP) or 'cusip'. Securities is an optional
+    security_master for the names of the securities; investors given by CIK are named by
+    their owner.
+    """
+    columns = list(dict.fromkeys([node, on, 'value', 'report_date', 'owner']))
+    df = read_holdings(path, columns, year=year, compact=True)
+    names = None
+    if node != 'owner':
+        names = df.drop_duplicates(subset=node, keep='last').set_index(node)['owner'].astype(str)
+    return holdings_index(quarter_store(df, node, on), securities, names)
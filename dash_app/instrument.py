@@ -0,0 +1,204 @@
+"""
+Module to time the stages of the pipeline
+
+A span measures one stage: its wall time, the rows it went through and the peak
+resident memory of the process (and how much the span raised it). Spans nest,
+every record names the span it ran in, so a slow callback can be broken down
+into read, normalize, pivot, correlate, cluster, layout, render and encode.
+
+    with span('render', year=year) as s:
+        ...
+        s.set(rows=len(G))
+
+or, for a whole function, @traced('normalize', rows=len).
+
+Instrumentation is off unless the INSTRUMENT environment variable is set or
+enable() is called. Off, span() returns one shared object that does nothing,
+so the spans can stay in production code. On, every finished span is written
+as a JSON line, to the file INSTRUMENT names (appended, so worker processes
+can share it) or to the 'instrument' logger with INSTRUMENT=1, and added to
+the per-stage totals of summary(), which the Dash app serves at /metrics.
+"""
+
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # windows, no memory measurements
+    resource = None
+
+# writes a finished span, None while instrumentation is off
+_write = None
+_local = threading.local()
+_lock = threading.Lock()
+_totals = {}
+
+
+def peak_rss():
+    """ Peak resident memory of this process in bytes, None where it can't be measured """
+    try:
+        # linux: the high water mark of this process' memory, which starts afresh at exec.
+        # ru_maxrss doesn't, a child process reports the peak of its parent until it goes above it
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _stack():
+    """ Open spans of the current thread """
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+class _span:
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def set(self, **fields):
+        """ Add fields to the record, e.g. rows once they are known """
+        self.fields.update(fields)
+
+    def __enter__(self):
+        stack = _stack()
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self.peak = peak_rss()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        seconds = time.perf_counter() - self.start
+        peak = peak_rss()
+        _stack().pop()
+        record = {'span': self.name, 'parent': self.parent, 'seconds': seconds, 'peak': peak,
+                  'peak_growth': None if peak is None else peak - self.peak, **self.fields}
+        if kind is not None:
+            record['error'] = kind.__name__
+        _record(record)
+        return False
+
+
+class _disabled:
+    """ What span() returns while instrumentation is off """
+    __slots__ = ()
+
+    def set(self, **fields):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        return False
+
+
+_DISABLED = _disabled()
+
+
+def span(name, **fields):
+    """
+    Context manager measuring one stage; fields (e.g. year=2019) are added to its record
+    """
+    if _write is None:
+        return _DISABLED
+    return _span(name, fields)
+
+
+def traced(name, rows=None):
+    """
+    Decorator measuring every call of a function as a span
+
+    Rows is an optional function of the result giving the rows of the record, e.g. len.
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _write is None:
+                return function(*args, **kwargs)
+            with _span(name, {}) as s:
+                result = function(*args, **kwargs)
+                if rows is not None:
+                    s.set(rows=rows(result))
+                return result
+        return wrapper
+    return decorate
+
+
+def _record(record):
+    record['time'] = time.time()
+    record['pid'] = os.getpid()
+    with _lock:
+        total = _totals.setdefault(record['span'], {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                                    'rows': 0, 'peak': None, 'errors': 0})
+        total['count'] += 1
+        total['seconds'] += record['seconds']
+        total['max_seconds'] = max(total['max_seconds'], record['seconds'])
+        total['rows'] += record.get('rows') or 0
+        if record['peak'] is not None:
+            total['peak'] = max(total['peak'] or 0, record['peak'])
+        total['errors'] += 'error' in record
+    write = _write
+    if write is not None:
+        write(json.dumps(record, default=str))
+
+
+def enable(path=None):
+    """
+    Turn instrumentation on, writing the spans to path (JSON lines) or the 'instrument' logger
+    """
+    global _write
+    if path is None:
+        logger = logging.getLogger('instrument')
+        if not logger.handlers and not logging.getLogger().handlers:
+            # nothing configured logging, the records would be dropped
+            logger.addHandler(logging.StreamHandler())
+            logger.setLevel(logging.INFO)
+        _write = logger.info
+        return
+
+    # one write per record on a file opened for appending, so processes don't mix their lines
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    _write = lambda line: os.write(fd, (line + '\n').encode())
+
+
+def disable():
+    """ Turn instrumentation off """
+    global _write
+    _write = None
+
+
+def enabled():
+    return _write is not None
+
+
+def summary():
+    """ Count, total and longest time, rows, peak memory and errors of every span name since the start """
+    with _lock:
+        return {'enabled': enabled(), 'spans': {name: dict(total) for name, total in _totals.items()}}
+
+
+def reset():
+    """ Forget the totals """
+    with _lock:
+        _totals.clear()
+
+
+_setting = os.environ.get('INSTRUMENT', '')
+if _setting and _setting != '0':
+    enable(None if _setting == '1' else _setting)
@@ -2,53 +2,165 @@
 Module to create network
 """
 
-import numpy as np
+import os
 import pandas as pd
-import operator
 import base64
+import io
+from functools import lru_cache
 
 import networkx as nx
 import matplotlib
 # Necessary backend
 matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
-import seaborn as sns
+from matplotlib.figure import Figure
 
-def create_correlation_network(year, threshold, linkage):
+from holdings import read_holdings, normalize_positions
+from security_master import load_security_master
+from holdings_index import load_index
+from feature_map import correlation_frame
+from bipartite import bipartite_graph
+from layout import layout
+from clustering import METHODS, condensed_distance, linkage_matrix, heatmap_figure
+from instrument import span, traced
+
+# parquet dataset written by xml_parser.parse(format='parquet'), used instead of
+# the yearly csv files when it exists
+HOLDINGS_DATASET = 'data/holdings'
+# per-year artifacts written by precompute()
+PREPARED_DIR = 'data/prepared'
+# cached network positions
+LAYOUT_DIR = 'data/layouts'
+# number of prepared years and of rendered figures kept in memory
+YEAR_CACHE_SIZE = 4
+FIGURE_CACHE_SIZE = 64
+# number of flat clusters outlined on the correlation matrix
+FLAT_CLUSTERS = 8
+# the network figure draws the largest positions above the threshold, at most this many
+NETWORK_MAX_POSITIONS = 2000
+# the correlation matrix (and its clustering, cubic in the number of investors) covers
+# this many investors of the year, the largest by reported value
+MATRIX_MAX_INVESTORS = 1000
+# an issuer can have multiple different CUSIP's (first class shares, normal shares, etc)
+# they are all money however so we only load the issuer (first 6 characters of the CUSIP),
+# its name comes from the security master
+COLUMNS = ['issuer', 'value', 'owner', 'cik']
+
+
+def load_holdings(year):
     """
-    Generate the graph based on correlation
+    Load the holdings of one year, only the columns needed for the figures
+    """
+    if os.path.isdir(HOLDINGS_DATASET):
+        return read_holdings(HOLDINGS_DATASET, COLUMNS, year=year, compact=True)
+    return read_holdings('data/filingsEnd{}.csv'.format(year), COLUMNS, compact=True)
+
+
+def load_securities(year):
+    """
+    Security master of the holdings of one year (of all years with the parquet dataset)
+    """
+    if os.path.isdir(HOLDINGS_DATASET):
+        return load_security_master(HOLDINGS_DATASET)
+    return load_security_master('data/filingsEnd{}.csv'.format(year))
+
+
+@lru_cache(maxsize=YEAR_CACHE_SIZE)
+def year_index(year):
+    """
+    Holders of every issuer and portfolio of every CIK in the quarters of one year (see holdings_index)
+    """
+    if os.path.isdir(HOLDINGS_DATASET):
+        return load_index(HOLDINGS_DATASET, year=year, securities=load_securities(year))
+    return load_index('data/filingsEnd{}.csv'.format(year), securities=load_securities(year))
+
+
+@traced('encode', rows=len)
+def encode_figure(fig):
+    """
+    Render a figure to png in memory, base64 encoded
+    """
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png')
+    return base64.b64encode(buffer.getvalue())
+
+
+@lru_cache(maxsize=YEAR_CACHE_SIZE)
+def prepare_year(year):
+    """
+    Normalized positions, security master and investor correlation of one year
+
+    The positions cover every investor, the correlation the MATRIX_MAX_INVESTORS largest.
+    Read from PREPARED_DIR when precompute() has been run at build time, computed otherwise.
+    The result is shared by every figure of that year and must not be modified.
+    """
+    path = os.path.join(PREPARED_DIR, '{}.pkl'.format(year))
+    if os.path.exists(path):
+        return pd.read_pickle(path)
+    return _compute_year(year)
+
+
+@traced('prepare year', rows=lambda result: len(result[2]))
+def _compute_year(year):
+    df = load_holdings(year)
+    securities = load_securities(year)
+    largest = df.groupby('cik', observed=True)['value'].sum().nlargest(MATRIX_MAX_INVESTORS).index
+    # share of each position in the owner's portfolio, summed per investor and issuer
+    df = normalize_positions(df)
+    # correlate the largest investors on the sparse cik x issuer feature map
+    matrix = df[df['cik'].isin(largest)]
+    correlation = correlation_frame(matrix, index='cik', columns='issuer', values='norm_value')
+    return df, securities, correlation
+
+
+def precompute(years):
     """
-    df = pd.read_csv('data/filingsEnd{}.csv'.format(year))
-    df = df.sample(frac=.1, replace=False, random_state=13)
-    df = df.reset_index(inplace=False)
-    # an issuer can have multiple different CUSIP's (first class shares, normal shares, etc)
-    # they are all money however so we will aggregate them in the future
-    df['issuer'] = df['cusip'].apply(lambda x: x[:6])
-    # compute total value for each CIK, to normalize investments later
-    totalValue = df.groupby('owner')['value'].sum()
-    df = df.merge(totalValue, how='left', left_on='owner', right_index=True)
-    df.drop(columns=['Unnamed: 0', 'cusip', 'amount', 'put_or_call', 'report_date'], inplace=True)
-    print(df.columns)
-    # compute normalized value
-    df['norm_value'] = df['value_x'] / df['value_y']
-    mask = df['value_x'] == 0
-    df = df.loc[~mask]
-    issuers = df.drop_duplicates(subset='issuer')
-    issuers['label'] = issuers['filed name'].apply(lambda x: ' '.join(x[:].split(' ')[:3]))
-    # perform final aggregation and inspect
-    issuers = issuers[['label', 'issuer']]
-    df = df.groupby(['cik','issuer']).agg({'norm_value': 'sum'})
-    df = df.reset_index()
-    wideDf = df.pivot(index='cik', columns='issuer', values='norm_value').fillna(value=0)
-    correlation = wideDf.transpose().corr()
-    # cluster the correlation matrix to show connectivity
-    clmap = sns.clustermap(correlation, method=linkage)
-
-    # Necessary to refresh newly saved fig
-    corr_matrix = "data/corr_matrix.png"
-    clmap.savefig(corr_matrix)
-    encoded_matrix = base64.b64encode(open(corr_matrix, 'rb').read())
+    Build the per-year artifacts and store them in PREPARED_DIR
+
+    Run this at build time (see the bottom of this file) after the holdings changed,
+    the app then only has to load them.
+    """
+    os.makedirs(PREPARED_DIR, exist_ok=True)
+    for year in years:
+        pd.to_pickle(_compute_year(int(year)), os.path.join(PREPARED_DIR, '{}.pkl'.format(year)))
+    prepare_year.cache_clear()
+
+
+@lru_cache(maxsize=YEAR_CACHE_SIZE)
+def year_distance(year):
+    """
+    Condensed distance matrix of the investors of one year, shared by all linkage methods
+    """
+    df, securities, correlation = prepare_year(year)
+    return condensed_distance(correlation)
+
+
+@lru_cache(maxsize=YEAR_CACHE_SIZE * len(METHODS))
+def year_linkage(year, method):
+    """
+    Linkage of one year for one method, the same for the rows and columns of the matrix
+    """
+    return linkage_matrix(year_distance(year), method)
+
+
+@lru_cache(maxsize=FIGURE_CACHE_SIZE)
+@traced('matrix figure')
+def correlation_matrix_figure(year, linkage):
+    """
+    Clustered correlation matrix of one year, base64 encoded png
+    """
+    df, securities, correlation = prepare_year(year)
+    # cluster the correlation matrix to show connectivity, drawn at most HEATMAP_SIZE cells wide
+    fig = heatmap_figure(correlation, year_linkage(year, linkage), clusters=FLAT_CLUSTERS)
+    return encode_figure(fig)
+
+
+@lru_cache(maxsize=FIGURE_CACHE_SIZE)
+@traced('network figure')
+def network_figure(year, threshold):
+    """
+    Investor-issuer network of one year for a position threshold, base64 encoded png
+    """
+    df, securities, correlation = prepare_year(year)
 
     # now pick an 'gravity' factor
     # factors above 1 lead to a more clustered graph
@@ -56,53 +168,51 @@ def create_correlation_network(year, threshold, linkage):
     # values between 0.5-1 make best graphs
     # lower threshold values need lower gravity factors
     gravity = 0.4
-    df = df.sample(frac=.1, replace=False, random_state=13)
-    df = df.reset_index(inplace=False)
-    investors = []
-    companies = []
-    G=nx.Graph()
-    for i in df.index:
-        edge = df.iloc[i,]
-        if edge['norm_value'] > threshold:
-            G.add_edge(edge['cik'], edge['issuer'], weight=edge['norm_value'] ** (1/gravity))
-            investors.append(edge['cik'])
-            companies.append(edge['issuer'])
-            # calculate centrality
-    degCent = nx.degree_centrality(G)
+    # the network can't show every investor, draw the largest positions above the threshold
+    df = df[df['norm_value'] > threshold].nlargest(NETWORK_MAX_POSITIONS, 'norm_value')
+    # positions above the threshold become edges, investors and companies hold each node once
+    G, investors, companies, degCent = bipartite_graph(df, threshold, gravity)
     # get positions
-    pos = nx.spring_layout(G)  # positions for all nodes
+    pos = layout(G, cache_dir=LAYOUT_DIR)  # positions for all nodes
     # calculate node size based on centrality for each group
-    investorSize = [degCent[investor]**1.5 * 10000 for investor in investors]
-    issuerSize = [degCent[issuer]**1.5 * 10000 for issuer in companies]
+    investorSize = (degCent[investors]**1.5 * 10000).tolist()
+    issuerSize = (degCent[companies]**1.5 * 10000).tolist()
     # calculate edge size
     edgeSize = [d['weight'] ** (gravity) for (u, v, d) in G.edges(data=True)]
     #pick how many labels you want displayed
     num = 20
     # get num most central issuers
-    sorted_x = sorted(degCent.items(), key=operator.itemgetter(1), reverse=True)
-    central = [item[0] for item in sorted_x[:num] if type(item[0]) == str]
-#
-    # turn list into dictionary
-    labels = {}
-    for code in central:
-        try:
-            labels[code] = issuers[issuers['issuer'] == code]['label'].item()
-        except:
-            labels[code] = code
-
-    plt.figure(figsize=(15,15))
-    nx.draw_networkx_nodes(G, pos, nodelist=investors, node_size=investorSize, alpha=0.5, node_color='r')
-    nx.draw_networkx_nodes(G, pos, nodelist=companies, node_size=issuerSize, alpha=0.5, node_color='b')
-    nx.draw_networkx_edges(
-        G, pos, width=edgeSize, alpha=0.4, edge_color="k")
-    nx.draw_networkx_labels(G, pos, labels=labels, font_size=10, font_family="sans-serif", font_color='k');
-
-    corr_network = "data/corr_network.png"
-    plt.savefig('data/corr_network.png')
-    encoded_network = base64.b64encode(open(corr_network, 'rb').read())
-
-    return encoded_network, encoded_matrix
+    central = degCent.nlargest(num).index.intersection(companies, sort=False)
+    # canonical names from the security master, the code itself for an unknown issuer
+    labels = securities.labels(central)
+
+    # a figure of our own instead of pyplot's current one, so parallel callbacks don't share state
+    with span('render network', rows=len(G)):
+        fig = Figure(figsize=(15,15))
+        ax = fig.add_subplot()
+        nx.draw_networkx_nodes(G, pos, nodelist=investors, node_size=investorSize, alpha=0.5, node_color='r', ax=ax)
+        nx.draw_networkx_nodes(G, pos, nodelist=companies, node_size=issuerSize, alpha=0.5, node_color='b', ax=ax)
+        nx.draw_networkx_edges(
+            G, pos, width=edgeSize, alpha=0.4, edge_color="k", ax=ax)
+        nx.draw_networkx_labels(G, pos, labels=labels, font_size=10, font_family="sans-serif", font_color='k', ax=ax)
+
+    return encode_figure(fig)
+
+
+def create_correlation_network(year, threshold, linkage):
+    """
+    Generate the graph based on correlation
+
+    Every stage is cached: a new threshold only rebuilds the network from the prepared
+    positions, a new linkage only re-clusters the distances of the prepared correlation matrix.
+    """
+    # slider values can come in as strings or with float noise
+    year = int(year)
+    threshold = round(float(threshold), 2)
+    return network_figure(year, threshold), correlation_matrix_figure(year, linkage)
 
 
 if __name__ == "__main__":
-    create_correlation_network("2017", .5)
+    # build step: python investor_correlation.py 2017 2018 2019 2020
+    import sys
+    precompute(sys.argv[1:])
@@ -0,0 +1,255 @@
+"""
+Module to compute node positions for the network figures
+
+force_layout is a Fruchterman-Reingold layout (the algorithm behind
+nx.spring_layout) written with numpy arrays: attraction is summed over the edge
+arrays and repulsion is computed exactly in blocks for small graphs, or against
+the centres of mass of a grid of cells for large graphs (a one-level
+Barnes-Hut approximation).
+
+layout adds a disk cache keyed by a fingerprint of the graph and of the layout
+settings, and can warm-start from earlier positions (e.g. the previous year) so
+that nodes keep their place.
+"""
+
+import os
+import hashlib
+import tempfile
+import zipfile
+
+import numpy as np
+import networkx as nx
+
+from instrument import traced
+
+# graphs with more nodes use the grid approximation for repulsion
+EXACT_MAX_NODES = 2000
+# largest first step and number of iterations of a warm start, layouts span [-1, 1]
+WARM_TEMPERATURE = 0.01
+WARM_ITERATIONS = 20
+# layouts kept in a cache folder, the least recently used ones are removed beyond this
+CACHE_MAX_FILES = 256
+
+
+def _repulsion_exact(xy, k, block_size=512):
+    """ Repulsive displacement between all pairs of nodes, block_size rows at a time """
+    disp = np.zeros_like(xy)
+    for start in range(0, len(xy), block_size):
+        delta = xy[start:start + block_size, None, :] - xy[None, :, :]
+        # same 0.01 minimum distance as networkx
+        distance2 = np.maximum((delta ** 2).sum(axis=-1), 1e-4)
+        disp[start:start + block_size] = np.einsum('ijk,ij->ik', delta, k * k / distance2)
+    return disp
+
+
+def _repulsion_grid(xy, k, cells, block_size=1024):
+    """
+    Repulsive displacement against the centre of mass of every cell of a cells x cells grid
+
+    The own cell of a node is used without the node itself.
+    """
+    low = xy.min(axis=0)
+    size = np.maximum(xy.max(axis=0) - low, 1e-9)
+    ij = np.minimum(((xy - low) / size * cells).astype(int), cells - 1)
+    cell = ij[:, 0] * cells + ij[:, 1]
+
+    ncells = cells * cells
+    mass = np.bincount(cell, minlength=ncells).astype(float)
+    total = np.column_stack([np.bincount(cell, weights=xy[:, d], minlength=ncells) for d in range(2)])
+    occupied = np.flatnonzero(mass)
+    centre = total[occupied] / mass[occupied, None]
+    mass = mass[occupied]
+    # position of each node's own cell in the occupied list
+    own = np.searchsorted(occupied, cell)
+
+    disp = np.zeros_like(xy)
+    for start in range(0, len(xy), block_size):
+        stop = min(start + block_size, len(xy))
+        rows = np.arange(stop - start)
+        m = np.broadcast_to(mass, (stop - start, len(mass))).copy()
+        c = np.broadcast_to(centre, (stop - start,) + centre.shape).copy()
+        # take the node out of its own cell
+        o = own[start:stop]
+        m[rows, o] -= 1
+        with np.errstate(invalid='ignore', divide='ignore'):
+            c[rows, o] = np.where(m[rows, o, None] > 0,
+                                  (total[occupied][o] - xy[start:stop]) / m[rows, o, None], 0)
+
+        delta = xy[start:stop, None, :] - c
+        distance2 = np.maximum((delta ** 2).sum(axis=-1), 1e-4)
+        disp[start:stop] = np.einsum('ijk,ij->ik', delta, m * k * k / distance2)
+    return disp
+
+
+def force_layout(G, pos=None, iterations=50, weight='weight', seed=None, temperature=None, cells=None):
+    """
+    Fruchterman-Reingold positions of the nodes of G, scaled to [-1, 1]
+
+    Pos gives starting positions, nodes without one start at the mean position of
+    their placed neighbours (or at random). Temperature is the largest first step,
+    by default a tenth of the layout size like nx.spring_layout. Cells sets the grid
+    used for repulsion, by default exact repulsion up to EXACT_MAX_NODES nodes.
+    Returns a dict node -> array([x, y]) in the node order of G.
+    """
+    nodes = list(G)
+    n = len(nodes)
+    if n == 0:
+        return {}
+    if n == 1:
+        return {nodes[0]: np.zeros(2)}
+
+    A = nx.to_scipy_sparse_array(G, nodelist=nodes, weight=weight, format='coo')
+    rows, cols, w = A.row, A.col, A.data
+
+    rng = np.random.default_rng(seed)
+    xy = rng.random((n, 2))
+    if pos:
+        placed = np.array([node in pos for node in nodes])
+        if placed.any():
+            xy[placed] = [pos[node] for node, p in zip(nodes, placed) if p]
+            xy[~placed] = _place_new(xy, placed, rows, cols, rng)
+
+    k = 1 / np.sqrt(n)
+    if temperature is None:
+        temperature = 0.1 * np.ptp(xy, axis=0).max()
+    t = temperature
+    dt = t / (iterations + 1)
+    if cells is None and n > EXACT_MAX_NODES:
+        # about 4 * sqrt(n) cells keeps the work per iteration near n ** 1.5
+        cells = int(2 * n ** 0.25)
+
+    for _ in range(iterations):
+        disp = _repulsion_grid(xy, k, cells) if cells else _repulsion_exact(xy, k)
+        # attraction along every edge (the adjacency holds both directions)
+        delta = xy[rows] - xy[cols]
+        distance = np.maximum(np.hypot(delta[:, 0], delta[:, 1]), 0.01)
+        pull = delta * (w * distance / k)[:, None]
+        for d in range(2):
+            disp[:, d] -= np.bincount(rows, weights=pull[:, d], minlength=n)
+
+        length = np.maximum(np.hypot(disp[:, 0], disp[:, 1]), 0.01)
+        xy += disp * (t / length)[:, None]
+        t -= dt
+
+    # same scaling as nx.spring_layout: centred, largest coordinate 1
+    xy -= xy.mean(axis=0)
+    lim = np.abs(xy).max()
+    if lim > 0:
+        xy /= lim
+    return dict(zip(nodes, xy))
+
+
+def _place_new(xy, placed, rows, cols, rng):
+    """ Starting positions of unplaced nodes: mean of their placed neighbours, random otherwise """
+    n = len(xy)
+    known = placed[cols]
+    count = np.bincount(rows[known], minlength=n)
+    mean = np.column_stack([np.bincount(rows[known], weights=xy[cols[known], d], minlength=n) for d in range(2)])
+    new = ~placed
+    low, high = xy[placed].min(axis=0), xy[placed].max(axis=0)
+    start = low + rng.random((new.sum(), 2)) * (high - low)
+    has_neighbour = count[new] > 0
+    start[has_neighbour] = mean[new][has_neighbour] / count[new][has_neighbour, None]
+    # a little noise so nodes with the same neighbours don't sit on top of each other
+    start += rng.normal(scale=0.01 * max((high - low).max(), 1e-3), size=start.shape)
+    return start
+
+
+def graph_fingerprint(G, weight='weight'):
+    """
+    Hash of the node and edge set of G (with weights), independent of insertion order
+    """
+    digest = hashlib.sha1()
+    digest.update('\n'.join(sorted(map(str, G))).encode())
+    edges = sorted('\t'.join(sorted((str(u), str(v)))) + '\t' + repr(d.get(weight, 1))
+                   for u, v, d in G.edges(data=True))
+    digest.update('\n'.join(edges).encode())
+    return digest.hexdigest()
+
+
+def _cache_key(G, initial, seed, kwargs):
+    """ Fingerprint of the graph, the starting positions, the seed and the force_layout settings """
+    digest = hashlib.sha1(graph_fingerprint(G, kwargs.get('weight', 'weight')).encode())
+    if initial:
+        digest.update('\n'.join(sorted(f"{node}\t{np.round(xy, 6).tolist()}" for node, xy in initial.items())).encode())
+    digest.update(repr((seed, sorted(kwargs.items()))).encode())
+    return digest.hexdigest()
+
+
+def _read_cache(path):
+    """ Positions saved at path by string node, None when there is no (complete) file """
+    try:
+        with np.load(path) as cached:
+            return dict(zip(cached['nodes'], cached['xy']))
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        # missing, or a file we can't read: compute the layout again
+        return None
+
+
+def _write_cache(path, pos):
+    """ Save positions to path, through a temporary file so readers never see a partial one """
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+    fd, temporary = tempfile.mkstemp(dir=folder, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, nodes=np.array([str(node) for node in pos]), xy=np.array(list(pos.values())).reshape(-1, 2))
+        os.replace(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+
+def _evict_cache(folder, max_files):
+    """ Remove the least recently used layouts of folder beyond max_files, by modification time """
+    files = []
+    for entry in os.scandir(folder):
+        if entry.name.endswith('.npz'):
+            try:
+                files.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                pass
+    for _, path in sorted(files, reverse=True)[max_files:]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # removed by another worker at the same time
+            pass
+
+
+@traced('layout', rows=len)
+def layout(G, initial=None, cache_dir=None, seed=13, **kwargs):
+    """
+    Positions of the nodes of G, cached on disk when cache_dir is given
+
+    Initial are earlier positions (e.g. of the previous period) to warm-start from:
+    shared nodes start where they were and the layout only moves them a little.
+    Other keyword arguments go to force_layout.
+
+    The cache key covers the graph, initial, seed and the force_layout arguments, so
+    a layout is only reused for the same inputs. A cache file is written to a temporary
+    file and renamed, so threads and worker processes writing the same key at once
+    don't corrupt it, and a file that can't be read counts as a miss. A hit touches the
+    file, and the folder keeps the CACHE_MAX_FILES most recently used layouts.
+    """
+    if initial:
+        kwargs.setdefault('temperature', WARM_TEMPERATURE)
+        kwargs.setdefault('iterations', WARM_ITERATIONS)
+
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, _cache_key(G, initial, seed, kwargs) + '.npz')
+        positions = _read_cache(path)
+        if positions is not None and all(str(node) in positions for node in G):
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            return {node: positions[str(node)] for node in G}
+
+    pos = force_layout(G, pos=initial, seed=seed, **kwargs)
+
+    if path is not None:
+        _write_cache(path, pos)
+        _evict_cache(cache_dir, CACHE_MAX_FILES)
+    return pos
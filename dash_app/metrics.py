@@ -0,0 +1,295 @@
+"""
+Module for network metrics on the sparse adjacency matrix
+
+networkx walks the graph node by node in Python, which limits its centralities
+to sampled graphs. Here the metrics are computed with sparse matrix products
+on the adjacency matrix of the investor-issuer or co-holding graph:
+
+- eigenvector and PageRank centrality by power iteration,
+- approximate betweenness from a sample of sources: breadth-first search from
+  a batch of sources at once (one sparse product per level) and Brandes'
+  dependency accumulation on the way back,
+- communities by label propagation, each node taking the label with the
+  largest edge weight among its neighbours, scored by modularity.
+
+The products are split in blocks of rows and run in threads with workers > 1
+(scipy releases the GIL in its sparse kernels). Every metric returns its scores
+as a Series indexed by node, and a dict reporting its convergence.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import networkx as nx
+from scipy import sparse
+
+
+def adjacency(edges, source='source', target='target', weight=None):
+    """
+    Symmetric sparse adjacency matrix of an edge list and its nodes
+
+    Nodes are numbered in order of appearance, like bipartite.degree_centrality. Without
+    weight every edge counts 1; a repeated pair keeps its last weight.
+    """
+    endpoints = np.column_stack([edges[source].to_numpy(dtype=object), edges[target].to_numpy(dtype=object)])
+    codes, nodes = pd.factorize(endpoints.ravel())
+    codes = codes.reshape(-1, 2)
+    data = np.ones(len(codes)) if weight is None else edges[weight].to_numpy(dtype=float)
+
+    # last weight of every pair (either direction), no self loops in the graphs built here
+    pair = np.sort(codes, axis=1)
+    keep = ~pd.DataFrame(pair).duplicated(keep='last').to_numpy()
+    row, col, data = pair[keep, 0], pair[keep, 1], data[keep]
+    n = len(nodes)
+    A = sparse.csr_matrix((np.r_[data, data], (np.r_[row, col], np.r_[col, row])), shape=(n, n))
+    return A, pd.Index(nodes)
+
+
+def graph_adjacency(G, weight='weight'):
+    """ Sparse adjacency matrix of a networkx graph and its nodes """
+    nodes = list(G)
+    return nx.to_scipy_sparse_array(G, nodelist=nodes, weight=weight, format='csr'), pd.Index(nodes)
+
+
+class _product:
+    """ A @ x with the rows of A split in blocks, each multiplied in a thread of a pool """
+    def __init__(self, A, workers=1):
+        self.A = sparse.csr_matrix(A)
+        self.workers = workers
+        self.pool = None
+        if workers > 1:
+            edges = np.linspace(0, self.A.shape[0], workers + 1).astype(int)
+            self.blocks = [self.A[start:stop] for start, stop in zip(edges[:-1], edges[1:])]
+            self.pool = ThreadPoolExecutor(workers)
+
+    def __call__(self, x):
+        if self.pool is None:
+            return self.A @ x
+        parts = list(self.pool.map(lambda block: block @ x, self.blocks))
+        return sparse.vstack(parts, format='csr') if sparse.issparse(parts[0]) else np.concatenate(parts)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
+def _convergence(iterations, error, tol):
+    return {'iterations': iterations, 'error': float(error), 'converged': bool(error < tol)}
+
+
+def eigenvector_centrality(A, nodes=None, start=None, tol=1e-6, max_iter=100, workers=1):
+    """
+    Eigenvector centrality by power iteration, like nx.eigenvector_centrality
+
+    Iterates x = x + A x (the shift keeps bipartite graphs from oscillating) from start
+    (e.g. the result of the previous period) or a constant vector, until the L1 change of
+    the normalized vector is below tol (networkx stops at n * tol, which gets loose on
+    large graphs). Returns the Series and the convergence report.
+    """
+    n = A.shape[0]
+    x = np.ones(n) if start is None else np.array(start, dtype=float)
+    if not x.any():
+        x[:] = 1
+    x /= np.abs(x).sum()
+    error = np.inf
+    iteration = 0
+    with _product(A, workers) as product:
+        for iteration in range(1, max_iter + 1):
+            last = x
+            x = last + product(last)
+            x /= max(np.linalg.norm(x), 1e-300)
+            error = np.abs(x - last).sum()
+            if error < tol:
+                break
+    return pd.Series(x, index=nodes, name='eigenvector'), _convergence(iteration, error, tol)
+
+
+def pagerank(A, nodes=None, alpha=0.85, start=None, tol=1e-6, max_iter=100, workers=1):
+    """
+    PageRank by power iteration, like nx.pagerank
+
+    Nodes without edges spread their rank evenly over all nodes. Stops when the L1 change
+    is below tol (networkx uses n * tol). Returns the Series and the convergence report.
+    """
+    n = A.shape[0]
+    strength = np.asarray(A.sum(axis=1)).ravel()
+    dangling = strength == 0
+    # column-stochastic transition matrix, transposed so a row product gives the incoming rank
+    P = sparse.csr_matrix(A.T @ sparse.diags(np.divide(1, strength, out=np.zeros(n), where=~dangling)))
+    x = np.full(n, 1 / n) if start is None else np.array(start, dtype=float) / np.sum(start)
+    error = np.inf
+    iteration = 0
+    with _product(P, workers) as product:
+        for iteration in range(1, max_iter + 1):
+            last = x
+            x = alpha * (product(last) + last[dangling].sum() / n) + (1 - alpha) / n
+            error = np.abs(x - last).sum()
+            if error < tol:
+                break
+    return pd.Series(x, index=nodes, name='pagerank'), _convergence(iteration, error, tol)
+
+
+def _dependencies(A, sources):
+    """
+    Brandes' dependencies of every node on shortest paths (in hops) from each source of a batch
+
+    Returns an n x len(sources) array.
+    """
+    n = A.shape[0]
+    b = len(sources)
+    columns = np.arange(b)
+    sigma = np.zeros((n, b))
+    sigma[sources, columns] = 1
+    depth = np.full((n, b), -1, dtype=np.int32)
+    depth[sources, columns] = 0
+    frontier = sigma.copy()
+    level = 0
+    # breadth first: number of shortest paths to every node, level by level
+    while frontier.any():
+        paths = A @ frontier
+        new = (paths > 0) & (depth < 0)
+        level += 1
+        depth[new] = level
+        sigma[new] = paths[new]
+        frontier = np.where(new, paths, 0)
+
+    # dependencies from the deepest level back to the sources
+    delta = np.zeros((n, b))
+    for d in range(level, 0, -1):
+        at = depth == d
+        share = np.where(at, (1 + delta) / np.where(at, sigma, 1), 0)
+        delta += np.where(depth == d - 1, sigma * (A @ share), 0)
+    delta[sources, columns] = 0
+    return delta
+
+
+def betweenness_centrality(A, nodes=None, samples=None, batch_size=64, seed=13, tol=0.05, workers=1):
+    """
+    Approximate betweenness centrality from samples sources, like nx.betweenness_centrality(G, k=samples)
+
+    Shortest paths count hops (edge weights are ignored). With samples=None every node is a
+    source and the result is exact. Sources are processed in batches, in threads with
+    workers > 1. The convergence report has the relative standard error of the estimate
+    over the batches (0 when exact), converged when it is below tol.
+    """
+    n = A.shape[0]
+    A = sparse.csr_matrix(A, dtype=float, copy=True)
+    A.data[:] = 1
+    rng = np.random.default_rng(seed)
+    sources = np.arange(n) if samples is None or samples >= n else rng.choice(n, samples, replace=False)
+    batches = [sources[start:start + batch_size] for start in range(0, len(sources), batch_size)]
+
+    def batch(part):
+        return _dependencies(A, part).sum(axis=1)
+
+    if workers > 1:
+        with ThreadPoolExecutor(workers) as pool:
+            sums = list(pool.map(batch, batches))
+    else:
+        sums = [batch(part) for part in batches]
+    sums = np.array(sums).reshape(len(batches), n)
+
+    # undirected pairs, normalized like networkx and scaled up from the sampled sources
+    scale = 1 / ((n - 1) * (n - 2)) if n > 2 else 1
+    scores = sums.sum(axis=0) * scale * n / max(len(sources), 1)
+
+    error = 0.0
+    if len(sources) < n and len(batches) > 1:
+        sizes = np.array([len(part) for part in batches])
+        means = sums / sizes[:, None]
+        stderr = means.std(axis=0, ddof=1) / np.sqrt(len(batches)) * scale * n
+        error = np.linalg.norm(stderr) / max(np.linalg.norm(scores), 1e-300)
+    report = {'samples': len(sources), 'error': float(error), 'converged': bool(len(sources) >= n or error < tol)}
+    return pd.Series(scores, index=nodes, name='betweenness'), report
+
+
+def modularity(A, labels):
+    """ Modularity of a partition (integer label per node) of the weighted graph A """
+    strength = np.asarray(A.sum(axis=1)).ravel()
+    total = strength.sum()
+    if total == 0:
+        return 0.0
+    coo = A.tocoo()
+    inside = coo.data[labels[coo.row] == labels[coo.col]].sum()
+    community_strength = np.bincount(labels, weights=strength)
+    return float(inside / total - ((community_strength / total) ** 2).sum())
+
+
+def label_propagation(A, nodes=None, max_iter=100, seed=13, workers=1):
+    """
+    Communities by label propagation
+
+    Every node starts with its own label and takes the label with the largest total edge
+    weight among its neighbours (its own label wins ties, other ties are drawn at random).
+    Half of the nodes, drawn at random, move per iteration, so two sides of a bipartite
+    graph don't swap labels back and forth. Stops when no label changes. Returns the community number of every
+    node (numbered from 0 by size) and the convergence report with the modularity.
+    """
+    n = A.shape[0]
+    A = sparse.csr_matrix(A, dtype=float)
+    rng = np.random.default_rng(seed)
+    labels = np.arange(n)
+    # own label counts a little, so a node only moves for a strictly better label
+    scale = max(np.abs(A.data).max(initial=0), 1)
+    own = sparse.diags(np.full(n, 1e-9 * scale))
+    iteration = 0
+    changed = n
+    with _product(A + own, workers) as product:
+        for iteration in range(1, max_iter + 1):
+            one_hot = sparse.csr_matrix((np.ones(n), (np.arange(n), labels)), shape=(n, n))
+            weights = sparse.csr_matrix(product(one_hot))
+            # equal labels are drawn at random, below the preference for the own label
+            weights.data += 1e-12 * scale * rng.random(n)[weights.indices]
+            best = _row_argmax(weights, labels)
+            wants = best != labels
+            changed = int(wants.sum())
+            if changed == 0:
+                break
+            labels = np.where(wants & (rng.random(n) < 0.5), best, labels)
+
+    # number communities from the largest
+    _, labels, sizes = np.unique(labels, return_inverse=True, return_counts=True)
+    rank = np.empty(len(sizes), dtype=np.int64)
+    rank[np.argsort(-sizes, kind='stable')] = np.arange(len(sizes))
+    labels = rank[labels]
+    report = {'iterations': iteration, 'changed': changed, 'converged': changed == 0,
+              'communities': len(sizes), 'modularity': modularity(A, labels)}
+    return pd.Series(labels, index=nodes, name='community'), report
+
+
+def rankings(A, nodes=None, samples=1000, workers=1):
+    """
+    Degree, PageRank, eigenvector and approximate betweenness centrality and the community of every node
+
+    Returns a DataFrame indexed by node and the convergence report of every metric.
+    """
+    n = A.shape[0]
+    degree = pd.Series(np.diff(sparse.csr_matrix(A).indptr) / max(n - 1, 1), index=nodes, name='degree')
+    frame = [degree]
+    reports = {}
+    for name, metric, kwargs in (('pagerank', pagerank, {}),
+                                 ('eigenvector', eigenvector_centrality, {}),
+                                 ('betweenness', betweenness_centrality, {'samples': samples}),
+                                 ('community', label_propagation, {})):
+        scores, reports[name] = metric(A, nodes, workers=workers, **kwargs)
+        frame.append(scores)
+    return pd.concat(frame, axis=1), reports
+
+
+def _row_argmax(M, default):
+    """ Column of the largest entry of every row of a csr matrix (the first one on ties), default for empty rows """
+    result = default.copy()
+    lengths = np.diff(M.indptr)
+    filled = np.flatnonzero(lengths)
+    if len(filled) == 0:
+        return result
+    largest = np.maximum.reduceat(M.data, M.indptr[filled])
+    winners = np.flatnonzero(M.data == np.repeat(largest, lengths[filled]))
+    row = np.repeat(np.arange(M.shape[0]), lengths)[winners]
+    first = np.r_[True, row[1:] != row[:-1]]
+    result[row[first]] = M.indices[winners[first]]
+    return result
@@ -1,100 +1,200 @@
-import networkx as nx
-import pandas as pd
+"""
+Module for the temporal investor network figure
+
+The figure only needs, per year, the trimmed graph (node names and edges as
+pairs of node positions), the node positions and the node degrees. build_payload
+computes them from the edge csv and writes them as .npy files, which the app
+memory-maps when it draws the figure: gunicorn workers share the pages and
+nothing has to be computed at startup. The payload of the sampled edges is
+committed in data/temporal, so it is part of the deployed app; rebuild it from
+the dash_app folder with python plotly_network_temporal.py whenever the edge csv
+changes. Without a payload the app computes it from the csv, and logs a warning.
+
+Traces are built with numpy: the edges index the position array to give the
+NaN-separated line coordinates in one step. With webgl=True the traces are
+drawn with Scattergl, which keeps graphs with many thousands of edges (e.g. a
+payload built with min_degree=0) responsive in the browser.
+
+The app sends one year at a time: serve_year returns the trace data of a year
+from a server-side cache (optionally with rounded coordinates) and prepares the
+neighbouring years in the background, so what the browser downloads per slider
+move does not grow with the number of years.
+"""
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import numpy as np
 import plotly.graph_objects as go
+from scipy import sparse
 
+from instrument import traced
 
-def make_temporal_plot():
+# edge csv the figure is built from
+TEMPORAL_EDGES = 'data/temporal_edges_sampled.csv'
+# per-year payloads written by build_payload
+PAYLOAD_DIR = 'data/temporal'
+# positions of the yearly graphs are cached here between builds
+LAYOUT_DIR = 'data/layouts'
+# nodes with fewer connections are trimmed from the yearly graphs
+MIN_DEGREE = 20
+# arrays stored for every year
+PAYLOAD_ARRAYS = ['nodes', 'xy', 'edges', 'degree']
+# years of trace data kept by serve_year
+YEAR_CACHE_SIZE = 16
+# coordinates sent by serve_year are rounded to this many decimals, None to send them as they are
+COORDINATE_DECIMALS = 3
+# prepares the neighbouring years of the one being served
+PREFETCH = ThreadPoolExecutor(max_workers=1)
+
+logger = logging.getLogger(__name__)
+
+
+@traced('temporal payload', rows=len)
+def compute_payload(path=TEMPORAL_EDGES, years=None, min_degree=MIN_DEGREE, cache_dir=LAYOUT_DIR):
     """
-    Make the network and slider
+    Trimmed graph, positions and degrees of every year of an edge csv
+
+    Path is a csv of investor-investor edges with source, target and year columns, e.g. the
+    full edge set written by coholding.temporal_coholding_edges. Returns a dict year -> dict
+    with the node names, their xy positions, the edges as pairs of node numbers and the degrees.
+    The positions are cached in cache_dir, None computes them without a cache.
     """
-    edges = pd.read_csv('data/temporal_edges_sampled.csv')
-    edge_traces = []
-    node_traces = []
-    years = ['2017', '2018', '2019', '2020']
+    # only needed to build the payload, the app starts without them
+    import networkx as nx
+    import pandas as pd
+    from layout import layout
+
+    columns = ['source', 'target', 'year', 'weight']
+    edges = pd.read_csv(path, usecols=lambda col: col in columns)
+    years = sorted(edges['year'].unique()) if years is None else years
+
+    payload = {}
+    pos = None
     for year in years:
         filtered_edges = edges[edges['year'] == int(year)]
         G = nx.from_pandas_edgelist(filtered_edges, edge_attr=True)
-        # Trim the graph
-        remove = [node for node,degree in dict(G.degree()).items() if degree < 20]
-        G.remove_nodes_from(remove)
-        pos = nx.spring_layout(G)
-        edge_x = []
-        edge_y = []
-        for edge in G.edges():
-            x0 = pos[edge[0]][0]
-            y0 = pos[edge[0]][1]
-            x1 = pos[edge[1]][0]
-            y1 = pos[edge[1]][1]
-            #x0, y0 = G.nodes[edge[0]]['pos']
-            #x1, y1 = G.nodes[edge[1]]['pos']
-            edge_x.append(x0)
-            edge_x.append(x1)
-            edge_x.append(None)
-            edge_y.append(y0)
-            edge_y.append(y1)
-            edge_y.append(None)
-
-        edge_trace = go.Scatter(
-            visible=False,
-            name="year",
-            x=edge_x, y=edge_y,
-            line=dict(width=0.5, color='#888'),
-            hoverinfo='none',
-            mode='lines')
-
-        node_x = []
-        node_y = []
-        for p in pos:
-            x = pos[p][0]
-            y = pos[p][1]
-            #x, y = G.nodes[node]['pos']
-            node_x.append(x)
-            node_y.append(y)
-
-        node_trace = go.Scatter(
-            visible=False,
-            name="year",
-            x=node_x, y=node_y,
-            mode='text+markers',
-            hoverinfo='text',
-            text = [n for n in G.nodes()],
-            marker=dict(
-                showscale=True,
-                # colorscale options
-                #'Greys' | 'YlGnBu' | 'Greens' | 'YlOrRd' | 'Bluered' | 'RdBu' |
-                #'Reds' | 'Blues' | 'Picnic' | 'Rainbow' | 'Portland' | 'Jet' |
-                #'Hot' | 'Blackbody' | 'Earth' | 'Electric' | 'Viridis' |
-                colorscale='YlGnBu',
-                reversescale=True,
-                color=[],
-                size=10,
-                colorbar=dict(
-                    thickness=15,
-                    title='Node Connections',
-                    xanchor='left',
-                    titleside='right'
-                ),
-                line_width=2))
-
-
-        # add color
-        node_adjacencies = []
-        node_text = []
-        for node, adjacencies in enumerate(G.adjacency()):
-            node_adjacencies.append(len(adjacencies[1]))
-            node_text.append('# of connections: '+str(len(adjacencies[1])))
-
-        node_trace.marker.color = node_adjacencies
+        # Trim the graph, degrees are the row lengths of the sparse adjacency
+        nodes = list(G)
+        A = nx.to_scipy_sparse_array(G, nodelist=nodes, weight=None, format='csr')
+        G.remove_nodes_from([nodes[i] for i in np.flatnonzero(np.diff(A.indptr) < min_degree)])
+        # start from last year's positions so nodes stay put when moving the slider
+        pos = layout(G, initial=pos, cache_dir=cache_dir)
+
+        nodes = list(G)
+        A = nx.to_scipy_sparse_array(G, nodelist=nodes, weight=None, format='csr')
+        upper = sparse.triu(A, format='coo')
+        payload[int(year)] = {
+            'nodes': np.array([str(node) for node in nodes]),
+            'xy': np.array([pos[node] for node in nodes], dtype=np.float32).reshape(-1, 2),
+            'edges': np.column_stack([upper.row, upper.col]).astype(np.int32),
+            'degree': np.diff(A.indptr).astype(np.int32)}
+    return payload
+
+
+def build_payload(path=TEMPORAL_EDGES, payload_dir=PAYLOAD_DIR, years=None, min_degree=MIN_DEGREE,
+                  cache_dir=LAYOUT_DIR):
+    """
+    Compute the payload of every year and store it in payload_dir (build step)
+    """
+    payload = compute_payload(path, years, min_degree, cache_dir)
+    os.makedirs(payload_dir, exist_ok=True)
+    for year, arrays in payload.items():
+        for name in PAYLOAD_ARRAYS:
+            np.save(os.path.join(payload_dir, f'{year}_{name}.npy'), arrays[name])
+    # written last, so a half-written payload is never picked up
+    np.save(os.path.join(payload_dir, 'years.npy'), np.array(sorted(payload), dtype=np.int32))
+    return payload
+
+
+def load_payload(payload_dir=PAYLOAD_DIR):
+    """
+    Memory-mapped payload of every year written by build_payload, None if there is none
+    """
+    if not os.path.exists(os.path.join(payload_dir, 'years.npy')):
+        return None
+    years = np.load(os.path.join(payload_dir, 'years.npy'))
+    return {int(year): {name: np.load(os.path.join(payload_dir, f'{year}_{name}.npy'), mmap_mode='r')
+                        for name in PAYLOAD_ARRAYS}
+            for year in years}
+
+
+def edge_coordinates(xy, edges):
+    """
+    x and y of the line trace of the edges: both endpoints of every edge followed by a NaN gap
+    """
+    xy = np.asarray(xy)
+    edges = np.asarray(edges).reshape(-1, 2)
+    lines = np.full((len(edges), 3, 2), np.nan, dtype=xy.dtype)
+    lines[:, :2] = xy[edges]
+    return lines[:, :, 0].ravel(), lines[:, :, 1].ravel()
+
+
+def year_traces(arrays, decimals=None):
+    """
+    Trace data of one year of the payload
+
+    Returns a dict with the x and y of the edge lines and of the nodes, the node names,
+    degrees and hover texts. With decimals the coordinates are rounded, which shortens
+    the json sent to the browser (the layout spans about [-1, 1]).
+    """
+    nodes, xy, edges, degree = (arrays[name] for name in PAYLOAD_ARRAYS)
+    xy = np.asarray(xy)
+    if decimals is not None:
+        xy = xy.astype(float).round(decimals)
+    edge_x, edge_y = edge_coordinates(xy, edges)
+    degree = np.asarray(degree)
+    return {'edge_x': edge_x, 'edge_y': edge_y, 'node_x': xy[:, 0], 'node_y': xy[:, 1],
+            'text': np.asarray(nodes), 'degree': degree,
+            'hovertext': np.char.add('# of connections: ', degree.astype(str))}
+
+
+def _traces(traces, scatter=go.Scatter, visible=True):
+    """ Edge and node trace of the trace data of one year """
+    edge_trace = scatter(
+        visible=visible,
+        name="year",
+        x=traces['edge_x'], y=traces['edge_y'],
+        line=dict(width=0.5, color='#888'),
+        hoverinfo='none',
+        mode='lines')
+
+    node_trace = scatter(
+        visible=visible,
+        name="year",
+        x=traces['node_x'], y=traces['node_y'],
+        mode='text+markers',
+        hoverinfo='text',
+        text = traces['text'].tolist(),
+        marker=dict(
+            showscale=True,
+            # colorscale options
+            #'Greys' | 'YlGnBu' | 'Greens' | 'YlOrRd' | 'Bluered' | 'RdBu' |
+            #'Reds' | 'Blues' | 'Picnic' | 'Rainbow' | 'Portland' | 'Jet' |
+            #'Hot' | 'Blackbody' | 'Earth' | 'Electric' | 'Viridis' |
+            colorscale='YlGnBu',
+            reversescale=True,
+            # add color
+            color=traces['degree'],
+            size=10,
+            colorbar=dict(
+                thickness=15,
+                title='Node Connections',
+                xanchor='left',
+                titleside='right'
+            ),
+            line_width=2),
         # Can add number of connections when scroll over nodes
-        node_trace.hovertext = node_text
+        hovertext=traces['hovertext'])
+    return edge_trace, node_trace
 
-        #fig.add_trace(edge_trace)
-        #fig.add_trace(node_trace)
-        edge_traces.append(edge_trace)
-        node_traces.append(node_trace)
 
-    fig = go.Figure(data=edge_traces + node_traces, layout=go.Layout(
-                title='Temporal 13F-HR Investment Network',
+def _figure(data, title):
+    """ Figure with the common layout of the temporal network """
+    return go.Figure(data=data, layout=go.Layout(
+                title=title,
                 width=1000,
                 height=750,
                 titlefont_size=16,
@@ -104,10 +204,90 @@ def make_temporal_plot():
                 xaxis=dict(showgrid=False, zeroline=False, showticklabels=False),
                 yaxis=dict(showgrid=False, zeroline=False, showticklabels=False)))
 
-    # Make 2015 trace visible
-    fig.data[0].visible = True
-    fig.data[6].visible = True
+
+def year_title(year):
+    """ Title of the figure showing year """
+    return "Temporal 13F-HR Investment Network: " + str(year)
+
+
+def make_year_plot(traces, year, webgl=False):
+    """
+    Network of a single year (trace data from year_traces), the figure the app updates per year
+    """
+    return _figure(_traces(traces, go.Scattergl if webgl else go.Scatter), year_title(year))
+
+
+@lru_cache(maxsize=1)
+def temporal_payload():
+    """
+    Payload served by the app: the prebuilt one, computed from the edge csv if there is none
+    """
+    payload = load_payload()
+    if payload is None:
+        logger.warning("No temporal payload in %s, computing it from %s (build it with "
+                       "python plotly_network_temporal.py)", PAYLOAD_DIR, TEMPORAL_EDGES)
+        return compute_payload()
+    return payload
+
+
+def temporal_years():
+    """ Years of the served payload """
+    return list(temporal_payload())
+
+
+@lru_cache(maxsize=YEAR_CACHE_SIZE)
+@traced('year traces', rows=lambda traces: len(traces['node_x']))
+def cached_year_traces(year, decimals=COORDINATE_DECIMALS):
+    """ year_traces of a year of the served payload, cached """
+    return year_traces(temporal_payload()[year], decimals)
+
+
+def serve_year(year, decimals=COORDINATE_DECIMALS, prefetch=True):
+    """
+    Trace data of year from the server cache
+
+    With prefetch the years before and after it are prepared in the background.
+    """
+    traces = cached_year_traces(year, decimals)
+    if prefetch:
+        years = temporal_years()
+        i = years.index(year)
+        for neighbour in years[max(i - 1, 0):i + 2]:
+            if neighbour != year:
+                PREFETCH.submit(cached_year_traces, neighbour, decimals)
+    return traces
+
+
+def make_temporal_plot(path=TEMPORAL_EDGES, payload_dir=PAYLOAD_DIR, webgl=False, decimals=None, payload=None):
+    """
+    Make the network and slider
+
+    All years are in the figure and the slider switches their visibility, so the browser
+    receives every year at once (the app sends one year at a time, see make_year_plot).
+    Draws payload when it is given (e.g. from compute_payload), otherwise the payload in
+    payload_dir when it has been built, otherwise it is computed from path.
+    With webgl the traces are drawn with Scattergl (for large graphs).
+    """
+    if payload is None:
+        payload = load_payload(payload_dir)
+    if payload is None:
+        payload = compute_payload(path)
+    scatter = go.Scattergl if webgl else go.Scatter
+
+    edge_traces = []
+    node_traces = []
+    years = [str(year) for year in payload]
+    for year in payload:
+        edge_trace, node_trace = _traces(year_traces(payload[year], decimals), scatter, visible=False)
+        edge_traces.append(edge_trace)
+        node_traces.append(node_trace)
+
+    fig = _figure(edge_traces + node_traces, 'Temporal 13F-HR Investment Network')
+
+    # Make the first year visible
     num_steps = int(len(fig.data) / 2)
+    fig.data[0].visible = True
+    fig.data[num_steps].visible = True
     # Create and add slider
     steps = []
     for i in range(num_steps):
@@ -134,3 +314,10 @@ def make_temporal_plot():
 
 
     return fig
+
+
+if __name__ == "__main__":
+    # build step: python plotly_network_temporal.py [edge csv]
+    # the layouts are computed fresh, so the payload doesn't depend on the local cache
+    import sys
+    build_payload(*sys.argv[1:2], cache_dir=None)
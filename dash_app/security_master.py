@@ -0,0 +1,167 @@
+"""
+Module for the security master: the canonical name of every CUSIP and issuer
+
+A filer writes the issuer name the way it likes ('APPLE INC', 'APPLE INC COM',
+typos...), so the first filed name seen for a security is a poor label. The
+master counts how often every (CUSIP, filed name) pair was filed and takes
+the most frequent name as the canonical one; the name of an issuer (first 6
+characters of the CUSIP) is the most frequent name of its securities with the
+class of shares ' (CL A)' left out.
+
+The counts are kept, so the master can be updated chunk by chunk while
+xml_parser ingests the filings, and is saved next to the holdings (see
+security_master_path). Lookups go through a hashed pandas Index, one bulk
+reindex for any number of codes.
+
+Build the master of holdings parsed before it existed with
+python security_master.py data/filingsEnd2019.csv
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+# a class of shares appended to the filed name by the parser, e.g. 'ALPHABET INC (CAP STK CL A)'
+SHARE_CLASS = r'\s*\([^()]*\)$'
+
+
+def security_master_path(holdings_path):
+    """
+    Where the master of a holdings csv file or parquet dataset folder is stored
+
+    In a dataset folder the name starts with '_', so the parquet reader skips it.
+    """
+    if os.path.isdir(holdings_path):
+        return os.path.join(holdings_path, '_securities.csv')
+    return os.path.splitext(holdings_path)[0] + '.securities.csv'
+
+
+def _most_frequent(keys, names, counts):
+    """ Most frequent name of every key (ties go to the first name in sorted order), as a Series """
+    frame = pd.DataFrame({'key': keys, 'name': names, 'count': counts})
+    frame = frame.groupby(['key', 'name'], sort=True)['count'].sum().reset_index()
+    best = frame.sort_values('count', ascending=False, kind='stable').drop_duplicates('key')
+    return pd.Series(best['name'].to_numpy(), index=pd.Index(best['key'].to_numpy())).sort_index()
+
+
+class security_master:
+    """
+    Canonical names of the CUSIPs and issuers of the holdings
+
+    Counts is a DataFrame with the columns cusip, name and count (the number of times a
+    name was filed for that CUSIP), or None for an empty master.
+    """
+    def __init__(self, counts=None):
+        if counts is None:
+            counts = pd.DataFrame({'cusip': pd.Series(dtype=object), 'name': pd.Series(dtype=object),
+                                   'count': pd.Series(dtype=np.int64)})
+        self._counts = counts[['cusip', 'name', 'count']]
+        # counts of the updates since the last merge, merged when they are needed
+        self._pending = []
+        self._names = None
+
+    def __len__(self):
+        return len(self._canonical()[0])
+
+    def __repr__(self):
+        return f"security master of {len(self)} securities"
+
+    def update(self, df, cusip='cusip', name='filed name'):
+        """
+        Add the filed names of a holdings table (or a chunk of one)
+        """
+        df = df.dropna(subset=[cusip, name])
+        new = df.groupby([df[cusip].astype(str), df[name].astype(str)], observed=True).size()
+        self._pending.append(new.rename('count').rename_axis(['cusip', 'name']).reset_index())
+        self._names = None
+        return self
+
+    @property
+    def counts(self):
+        """ Number of times every (cusip, name) pair was filed """
+        if self._pending:
+            counts = pd.concat([self._counts] + self._pending, ignore_index=True)
+            self._counts = counts.groupby(['cusip', 'name'], sort=True)['count'].sum().reset_index()
+            self._pending = []
+        return self._counts
+
+    def _canonical(self):
+        """ Canonical name of every CUSIP and of every issuer, as two Series indexed by the codes """
+        if self._names is None:
+            cusip = self.counts['cusip'].to_numpy(dtype=object)
+            name = self.counts['name'].to_numpy(dtype=object)
+            count = self.counts['count'].to_numpy()
+            securities = _most_frequent(cusip, name, count)
+            base = pd.Series(name).str.replace(SHARE_CLASS, '', regex=True).to_numpy(dtype=object)
+            issuers = _most_frequent(pd.Series(cusip).str[:6].to_numpy(dtype=object), base, count)
+            self._names = securities, issuers
+        return self._names
+
+    def cusip_names(self, cusips, default=None):
+        """ Canonical name of every CUSIP, default (or the CUSIP itself if None) when it is unknown """
+        return self._lookup(self._canonical()[0], cusips, default)
+
+    def issuer_names(self, issuers, default=None):
+        """ Canonical name of every issuer, default (or the issuer itself if None) when it is unknown """
+        return self._lookup(self._canonical()[1], issuers, default)
+
+    def labels(self, issuers, words=3):
+        """
+        Plot label of every issuer: the first words of its canonical name, the code when it is unknown
+
+        Returns a dict code -> label, e.g. for nx.draw_networkx_labels.
+        """
+        names = self.issuer_names(issuers)
+        return dict(zip(issuers, names.str.split(' ').str[:words].str.join(' ')))
+
+    @staticmethod
+    def _lookup(names, codes, default):
+        codes = pd.Index(codes)
+        found = names.reindex(codes.astype(str))
+        fallback = codes.astype(str) if default is None else default
+        return pd.Series(np.where(found.isna(), fallback, found), index=codes, dtype=object)
+
+    def save(self, path):
+        """ Write the name counts to a csv file """
+        self.counts.to_csv(path, index=False)
+
+
+def read_security_master(path):
+    """ security_master saved at path, None if there is none """
+    if not os.path.exists(path):
+        return None
+    return security_master(pd.read_csv(path, dtype={'cusip': str, 'name': str}, keep_default_na=False))
+
+
+def build_security_master(holdings_path, chunksize=200000):
+    """
+    security_master of a holdings csv file or parquet dataset folder, read chunk by chunk
+    """
+    master = security_master()
+    if os.path.isdir(holdings_path):
+        import pyarrow.dataset as ds
+
+        dataset = ds.dataset(holdings_path, format='parquet', partitioning='hive')
+        for batch in dataset.to_batches(columns=['cusip', 'filed name'], batch_size=chunksize):
+            master.update(batch.to_pandas())
+        return master
+    for chunk in pd.read_csv(holdings_path, usecols=['cusip', 'filed name'], dtype={'cusip': str},
+                             chunksize=chunksize):
+        master.update(chunk)
+    return master
+
+
+def load_security_master(holdings_path):
+    """
+    security_master of a holdings csv file or dataset folder: the saved one, built from the holdings otherwise
+    """
+    master = read_security_master(security_master_path(holdings_path))
+    return master if master is not None else build_security_master(holdings_path)
+
+
+if __name__ == "__main__":
+    # build step: python security_master.py data/filingsEnd2017.csv data/filingsEnd2018.csv ...
+    import sys
+    for holdings_path in sys.argv[1:]:
+        build_security_master(holdings_path).save(security_master_path(holdings_path))
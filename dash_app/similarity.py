@@ -0,0 +1,211 @@
+"""
+Module to find similar investors approximately, without the n x n correlation matrix
+
+Every investor is sketched with weighted MinHash: each hash draws an exponential
+variable per issuer and picks the issuer with the smallest draw / weight, so an
+issuer is picked with probability proportional to its share of the portfolio.
+Two investors pick the same issuer about as often as their largest positions
+overlap, which is also what drives their Pearson correlation.
+
+The sketches are split into bands of a few hashes. Investors that agree on all
+hashes of a band land in the same bucket, and only investors sharing a bucket in
+some band are compared (locality sensitive hashing). Candidates are scored exactly
+from the sparse rows (optionally only the best ones by fraction of equal hashes),
+so the returned correlations are exact but some pairs can be missed.
+
+recall() measures how many of the exact top-k pairs (feature_map.top_correlations)
+an approximate answer finds.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from feature_map import feature_map, _row_stats
+
+# pairs are scored in chunks of about this many hashes, or Gram blocks of about this many entries
+CHUNK_ENTRIES = 10000000
+
+
+def sketch(X, hashes=128, seed=13):
+    """
+    Weighted MinHash of every row of the sparse non-negative matrix X
+
+    Returns an int array of shape (rows, hashes) with the picked column of every hash,
+    -1 for rows without positive entries.
+    """
+    X = sparse.csr_matrix(X, dtype=float, copy=True)
+    X.eliminate_zeros()
+    n, m = X.shape
+    lengths = np.diff(X.indptr)
+    filled = np.flatnonzero(lengths)
+    row = np.repeat(np.arange(n), lengths)
+
+    rng = np.random.default_rng(seed)
+    picks = np.full((n, hashes), -1, dtype=np.int64)
+    for h in range(hashes):
+        race = rng.exponential(size=m)[X.indices] / X.data
+        smallest = np.minimum.reduceat(race, X.indptr[filled])
+        winners = np.flatnonzero(race == np.repeat(smallest, lengths[filled]))
+        # a tie is practically impossible, keep the first winner of every row anyway
+        rows, first = np.unique(row[winners], return_index=True)
+        picks[rows, h] = X.indices[winners[first]]
+    return picks
+
+
+def _ranges(starts, lengths):
+    """ Concatenation of arange(start, start + length) for every start and length """
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+
+
+def _bucket_pairs(keys, max_bucket):
+    """ Every pair of rows (source < target) with the same key, buckets above max_bucket are skipped """
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    sizes = np.diff(np.r_[starts, len(keys)])
+    keep = (sizes > 1) & (sizes <= max_bucket)
+    starts, sizes = starts[keep], sizes[keep]
+
+    members = _ranges(starts, sizes)
+    bucket = np.repeat(np.arange(len(sizes)), sizes)
+    source = np.repeat(members, sizes[bucket])
+    target = _ranges(starts[bucket], sizes[bucket])
+    pairs = source < target
+    return order[source[pairs]], order[target[pairs]]
+
+
+def _top_per_source(source, target, score, k):
+    """ The k highest scores of every source, sorted by source and descending score """
+    order = np.lexsort((-score, source))
+    source, target, score = source[order], target[order], score[order]
+    first = np.flatnonzero(np.r_[True, source[1:] != source[:-1]]) if len(source) else np.empty(0, dtype=int)
+    rank = np.arange(len(source)) - np.repeat(first, np.diff(np.r_[first, len(source)]))
+    keep = rank < k
+    return source[keep], target[keep], score[keep]
+
+
+class lsh_index:
+    """
+    Locality sensitive hashing index over the weighted MinHash sketches of the rows of X
+
+    There are bands * rows hashes. More bands find more of the similar pairs, more rows
+    per band make buckets smaller and faster to compare. Buckets with more than
+    max_bucket rows say little about similarity and are skipped.
+    """
+    def __init__(self, X, bands=64, rows=2, max_bucket=1000, seed=13):
+        self.X = sparse.csr_matrix(X, dtype=float)
+        self.mean, self.norm = _row_stats(self.X)
+        self.max_bucket = max_bucket
+        self.picks = sketch(self.X, bands * rows, seed)
+
+        n = self.X.shape[0]
+        # rows without variance have no correlation with anything, they get a bucket of their own
+        alone = self.norm == 0
+        self.keys = np.empty((bands, n), dtype=np.uint64)
+        for band in range(bands):
+            key = np.zeros(n, dtype=np.uint64)
+            for pick in self.picks[:, band * rows:(band + 1) * rows].T:
+                # a collision of two different bands only adds a candidate, the score is exact
+                key = key * np.uint64(1000003) ^ pick.astype(np.uint64)
+            key[alone] = np.iinfo(np.uint64).max - np.flatnonzero(alone).astype(np.uint64)
+            self.keys[band] = key
+
+    def candidates(self):
+        """ Unique ordered pairs (source, target) that share a bucket in at least one band """
+        n = self.X.shape[0]
+        codes = [np.empty(0, dtype=np.int64)]
+        for key in self.keys:
+            source, target = _bucket_pairs(key, self.max_bucket)
+            codes.append(source * n + target)
+        codes = np.unique(np.concatenate(codes))
+        source, target = codes // n, codes % n
+        return np.r_[source, target], np.r_[target, source]
+
+    def neighbours(self, row):
+        """ Candidates of a single row: the rows that share a bucket with it in some band """
+        found = (self.keys == self.keys[:, [row]]).any(axis=0)
+        found[row] = False
+        if self.norm[row] == 0:
+            found[:] = False
+        return np.flatnonzero(found)
+
+    def _chunk_size(self, entries_per_row):
+        """ Number of pairs scored at a time, so a chunk holds about CHUNK_ENTRIES entries """
+        return max(1, int(CHUNK_ENTRIES // (2 * max(entries_per_row, 1))))
+
+    def estimate(self, source, target, chunk_size=None):
+        """ Fraction of equal hashes of the given pairs of rows """
+        chunk_size = chunk_size or self._chunk_size(self.picks.shape[1])
+        score = np.empty(len(source))
+        for start in range(0, len(source), chunk_size):
+            part = slice(start, start + chunk_size)
+            score[part] = (self.picks[source[part]] == self.picks[target[part]]).mean(axis=1)
+        return score
+
+    def exact(self, source, target, block_size=None):
+        """
+        Exact correlation of the given pairs of rows
+
+        The pairs are grouped by source, and every block of sources is multiplied with the
+        rows of its targets in one sparse Gram product, instead of taking rows pair by pair.
+        """
+        m = self.X.shape[1]
+        dots = np.empty(len(source))
+        order = np.argsort(source, kind='stable')
+        sources = np.unique(source)
+        # blocks of sources, so a Gram block of all their targets stays about CHUNK_ENTRIES
+        block_size = block_size or max(1, CHUNK_ENTRIES // max(self.X.shape[0], 1))
+        bounds = np.searchsorted(source[order], sources[::block_size])
+        for start, stop in zip(bounds, np.r_[bounds[1:], len(order)]):
+            pairs = order[start:stop]
+            rows, row_at = np.unique(source[pairs], return_inverse=True)
+            cols, col_at = np.unique(target[pairs], return_inverse=True)
+            gram = (self.X[rows] @ self.X[cols].T).toarray()
+            dots[pairs] = gram[row_at, col_at]
+        corr = (dots - m * self.mean[source] * self.mean[target]) / (self.norm[source] * self.norm[target])
+        return np.clip(corr, -1, 1)
+
+    def top_k(self, k, rerank=None):
+        """
+        The k most similar other rows of every row, as arrays (source, target, correlation)
+
+        All candidates are scored exactly, with rerank only the rerank * k best candidates
+        of every row by estimate (which helps when buckets are large).
+        """
+        source, target = self.candidates()
+        if rerank:
+            source, target, _ = _top_per_source(source, target, self.estimate(source, target), rerank * k)
+        return _top_per_source(source, target, self.exact(source, target), k)
+
+    def query(self, row, k):
+        """ The k most similar other rows of one row, as arrays (target, correlation) """
+        target = self.neighbours(row)
+        score = self.exact(np.full(len(target), row), target)
+        best = np.argsort(-score, kind='stable')[:k]
+        return target[best], score[best]
+
+
+def approximate_top_correlations(df, k, index='cik', columns='issuer', values='norm_value',
+                                 bands=64, rows=2, max_bucket=1000, rerank=None, seed=13):
+    """
+    The k most correlated other investors of every investor, found through an lsh_index
+
+    Same output as feature_map.top_correlations (source, target, correlation), but only
+    candidate pairs are compared, so some pairs can be missed (see recall).
+    """
+    X, labels, _ = feature_map(df, index, columns, values)
+    source, target, score = lsh_index(X, bands, rows, max_bucket, seed).top_k(k, rerank)
+    return pd.DataFrame({'source': labels[source], 'target': labels[target], 'correlation': score})
+
+
+def recall(exact, approximate):
+    """
+    Fraction of the (source, target) pairs of exact that approximate also found
+    """
+    if len(exact) == 0:
+        return 1.0
+    found = pd.MultiIndex.from_frame(exact[['source', 'target']]).isin(
+        pd.MultiIndex.from_frame(approximate[['source', 'target']]))
+    return found.mean()
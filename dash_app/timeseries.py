@@ -0,0 +1,109 @@
+"""
+Module for the holdings as a time series of quarters
+
+quarter_store keeps the positions of every report quarter as integer-coded
+arrays: investors and securities are numbered once over all quarters, and
+the positions are sorted by quarter, so a quarter is a slice and its sparse
+investor x security matrix is built without touching the others. The quarter
+of a position comes from its report date in one vectorized step (or from the
+year/quarter partitions of a parquet dataset).
+
+changes() lists the positions that are new, exited or resized between two
+quarters; coholding.incremental_coholding moves the co-holding network from
+one quarter to the next with these differences instead of rebuilding it.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from holdings import read_holdings
+
+
+def report_quarters(df):
+    """
+    Report quarter of every row as a pandas Period, from report_date or the year/quarter columns
+    """
+    if 'report_date' in df:
+        return pd.PeriodIndex(pd.to_datetime(df['report_date'].astype(str)), freq='Q')
+    return pd.PeriodIndex.from_fields(year=df['year'].to_numpy(), quarter=df['quarter'].to_numpy(), freq='Q')
+
+
+class quarter_store:
+    """
+    Positions (node, security, value) of every report quarter of a holdings table
+
+    Node is the investor column and on the security column. Rows of the same node and
+    security in a quarter are summed, rows without a node or security are dropped.
+    """
+    def __init__(self, df, node='owner', on='cusip', values='value'):
+        df = df.dropna(subset=[node, on])
+        quarters = report_quarters(df)
+        period_codes, self.quarters = pd.factorize(quarters, sort=True)
+        node_codes, self.nodes = pd.factorize(df[node], sort=True)
+        security_codes, self.securities = pd.factorize(df[on], sort=True)
+        self.node, self.on = node, on
+
+        positions = pd.DataFrame({'quarter': period_codes, 'node': node_codes, 'security': security_codes,
+                                  'value': df[values].to_numpy(dtype=float)})
+        positions = positions.groupby(['quarter', 'node', 'security'], sort=True)['value'].sum().reset_index()
+        self.quarter = positions['quarter'].to_numpy(dtype=np.int32)
+        self.node_code = positions['node'].to_numpy(dtype=np.int32)
+        self.security_code = positions['security'].to_numpy(dtype=np.int32)
+        self.value = positions['value'].to_numpy()
+        # positions of quarter i are rows offsets[i]:offsets[i + 1]
+        self.offsets = np.searchsorted(self.quarter, np.arange(len(self.quarters) + 1))
+
+    @property
+    def shape(self):
+        """ Number of nodes and of securities over all quarters """
+        return len(self.nodes), len(self.securities)
+
+    def _index(self, quarter):
+        """ Position of a quarter (Period, 'YYYYQn' string or position) in self.quarters """
+        if isinstance(quarter, (int, np.integer)):
+            return int(quarter)
+        return self.quarters.get_loc(pd.Period(quarter, freq='Q'))
+
+    def positions_of(self, quarter):
+        """ Arrays (node, security, value) of the positions of a quarter """
+        i = self._index(quarter)
+        part = slice(self.offsets[i], self.offsets[i + 1])
+        return self.node_code[part], self.security_code[part], self.value[part]
+
+    def matrix(self, quarter, values=True):
+        """
+        Sparse node x security matrix of a quarter, with the values or (values=False) ones
+        """
+        node, security, value = self.positions_of(quarter)
+        data = value if values else np.ones(len(node))
+        return sparse.csr_matrix((data, (node, security)), shape=self.shape)
+
+    def changes(self, before, after):
+        """
+        Positions that differ between two quarters
+
+        Returns node, security, value_before, value_after and status ('new', 'exited' or
+        'resized'); positions with the same value in both quarters are left out.
+        """
+        old = self.matrix(before)
+        new = self.matrix(after)
+        # +1 for new positions, -1 for exited ones (a zero value is still a position)
+        held = self.matrix(after, values=False) - self.matrix(before, values=False)
+        delta = (abs(new - old) + abs(held)).tocoo()
+        node, security = delta.row, delta.col
+        value_before = np.asarray(old[node, security]).ravel()
+        value_after = np.asarray(new[node, security]).ravel()
+        held = np.asarray(held[node, security]).ravel()
+        status = np.where(held > 0, 'new', np.where(held < 0, 'exited', 'resized'))
+        changes = pd.DataFrame({self.node: self.nodes[node], self.on: self.securities[security],
+                                'value_before': value_before, 'value_after': value_after, 'status': status})
+        return changes.sort_values([self.node, self.on], ignore_index=True)
+
+
+def load_quarters(path, node='owner', on='cusip', values='value', year=None):
+    """
+    quarter_store of a holdings csv file or parquet dataset (see holdings.read_holdings)
+    """
+    columns = list(dict.fromkeys([node, on, values, 'report_date']))
+    return quarter_store(read_holdings(path, columns, year=year, compact=True), node, on, values)
@@ -0,0 +1,254 @@
+"""
+Concurrent downloader for filings from the SEC EDGAR database
+
+Filings of many CIK's are fetched by a pool of threads that share one token
+bucket, so all together they stay under the SEC limit of 10 requests per second.
+Every thread keeps its own keep-alive session. Failed requests are retried with
+exponential backoff and jitter, and the outcome for every CIK is appended to a
+record file so a refresh can skip what was already downloaded.
+
+Filings are saved the same way sec_edgar_downloader does it:
+{folder}/sec-edgar-filings/{cik}/{form}/{accession number}/full-submission.txt
+which is what xml_parser walks.
+"""
+
+import html
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# downloads are timed with the pipeline stages (dash_app/instrument.py)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dash_app'))
+from instrument import span
+
+SUBMISSIONS_URL = 'https://data.sec.gov/submissions/'
+ARCHIVES_URL = 'https://www.sec.gov/Archives/edgar/data/'
+# daily list of filings, q1 is the number of days back
+CURRENT_URL = 'https://www.sec.gov/cgi-bin/current'
+# SEC fair access policy: at most 10 requests per second, and a user agent with a contact
+SEC_RATE = 10
+USER_AGENT = os.environ.get('SEC_USER_AGENT', 'financial-network-analysis admin@example.com')
+# responses worth trying again, anything else is a permanent failure
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+# a row of the cgi-bin/current list once the links are stripped: date, form, cik, name
+CURRENT_ROW = re.compile(r'^\s*(\d{2})-(\d{2})-(\d{4})\s+(\S+)\s+(\d+)\s+(.*\S)\s*$')
+TAG = re.compile(r'<[^>]*>')
+
+
+def parse_current_page(page):
+    """
+    Filings listed on a cgi-bin/current page (the html as text)
+
+    Returns the day of the filings as YYYY-MM-DD (None when the page lists nothing)
+    and a list of (form, cik, name) with the CIK padded to 10 digits.
+    """
+    lower = page.lower()
+    start = lower.find('<pre')
+    end = lower.find('</pre>', start)
+    if start < 0:
+        return None, []
+    text = html.unescape(TAG.sub('', page[start:end if end >= 0 else len(page)]))
+
+    day = None
+    filings = []
+    for line in text.splitlines():
+        match = CURRENT_ROW.match(line)
+        if match is None:
+            continue
+        month, date, year, form, cik, name = match.groups()
+        day = f"{year}-{month}-{date}"
+        filings.append((form, cik.zfill(10), ' '.join(name.split())))
+    return day, filings
+
+
+class rate_limiter:
+    """
+    Token bucket shared between threads: rate requests per second, at most burst at once
+    """
+    def __init__(self, rate=SEC_RATE, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Blocks until a request may be sent """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class fetch_record:
+    """
+    Append-only json lines file with the outcome of every fetched CIK
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(filepath):
+            with open(filepath) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.entries[self.key(entry['cik'], entry['form'], entry['after'], entry['before'])] = entry
+
+    @staticmethod
+    def key(cik, form, after, before):
+        return (str(cik), form, after, before)
+
+    def done(self, cik, form, after, before):
+        """ True if this CIK was already downloaded successfully for the same form and dates """
+        entry = self.entries.get(self.key(cik, form, after, before))
+        return entry is not None and entry['status'] == 'success'
+
+    def add(self, cik, form, after, before, status, filings=0, error=None):
+        entry = {'cik': str(cik), 'form': form, 'after': after, 'before': before, 'status': status,
+                 'filings': filings, 'error': error, 'time': datetime.now().isoformat(timespec='seconds')}
+        with self.lock:
+            self.entries[self.key(cik, form, after, before)] = entry
+            with open(self.filepath, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+
+class edgar_client:
+    """
+    Downloads filings of many CIK's in parallel under one rate limit
+
+    The urls can be pointed to a local stub server for testing, see benchmarks/check_edgar_client.py.
+    """
+    def __init__(self, folder, user_agent=USER_AGENT, workers=8, limiter=None, retries=5, backoff=0.5,
+                 submissions_url=SUBMISSIONS_URL, archives_url=ARCHIVES_URL):
+        self.folder = folder
+        self.user_agent = user_agent
+        self.workers = workers
+        self.limiter = limiter or rate_limiter()
+        self.retries = retries
+        self.backoff = backoff
+        self.submissions_url = submissions_url
+        self.archives_url = archives_url
+        self.local = threading.local()
+
+    def session(self):
+        """ Keep-alive session of the current thread """
+        if not hasattr(self.local, 'session'):
+            session = requests.Session()
+            session.headers.update({'User-Agent': self.user_agent, 'Accept-Encoding': 'gzip, deflate'})
+            session.mount('http://', HTTPAdapter(pool_maxsize=1))
+            session.mount('https://', HTTPAdapter(pool_maxsize=1))
+            self.local.session = session
+        return self.local.session
+
+    def get(self, url):
+        """
+        GET under the rate limit, retried with exponential backoff and jitter
+
+        Raises requests.HTTPError for permanent failures (e.g. 404) and once retries run out.
+        """
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            try:
+                response = self.session().get(url, timeout=30)
+                if response.status_code not in RETRY_STATUS:
+                    response.raise_for_status()
+                    return response
+                error = requests.HTTPError(f"{response.status_code} for url: {url}", response=response)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+
+            if attempt == self.retries:
+                raise error
+            # full jitter: anything between 0 and the exponential delay
+            time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    def filings(self, cik, form, after, before):
+        """ Accession numbers of the filings of a CIK with the given form, filed between after and before """
+        url = f"{self.submissions_url}CIK{str(cik).zfill(10)}.json"
+        submissions = self.get(url).json()
+
+        pages = [submissions['filings']['recent']]
+        # older filings are in extra pages, only fetch the ones overlapping the dates
+        for page in submissions['filings'].get('files', []):
+            if page['filingTo'] >= after and page['filingFrom'] <= before:
+                pages.append(self.get(self.submissions_url + page['name']).json())
+
+        accessions = []
+        for page in pages:
+            for accession, kind, date in zip(page['accessionNumber'], page['form'], page['filingDate']):
+                if kind == form and after <= date <= before:
+                    accessions.append(accession)
+        return accessions
+
+    def download(self, cik, form, after, before):
+        """ Saves the full submission of every matching filing of a CIK, returns how many there are """
+        accessions = self.filings(cik, form, after, before)
+        for accession in accessions:
+            folder = os.path.join(self.folder, 'sec-edgar-filings', str(cik), form, accession)
+            filepath = os.path.join(folder, 'full-submission.txt')
+            # already there from an earlier run
+            if os.path.exists(filepath):
+                continue
+
+            url = f"{self.archives_url}{int(cik)}/{accession.replace('-', '')}/{accession}.txt"
+            with span('download filing', cik=str(cik), accession=accession) as s:
+                content = self.get(url).content
+                s.set(bytes=len(content))
+            os.makedirs(folder, exist_ok=True)
+            # write next to the target first so an interrupted download never looks complete
+            with open(filepath + '.part', 'wb') as f:
+                f.write(content)
+            os.replace(filepath + '.part', filepath)
+        return len(accessions)
+
+    def fetch(self, codes, form, after, before, record=None):
+        """
+        Downloads the filings of all codes in parallel, returns the lists of succeeded and failed CIK's
+
+        After and before are dates as YYYY-MM-DD (both included). With record (a path) the outcome
+        of every CIK is stored, and CIK's that already succeeded for the same form and dates are skipped.
+        """
+        record = fetch_record(record) if record else None
+        todo = [code for code in codes if not (record and record.done(code, form, after, before))]
+        if record and len(todo) < len(codes):
+            print(f"Skipping {len(codes) - len(todo)} CIK's downloaded before")
+
+        def work(code):
+            try:
+                num = self.download(code, form, after, before)
+            except (requests.RequestException, ValueError, KeyError) as e:
+                print(f"Something went wrong with company {code}: {e}")
+                if record:
+                    record.add(code, form, after, before, 'failed', error=str(e))
+                return False
+            print(f"Downloaded {num} files from company {code}")
+            if record:
+                record.add(code, form, after, before, 'success', filings=num)
+            return True
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            results = list(pool.map(work, todo))
+
+        success = [code for code, ok in zip(todo, results) if ok]
+        fail = [code for code, ok in zip(todo, results) if not ok]
+        return success, fail
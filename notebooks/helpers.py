@@ -3,16 +3,34 @@ import pandas as pd
 import networkx as nx
 
 from bs4 import BeautifulSoup
-from sec_edgar_downloader import Downloader
-from requests_html import HTMLSession
-import time
-import operator
+from lxml import etree
+import requests
+from edgar_client import edgar_client, parse_current_page, USER_AGENT, CURRENT_URL
 import os
+import itertools
+import multiprocessing
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
+import mmap
 from datetime import datetime
 
 import matplotlib.pyplot as plt
-import matplotlib.cm as cm
 import seaborn as sns
+
+# the analysis modules shared with the Dash app live in dash_app, which has to stay
+# self-contained for the Heroku deployment
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dash_app'))
+from holdings import read_holdings, write_holdings, clear_holdings, normalize_positions
+from security_master import security_master, build_security_master, load_security_master, security_master_path
+from feature_map import correlation_frame
+from bipartite import bipartite_graph, bipartite_edges
+from metrics import adjacency, rankings
+from layout import layout
+from clustering import condensed_distance, linkage_matrix, flat_clusters, heatmap_figure
+from instrument import span, traced
     
 
 class Filing13F:
@@ -24,6 +42,9 @@ class Filing13F:
     
     # If True prints out results in console
     debug = False
+
+    # Parser backend used by parse_file, one of ['lxml', 'bs4']
+    engine = 'lxml'
     
     
     def __init__(self,filepath=''):
@@ -35,27 +56,65 @@ class Filing13F:
             self.parse_file(self.filepath)
             
 
-    def parse_file(self, filepath=''):
-        """ Parses relevant information from 13F-HR text file """
-        self.filepath = filepath # Path of file
-        
+    def parse_file(self, filepath='', engine=None):
+        """
+        Parses relevant information from 13F-HR text file
+
+        Filepath can be a path (the file is memory-mapped, not copied), the raw bytes
+        of the submission, or a file-like object.
+
+        Engine can be one of ['lxml', 'bs4']. 'lxml' streams the XML sections of the
+        submission and is much faster on large information tables, 'bs4' is the
+        original BeautifulSoup html.parser implementation. Both give the same DataFrame.
+        """
+        self.filepath = filepath if isinstance(filepath, (str, os.PathLike)) else '' # Path of file
+        engine = engine or self.engine
+
         if self.debug:
             print(self.filepath)
-            
-        # Opens document and passes to BeautifulSoup object.
-        doc = open(filepath)
-        soup = BeautifulSoup(doc, 'html.parser') # OBS! XML parser will not work with SEC txt format
-        
+
+        if engine not in ('lxml', 'bs4'):
+            raise ValueError(f"Unknown parser engine: {engine}")
+
+        with _open_submission(filepath) as doc:
+            if engine == 'lxml':
+                columns = self._parse_lxml(doc)
+            else:
+                columns = self._parse_bs4(doc)
+
+        # Store in dataframe
+        data = pd.DataFrame(columns)
+        data['owner'] = self.company
+        data['cik'] = self.CIK
+        data['report_date'] = self.period_of_report_date
+
+        # Drop rows with put/call option
+        indexes =  data[  data['put_or_call'] != 'No' ].index
+        data.drop(indexes, inplace=True)
+        # data.set_index('symbol', inplace=True)
+        #data.set_index('filed name', inplace=True)
+
+        self.data = data
+
+        return
+
+    def _parse_bs4(self, doc):
+        """ Parses the filing with BeautifulSoup, returns the stock list as columns """
+        # some xml files have a 'ns1:' prefix which is annoying, drop it before handing
+        # the document to a BeautifulSoup object.
+        text = doc.read().replace(b'ns1:', b'').decode()
+        soup = BeautifulSoup(text, 'html.parser') # OBS! XML parser will not work with SEC txt format
+
         # Print document structure and tags in console
         if self.debug:
             print(soup.prettify())
-            
+
             for tag in soup.find_all(True):
                 print(tag.name)
-        
+
         ## --- Parse content using tag strings from txt document: <tag> content </tag>
         # OBS html.parser uses tags in lowercase
-        
+
         # Name of filing company
         self.company = soup.find('filingmanager').find('name').string
         # Company identifier: Central Index Key
@@ -68,10 +127,10 @@ class Filing13F:
         self.period_of_report_date = datetime.strptime(soup.find('periodofreport').string, '%m-%d-%Y').date()
         # Filing date (up to 45 days after reporting date)
         self.filing_date = datetime.strptime(soup.find('signaturedate').string, '%m-%d-%Y').date()
-                
+
         ## --- Parse stock list: Each stock is marked with an infoTable parent tag
         stocklist = soup.find_all('infotable') # List of parent tag objects
-        
+
         # Initialize lists
         name = []     # Company name
         cusip = []    # CUSIP identifier
@@ -80,19 +139,19 @@ class Filing13F:
         #price_per_share = []  # Share price on reporting day != purchase price
         poc = []      # Put/Call options
         symbol = []   # Trading symbol
-        
+
         # Fill lists with each stock
         for s in stocklist:
             # Company name & Title of class (e.g. COM, Class A, etc)
             n = s.find("nameofissuer").string
             n = n.replace('.','') # Remove dots
-            
+
             c = s.find("titleofclass").string
             if c != "COM":
                 name.append(n+" ("+c+")")
             else:
                 name.append(n)
-                
+
             # CUSIP identifier
             cusip.append(s.find("cusip").string)
             # Total value of holdings
@@ -102,224 +161,600 @@ class Filing13F:
             ssh = int(s.find("shrsorprnamt").find("sshprnamt").string)
             amount.append(ssh)
             # Share price on reporting day (OBS! != purchase price)
-            #price_per_share.append(round(v*1000/ssh,2))    
-            
+            #price_per_share.append(round(v*1000/ssh,2))
+
             # Put/Call options
             put_or_call = s.find("putcall")
             if put_or_call:
                 poc.append(put_or_call.string)
             else:
                 poc.append('No')
-            
 
-        # Create dictionary        
-        #stock_dict = {"filed name":name,  "cusip":cusip, "value":value, "amount":amount,
-        #       "price_per_share":price_per_share, "put_or_call":poc}
-        
-        # Create dictionary        
-        stock_dict = {"filed name":name,  "cusip":cusip, "value":value, "amount":amount, "put_or_call":poc}
-        # Store in dataframe
-        data = pd.DataFrame(stock_dict)
-        data['owner'] = self.company
-        data['cik'] = self.CIK
-        data['report_date'] = self.period_of_report_date
-        
-        # Drop rows with put/call option
-        indexes =  data[  data['put_or_call'] != 'No' ].index
-        data.drop(indexes, inplace=True)
-        # data.set_index('symbol', inplace=True)
-        #data.set_index('filed name', inplace=True)
-        
-        self.data = data
-        
-        return
-    
+        return {"filed name":name,  "cusip":cusip, "value":value, "amount":amount, "put_or_call":poc}
+
+    def _parse_lxml(self, doc):
+        """
+        Streams the <XML> sections of the filing through an incremental lxml parser,
+        returns the stock list as columns
+
+        Every <infoTable> is read and cleared as soon as it is complete, so memory does
+        not grow with the size of the information table. Namespace prefixes (e.g. 'ns1:')
+        are dropped from the tag names while parsing.
+        """
+        # header values, first occurrence wins (same as soup.find)
+        header = {}
+        # tag path that identifies each header field
+        header_tags = {'name': 'filingmanager', 'cik': None, 'submissiontype': None,
+                       'form13ffilenumber': None, 'periodofreport': None, 'signaturedate': None}
+
+        name = []     # Company name
+        cusip = []    # CUSIP identifier
+        value = []    # Total value of holdings
+        amount = []   # Amount of stocks
+        poc = []      # Put/Call options
+
+        parser = None
+        for line in iter(doc.readline, b''):
+            stripped = line.strip()
+            # each <XML> ... </XML> block is a standalone xml document
+            if stripped == b'<XML>':
+                parser = etree.XMLPullParser(events=('end',), recover=True, huge_tree=True)
+                first = True
+                continue
+            if parser is None:
+                continue
+            if stripped == b'</XML>':
+                parser.close()
+                parser = None
+                continue
+
+            # the xml declaration has to be the very first thing the parser sees
+            parser.feed(line.lstrip() if first else line)
+            first = False
+
+            for _, elem in parser.read_events():
+                tag = _local_name(elem.tag)
+
+                if tag == 'infotable':
+                    row = {}
+                    for child in elem.iter(tag=etree.Element):
+                        row.setdefault(_local_name(child.tag), child.text)
+
+                    n = row['nameofissuer'].replace('.','') # Remove dots
+                    c = row['titleofclass']
+                    if c != "COM":
+                        name.append(n+" ("+c+")")
+                    else:
+                        name.append(n)
+                    cusip.append(row['cusip'])
+                    value.append(int(row['value']))
+                    amount.append(int(row['sshprnamt']))
+                    poc.append(row.get('putcall', 'No'))
+
+                    # free the finished row and everything parsed before it
+                    elem.clear()
+                    while elem.getprevious() is not None:
+                        del elem.getparent()[0]
+
+                elif tag in header_tags and tag not in header:
+                    parent = header_tags[tag]
+                    if parent is None or _local_name(elem.getparent().tag) == parent:
+                        header[tag] = elem.text
+
+        # Name of filing company
+        self.company = header.get('name')
+        # Company identifier: Central Index Key
+        self.CIK = header.get('cik')
+        # Form type: 13F-HR
+        self.formtype = header.get('submissiontype')
+        # 13F-HR file number
+        self.fileNumber = header.get('form13ffilenumber')
+        # Reporting date (e.g. 03-31-2020)
+        self.period_of_report_date = datetime.strptime(header['periodofreport'], '%m-%d-%Y').date()
+        # Filing date (up to 45 days after reporting date)
+        self.filing_date = datetime.strptime(header['signaturedate'], '%m-%d-%Y').date()
+
+        return {"filed name":name,  "cusip":cusip, "value":value, "amount":amount, "put_or_call":poc}
+
+
+@contextlib.contextmanager
+def _open_submission(source):
+    """
+    Binary file-like view of a submission for Filing13F.parse_file.
+
+    Paths are memory-mapped, bytes are wrapped in a buffer and file objects are used as they are
+    (text mode ones are read and encoded).
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        yield io.BytesIO(source)
+    elif isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            try:
+                view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty files can't be mapped
+                yield f
+                return
+            with view:
+                yield view
+    elif isinstance(source, io.TextIOBase):
+        yield io.BytesIO(source.read().encode())
+    else:
+        yield source
+
+
+def _local_name(tag):
+    """ Lowercase tag name without namespace, e.g. '{uri}infoTable' or 'ns1:infoTable' -> 'infotable' """
+    return tag.rsplit('}', 1)[-1].rsplit(':', 1)[-1].lower()
+
+
+# columns of the holdings table written by xml_parser, in order
+HOLDING_COLUMNS = ['filed name', 'cusip', 'value', 'amount', 'put_or_call', 'owner', 'cik', 'report_date']
+
+
+@traced('parse filing', rows=lambda result: len(result[1]['cusip']))
+def _parse_filing(job):
+    """
+    Parses one filing for xml_parser.parse, possibly inside a worker process.
+
+    Returns the filer header and the holdings as plain lists, which are much cheaper
+    to send back to the parent process than a pickled DataFrame.
+    """
+    filepath, engine = job
+
+    # create a Filing object and parse it, 'ns1:' prefixes are handled by the parser
+    filing = Filing13F()
+    filing.parse_file(filepath, engine=engine)
+
+    header = (filing.company, filing.CIK, filing.period_of_report_date)
+    columns = {col: filing.data[col].tolist() for col in HOLDING_COLUMNS[:5]}
+    return header, columns
+
+
 class xml_parser:
     def __init__(self, parsepath):
         self.path = parsepath
-        
-    def parse(self, num, savepath):
-        dfs = []
+
+    def find_filings(self, num):
+        """
+        Yields the path of every submission file below the parse path.
+
+        Folders are visited in sorted order so every run sees the filings in the same order.
+        Like before, the walk stops after the folder where the filing count reaches a multiple of num.
+        """
         count = 1
 
         # traverse everything starting from folder 'sec-edgar-filings'
         for pathnames, dirnames, filenames in os.walk(self.path):
+            dirnames.sort()
             # check if every file if it's a submission file
-            for file in filenames:
+            for file in sorted(filenames):
                 if file == 'full-submission.txt':
-
-                    filepath = pathnames + os.sep + file
-
-                    # some xml files have a 'ns1:' prefix which is annoying, replace it
-                    with open(filepath) as f:
-                        newText=f.read().replace('ns1:', '')
-
-                    with open(filepath+'new', "w") as f:
-                        f.write(newText)
-
-                    # create a Filing object, parse it, and add data to dataframe
-                    filing = Filing13F()
-                    filing.parse_file(filepath+'new')
-                    dfs.append(filing.data)
-
+                    yield pathnames + os.sep + file
                     count += 1
-                    if count % 50 == 0:
-                        print(f"Already parsed {count} filings!")
             if count % num == 0:
                 break
-        
-        df = pd.concat(dfs, ignore_index=True)
-        df.to_csv(savepath)
 
-
-class sec_loader:
-    def __init__(self, foldname):
-        self.name = foldname
-        
-    def fetch(self, codes, date1, date2):
-        """
-        Codes: CIK codes to fetch data for
-        Date1: Start date (after) format YYYY-MM-DD
-        Date2: End date (bafore) format YYYY-MM-DD
+    def parse(self, num, savepath, workers=1, chunksize=200, engine=None, manifest=None, format='csv'):
         """
+        Parses the filings below the parse path and writes all holdings to savepath.
 
-        loader = Downloader(self.name)
+        Workers is the number of processes parsing filings in parallel, 1 parses in this process.
+        The filings are handed out in chunks of chunksize and every finished chunk is appended
+        to savepath in walk order, so the output does not depend on how the work was scheduled
+        and only one chunk of holdings is kept in memory.
 
-        # this is more or less useless, we may want to know which companies we downloaded filings for
-        success = []
+        Engine is passed on to Filing13F.parse_file.
 
-        # this is needed afterwards, we will iterate over CIK's we failed to download data because
-        # the downloaded sometimes fails to download anything for no clear reason
-        fail = []
+        Manifest is an optional path to an ingest_manifest file. With a manifest, filings that
+        were already written to savepath and have not changed since are skipped and new rows are
+        appended to the existing savepath, so re-running after new filings were downloaded,
+        or after an interrupted run, only parses what is missing.
 
-        # run over our codes and...
-        for code in codes:
+        Format can be 'csv' or 'parquet'. With 'parquet' savepath is a folder that receives a
+        dataset partitioned by report year and quarter (see holdings.write_holdings), which
+        can be read back column- and period-wise with holdings.read_holdings.
 
-            print(f"Trying CIK Number: {code}")
+        The canonical name of every CUSIP and issuer is collected on the way and saved next to
+        savepath (see security_master.py).
+        """
+        if format not in ('csv', 'parquet'):
+            raise ValueError(f"Unknown output format: {format}")
+        if format == 'parquet' and manifest is not None:
+            raise ValueError("A manifest can only be used with csv output")
+
+        filings = self.find_filings(num)
+        rows = 0
+        written = False
+
+        log = None
+        master = security_master()
+        if manifest is not None:
+            log = ingest_manifest(manifest, self.path)
+            if log.entries and os.path.exists(savepath):
+                filings = log.prepare(savepath, filings)
+                rows = log.next_row
+                written = True
+                # from the rows kept by prepare, an interrupted run may not have saved its master
+                master = build_security_master(savepath)
+                print(f"{len(filings)} new or changed filings to parse")
+            else:
+                log.reset()
 
-            # try downloading for a CIK
-            try:
-                # get 13F-HR filings for the period between 'before' and 'after'
-                # since this is 3 months (a quarter) we should only get 1 filing
-                num = loader.get('13F-HR', code, after=date1, before=date2)
-                print(f"Downloaded {num} files from company {code} \n")
-                success.append(code)
-            except:
-                # we couldn't download anything, add CIK to list for us to try again later
-                print(f"Something went wrong with company {code} \n")
-                fail.append(code)
+        jobs = ((filepath, engine) for filepath in filings)
+        # lists of up to chunksize jobs until the walk is exhausted
+        chunks = iter(lambda: list(itertools.islice(jobs, chunksize)), [])
+        pool = multiprocessing.Pool(workers) if workers > 1 else None
 
-            # sleep so we don't have problems with the SEC
-            time.sleep(0.11)
+        if format == 'parquet':
+            clear_holdings(savepath)
 
+        count = 1
+        try:
+            for chunk_number, chunk in enumerate(chunks):
+                # stat before parsing, a filing that changes meanwhile is picked up next run
+                stats = [log.stat(filepath) for filepath, _ in chunk] if log else None
+                results = pool.map(_parse_filing, chunk) if pool else map(_parse_filing, chunk)
+
+                dfs = []
+                for (company, cik, report_date), columns in results:
+                    data = pd.DataFrame(columns)
+                    data['owner'] = company
+                    data['cik'] = cik
+                    data['report_date'] = report_date
+                    dfs.append(data)
 
-        # by now we have run once over all CIK's and have downloaded filings for some
-        # we will try again for all CIK's we couldn't get a filing, until we get one
+                    count += 1
+                    if count % 50 == 0:
+                        print(f"Already parsed {count} filings!")
 
-        # we need a counter to not get stuck in an infinite loop, some CIK's might not
-        # have filing info or other issues may apply
-        count = 0
+                df = pd.concat(dfs, ignore_index=True)
+                master.update(df)
+                with span('write holdings', rows=len(df), format=format):
+                    if format == 'parquet':
+                        write_holdings(df, savepath, f'part-{chunk_number:05d}')
+                        continue
+
+                    df.index += rows
+                    # the first chunk creates the file, the others are appended without header
+                    df.to_csv(savepath, mode='a' if written else 'w', header=not written)
+                    written = True
+
+                if log:
+                    sizes = [len(data) for data in dfs]
+                    starts = rows + np.cumsum([0] + sizes[:-1])
+                    log.record([(filepath, stat, int(start), size)
+                                for (filepath, _), stat, start, size in zip(chunk, stats, starts, sizes)],
+                               os.path.getsize(savepath), rows + len(df))
+                rows += len(df)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        if not written and format == 'csv':
+            pd.DataFrame(columns=HOLDING_COLUMNS).to_csv(savepath)
+        if format == 'parquet':
+            os.makedirs(savepath, exist_ok=True)
+        master.save(security_master_path(savepath))
+
+
+class ingest_manifest:
+    """
+    Append-only record of the filings already written to an xml_parser output file.
 
-        # while there are companies we don't have data for, scrape and scrape again
-        while len(fail) > 0:
+    Every filing line holds the filing path (relative to the parse path), its size and mtime when
+    it was parsed, and the index range of its rows in the output ('start', 'rows'). After the lines
+    of a chunk follows a line with the size of the output file and the next free row index once
+    that chunk was written. Filing lines without such a closing line belong to a chunk that was
+    interrupted and are ignored; the output is cut back to the last recorded size.
+    """
+    def __init__(self, filepath, parsepath):
+        self.filepath = filepath
+        self.parsepath = parsepath
+        self.entries = {}
+        self.csv_size = 0
+        self.next_row = 0
+
+        if os.path.exists(filepath):
+            pending = []
+            with open(filepath) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # half-written last line of an interrupted run
+                        break
+                    if 'csv_size' in entry:
+                        self.entries.update((e['path'], e) for e in pending)
+                        self.csv_size = entry['csv_size']
+                        self.next_row = entry['next_row']
+                        pending = []
+                    else:
+                        pending.append(entry)
+
+    def key(self, filepath):
+        """ Manifest key of a filing: its path relative to the parse path """
+        return os.path.relpath(filepath, self.parsepath).replace(os.sep, '/')
+
+    def stat(self, filepath):
+        st = os.stat(filepath)
+        return st.st_size, st.st_mtime_ns
+
+    def is_current(self, filepath):
+        """ True if the filing was written before and has not changed since """
+        entry = self.entries.get(self.key(filepath))
+        return entry is not None and (entry['size'], entry['mtime']) == self.stat(filepath)
+
+    def prepare(self, savepath, filings):
+        """
+        Brings savepath in line with the manifest and returns the filings that still need parsing.
 
-            print(f'Failed to get data for {len(fail)} companies.\nTrying again.\n')
+        Rows of a chunk that was written but never recorded are cut off, rows of filings that
+        changed since they were parsed are dropped from savepath.
+        """
+        if os.path.getsize(savepath) > self.csv_size:
+            with open(savepath, 'r+b') as f:
+                f.truncate(self.csv_size)
+
+        todo = [filepath for filepath in filings if not self.is_current(filepath)]
+        stale = [self.entries.pop(self.key(filepath)) for filepath in todo if self.key(filepath) in self.entries]
+
+        if stale:
+            # read everything as text so the rewritten rows stay exactly as they were
+            df = pd.read_csv(savepath, index_col=0, dtype=str, keep_default_na=False)
+            drop = np.concatenate([np.arange(e['start'], e['start'] + e['rows']) for e in stale])
+            df = df[~df.index.astype(int).isin(drop)]
+            df.to_csv(savepath)
+            self.csv_size = os.path.getsize(savepath)
+            self._write(list(self.entries.values()), 'w')
+
+        return todo
+
+    def record(self, filings, csv_size, next_row):
+        """ Records a written chunk: filings is a list of (filepath, (size, mtime), start, rows) """
+        entries = [{'path': self.key(filepath), 'size': size, 'mtime': mtime, 'start': start, 'rows': rows}
+                   for filepath, (size, mtime), start, rows in filings]
+        self.entries.update((e['path'], e) for e in entries)
+        self.csv_size = csv_size
+        self.next_row = next_row
+        self._write(entries, 'a')
+
+    def reset(self):
+        """ Forgets every filing, used when the output is written from scratch """
+        self.entries = {}
+        self.csv_size = 0
+        self.next_row = 0
+        open(self.filepath, 'w').close()
+
+    def _write(self, entries, mode):
+        lines = [json.dumps(e) for e in entries]
+        lines.append(json.dumps({'csv_size': self.csv_size, 'next_row': self.next_row}))
+        with open(self.filepath, mode) as f:
+            f.write('\n'.join(lines) + '\n')
 
-            # each time we loop over all the companies we failed to get data the previous time
-            # increment the counter
-            count += 1
 
-            # 50 is an arbitrary threshold, depending on our patience and how much we want
-            # to get all possible data, this is the total number of iterations we are willing to try
-            if count > 50:
-                break
+class sec_loader:
+    def __init__(self, foldname, user_agent=USER_AGENT):
+        self.name = foldname
+        # the SEC wants a user agent with a contact address
+        self.user_agent = user_agent
 
-            # for every company we failed to get data, try again
-            for code in fail:
-                print(f"Trying CIK Number: {code}")
+    def fetch(self, codes, date1, date2, workers=8, record=None):
+        """
+        Codes: CIK codes to fetch data for
+        Date1: Start date (after) format YYYY-MM-DD
+        Date2: End date (bafore) format YYYY-MM-DD
+        Workers: number of CIK's downloaded at the same time, all under the SEC limit of 10 requests/s
+        Record: json lines file with the outcome per CIK, CIK's that succeeded before are skipped
 
-                try:
-                    num = loader.get('13F-HR', code, after=date1, before=date2)
-                    print(f"Downloaded {num} files from company {code} \n")
-                    success.append(code)
-                    fail.remove(code)
-                except:
-                    print(f"Something went wrong with company {code} \n")
+        Every request that fails is retried with exponential backoff, so one pass is enough.
+        Returns the lists of CIK's we got filings for and CIK's we failed to get.
+        """
+        client = edgar_client(self.name, self.user_agent, workers=workers)
 
-                time.sleep(0.11)
-        
+        # get 13F-HR filings for the period between 'before' and 'after'
+        # since this is 3 months (a quarter) we should only get 1 filing per company
+        success, fail = client.fetch(codes, '13F-HR', date1, date2, record=record)
+        if fail:
+            print(f'Failed to get data for {len(fail)} companies.\n')
+        return success, fail
 
 
-class cik_loader:
-    def __init__(self):
-        pass
-    
-    def fetch(self, days, filepath):
-        codes = []
-        session = HTMLSession()
-        url = 'https://www.sec.gov/cgi-bin/current?'
+# printed days of the pages cik_loader fetched before, in page order
+PAGE_INDEX = 'pages.json'
 
-        for page in range(days):
 
-            params = f"q1={page}&q2=0&q3=13F-HR"
-            r = session.get(url + params)
-            time.sleep(0.11)
+class cik_loader:
+    def __init__(self, cache='cik_pages', user_agent=USER_AGENT, workers=4):
+        # folder with the raw daily pages, one file per day
+        self.cache = cache
+        self.user_agent = user_agent
+        self.workers = workers
+
+    def fetch(self, days, filepath):
+        """
+        Days: number of days back to collect 13F filers for
+        Filepath: CSV with the CIK list, new CIK's are appended to it
 
+        Day pages are fetched in parallel under the SEC rate limit and kept in the cache folder,
+        so a re-run only fetches the days it doesn't have yet (today's page is always fetched,
+        it is not complete until the day is over). Returns the CIK's that were added.
+        """
+        client = edgar_client(None, self.user_agent, workers=self.workers)
+        os.makedirs(self.cache, exist_ok=True)
+
+        # page q1=n lists the filings of the n-th day back the SEC was open, so which day a page
+        # holds moves with every business day and every holiday. Pages are stored under the date
+        # printed on them, and PAGE_INDEX keeps the printed days of the pages of earlier runs in
+        # page order (chains of consecutive days). Once a fetched page prints a day of a chain,
+        # the days of the next pages are known, and the ones in the cache are not fetched again.
+        today = str(datetime.now().date())
+        cached = lambda day: os.path.join(self.cache, f'{day}.html')
+        index_path = os.path.join(self.cache, PAGE_INDEX)
+        chains = []
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                chains = json.load(f)['chains']
+        position = {day: (c, i) for c, chain in enumerate(chains) for i, day in enumerate(chain) if day}
+        # (chain, offset): page p held the day chains[chain][p + offset]
+        anchor = None
+
+        def known(page):
+            """ Day of a page that is certain from the index and cached, None when it has to be fetched """
+            if page == 0 or anchor is None:
+                return None
+            chain, offset = chains[anchor[0]], anchor[1]
+            day = chain[page + offset] if 0 <= page + offset < len(chain) else None
+            return day if day and day != today and os.path.exists(cached(day)) else None
+
+        def work(page):
             try:
-                text = r.html.find('pre', first=True).text
-                date = text[:100].split()[7]
-                filings = text.replace(date, '').split('\n ')[-1].split('  ')
-
-                firms = {'CIK': [filing.split()[1].zfill(10) for filing in filings],
-                        'Name': [' '.join(filing.split()[2:]) for filing in filings],
-                        'Type': [filing.split()[0] for filing in filings]}
-                codes.append(pd.DataFrame(firms))
-            except:
-                print(f'No fillings on {date}, or other error')
-        
-        df = pd.concat(codes, ignore_index=True)
-        df.drop_duplicates('CIK').drop(columns='Type').to_csv(filepath)
+                return client.get(f"{CURRENT_URL}?q1={page}&q2=0&q3=13F-HR").text
+            except requests.RequestException as e:
+                print(f'Could not fetch the filings of {page} days back: {e}')
+                return None
+
+        parsed = {}
+        page = 0
+        with ThreadPoolExecutor(self.workers) as pool:
+            while page < days:
+                # a batch of pages to fetch. Until a fetched page prints a day of the index, pages go
+                # one at a time (page 0 anchors a re-run on the same day, page 1 one on the next day),
+                # once the days are known the pages that aren't cached are fetched in parallel
+                todo = []
+                size = self.workers if anchor is not None or not chains else 1
+                while page < days and len(todo) < size:
+                    if known(page) is None:
+                        todo.append(page)
+                    page += 1
+                for p, text in zip(todo, pool.map(work, todo)):
+                    if text is None:
+                        continue
+                    day, filings = parse_current_page(text)
+                    parsed[p] = day, filings
+                    if day and day != today:
+                        with open(cached(day), 'w', encoding='utf-8') as f:
+                            f.write(text)
+                    if day in position:
+                        c, i = position[day]
+                        anchor = c, i - p
+
+        codes = []
+        printed = []
+        for page in range(days):
+            if page in parsed:
+                day, filings = parsed[page]
+            elif known(page):
+                with open(cached(known(page)), encoding='utf-8') as f:
+                    day, filings = parse_current_page(f.read())
+            else:
+                # could not be fetched
+                printed.append(None)
+                continue
+            printed.append(day)
+            if not filings:
+                print(f'No fillings on {day or f"page {page}"}')
+            codes.extend(filings)
+
+        # this run's pages, followed by the older days of the chain they continue
+        if anchor is not None:
+            printed += chains[anchor[0]][max(days + anchor[1], 0):]
+        seen = set(printed)
+        chains = [printed] + [chain for c, chain in enumerate(chains)
+                              if (anchor is None or c != anchor[0]) and not set(chain) <= seen]
+        with open(index_path + '.part', 'w') as f:
+            json.dump({'chains': chains}, f)
+        os.replace(index_path + '.part', index_path)
+
+        df = pd.DataFrame(codes, columns=['Type', 'CIK', 'Name']).drop_duplicates('CIK')[['CIK', 'Name']]
+
+        # merge into the existing list: only CIK's we don't have yet are appended
+        if os.path.exists(filepath):
+            listed = pd.read_csv(filepath, index_col=0, usecols=[0, 1], dtype={'CIK': str})
+            df = df[~df['CIK'].isin(listed['CIK'])]
+            start = listed.index.max() + 1 if len(listed) else 0
+            df.index = pd.RangeIndex(start, start + len(df))
+            df.to_csv(filepath, mode='a', header=False)
+        else:
+            df = df.reset_index(drop=True)
+            df.to_csv(filepath)
+        return df
+
+
+# columns the analysis classes need from the holdings table
+ANALYSIS_COLUMNS = ['issuer', 'value', 'owner', 'cik']
+# clmap draws a down-sampled heatmap instead of a clustermap above this many investors
+CLUSTERMAP_MAX_INVESTORS = 2000
 
 
 class clmap:
-    def __init__(self, datapath):
-        self.data = pd.read_csv(datapath)
+    def __init__(self, datapath, year=None, quarter=None):
+        """
+        Datapath is a holdings csv file or parquet dataset folder (see xml_parser.parse),
+        year and quarter optionally select report periods.
+        """
+        self.data = read_holdings(datapath, ANALYSIS_COLUMNS, year, quarter, compact=True)
+        # filled by the first calculate, later calls (e.g. another method) reuse them
+        self.correlation = None
+        self.distance = None
+        self.linkages = {}
         
     def __repr__(self):
         return "Performs necessary calculations and returns a clustermap"
         
-    def calculate(self, method, figsize):
+    def calculate(self, method, figsize, max_size=CLUSTERMAP_MAX_INVESTORS):
         """
         Performs calculations on our DataFrame and returns a clustermap.
         
         Method can be one of ['single', 'complete', 'centroid', 'ward']
+
+        With more than max_size investors a clustermap can't be drawn in reasonable time,
+        a heatmap figure in cluster order (averaged down to HEATMAP_SIZE cells) is returned instead.
         """
-        self.data['issuer'] = self.data['cusip'].apply(lambda x: x[:6])
-        
-        totalValue = self.data.groupby('owner')['value'].sum()
-        self.data = self.data.merge(totalValue, how='left', left_on='owner', right_index=True)
-        
-        self.data.drop(columns=['Unnamed: 0', 'cusip', 'amount', 'put_or_call', 'report_date'], inplace=True)
-        
-        self.data['norm_value'] = self.data['value_x'] / self.data['value_y']
-        
-        mask = self.data['value_x'] == 0
-        self.data = self.data.loc[~mask]
+        if self.correlation is None:
+            # share of each position in the owner's portfolio, summed per investor and issuer
+            self.data = normalize_positions(self.data)
 
-        self.data = self.data.groupby(['cik','issuer']).agg({'norm_value': 'sum'}).reset_index()
+            # same as pivoting to a dense cik x issuer table and calling .corr(), but sparse
+            self.correlation = correlation_frame(self.data, index='cik', columns='issuer', values='norm_value')
+            self.distance = condensed_distance(self.correlation)
 
-        wideDf = self.data.pivot(index='cik', columns='issuer', values='norm_value').fillna(value=0)
+        linkage = self.linkage(method)
+        if len(self.correlation) > max_size:
+            return heatmap_figure(self.correlation, linkage, figsize=figsize)
 
-        correlation = wideDf.transpose().corr()
-        
-        plt.figure(figsize=figsize)
+        with span('render clustermap', rows=len(self.correlation)):
+            plt.figure(figsize=figsize)
+
+            # the matrix is symmetric, rows and columns share the linkage
+            return sns.clustermap(self.correlation, row_linkage=linkage, col_linkage=linkage)
+
+    def linkage(self, method):
+        """
+        Linkage matrix of a method, computed once from the stored distances
+        """
+        if method not in self.linkages:
+            self.linkages[method] = linkage_matrix(self.distance, method)
+        return self.linkages[method]
 
-        return sns.clustermap(correlation, method=method)
+    def clusters(self, method, num):
+        """
+        Cluster number of every investor when the tree of a method is cut into num clusters (after calculate)
+        """
+        return flat_clusters(self.linkage(method), num, self.correlation.index)
 
 
 class netmap:
-        def __init__(self, datapath):
-            self.data = pd.read_csv(datapath)
+        def __init__(self, datapath, year=None, quarter=None):
+            """
+            Datapath is a holdings csv file or parquet dataset folder (see xml_parser.parse),
+            year and quarter optionally select report periods.
+            """
+            self.data = read_holdings(datapath, ANALYSIS_COLUMNS, year, quarter, compact=True)
+            self.datapath = datapath
+            # canonical issuer names, loaded by the first calculate
+            self.securities = None
         
         def __repr__(self):
             return "Performs necessary calculations and returns a network"
@@ -336,68 +771,61 @@ class netmap:
 
             Labels is the number of labels that will be visualized on the network.
             """
-            self.data['issuer'] = self.data['cusip'].apply(lambda x: x[:6])
-
-            totalValue = self.data.groupby('owner')['value'].sum()
-            self.data = self.data.merge(totalValue, how='left', left_on='owner', right_index=True)
+            if self.securities is None:
+                self.securities = load_security_master(self.datapath)
 
-            self.data.drop(columns=['Unnamed: 0', 'cusip', 'amount', 'put_or_call', 'report_date'], inplace=True)
+            # share of each position in the owner's portfolio, summed per investor and issuer
+            self.data = normalize_positions(self.data)
 
-            self.data['norm_value'] = self.data['value_x'] / self.data['value_y']
+            # positions above the threshold become edges, investors and companies hold each node once
+            G, investors, companies, degCent = bipartite_graph(self.data, threshold, gravity)
 
-            mask = self.data['value_x'] == 0
-            self.data = self.data.loc[~mask]
-
-            issuers = self.data.drop_duplicates(subset='issuer')
-            issuers['label'] = issuers['filed name'].apply(lambda x: ' '.join(x[:].split(' ')[:3]))
-            issuers = issuers[['label', 'issuer']]
-
-            self.data = self.data.groupby(['cik','issuer']).agg({'norm_value': 'sum'}).reset_index()
-
-            investors = []
-            companies = []
-
-            G=nx.Graph()
-
-            for i in self.data.index:
-                edge = self.data.iloc[i,]
-                if edge['norm_value'] > threshold:
-                    G.add_edge(edge['cik'], edge['issuer'], weight=edge['norm_value'] ** (1/gravity))
-                    investors.append(edge['cik'])
-                    companies.append(edge['issuer'])
-
-            degCent = nx.degree_centrality(G)
-            pos = nx.spring_layout(G)
+            pos = layout(G)
             print(f"Nodes in graph: {len(G.nodes())}\nEdges in graph: {len(G.edges())}")
 
             # calculate node size based on centrality for each group
-            investorSize = [degCent[investor]**1.5 * 10000 for investor in investors]
-            issuerSize = [degCent[issuer]**1.5 * 10000 for issuer in companies]
+            investorSize = (degCent[investors]**1.5 * 10000).tolist()
+            issuerSize = (degCent[companies]**1.5 * 10000).tolist()
 
             # calculate edge size
             edgeSize = [d['weight'] ** (gravity) for (u, v, d) in G.edges(data=True)]
 
-            sorted_x = sorted(degCent.items(), key=operator.itemgetter(1), reverse=True)
-            central = [item[0] for item in sorted_x[:num] if type(item[0]) == str]
+            # most central nodes that are issuers
+            central = degCent.nlargest(num).index.intersection(companies, sort=False)
 
-            # turn list into dictionary
-            labels = {}
-            for code in central:
-                try:
-                    labels[code] = issuers[issuers['issuer'] == code]['label'].item()
-                except:
-                    labels[code] = code
+            # canonical names from the security master, the code itself for an unknown issuer
+            labels = self.securities.labels(central)
 
-            # draw nodes
-            plt.figure(figsize=figsize)
-            nx.draw_networkx_nodes(G, pos, nodelist=investors, node_size=investorSize, alpha=0.5, node_color='r')
+            with span('render network', rows=len(G)):
+                # draw nodes
+                plt.figure(figsize=figsize)
+                nx.draw_networkx_nodes(G, pos, nodelist=investors, node_size=investorSize, alpha=0.5, node_color='r')
+
+                # draw nodes
+                nx.draw_networkx_nodes(G, pos, nodelist=companies, node_size=issuerSize, alpha=0.5, node_color='b')
 
-            # draw nodes
-            nx.draw_networkx_nodes(G, pos, nodelist=companies, node_size=issuerSize, alpha=0.5, node_color='b')
+                # edges
+                nx.draw_networkx_edges(
+                    G, pos, width=edgeSize, alpha=0.4, edge_color="k")
 
-            # edges
-            nx.draw_networkx_edges(
-                G, pos, width=edgeSize, alpha=0.4, edge_color="k")
+                # labels
+                nx.draw_networkx_labels(G, pos, labels=labels, font_size=16, font_family="sans-serif", font_color='k');
 
-            # labels
-            nx.draw_networkx_labels(G, pos, labels=labels, font_size=16, font_family="sans-serif", font_color='k');
\ No newline at end of file
+        def rankings(self, threshold, samples=1000, workers=1):
+            """
+            Systemic importance of every investor and issuer of the network at threshold.
+
+            Degree, PageRank, eigenvector and approximate betweenness centrality (from samples
+            sources) and the community of every node, computed on the sparse adjacency matrix
+            (see metrics.py) so it works on the whole filer universe. Workers > 1 runs the
+            matrix products in threads. Prints the convergence of every metric and returns
+            a DataFrame indexed by CIK or issuer.
+            """
+            # calculate() replaces the holdings with the normalized positions
+            positions = self.data if 'norm_value' in self.data else normalize_positions(self.data)
+            edges = bipartite_edges(positions, threshold)
+            A, nodes = adjacency(edges, 'cik', 'issuer', 'norm_value')
+            table, reports = rankings(A, nodes, samples, workers)
+            for name, report in reports.items():
+                print(name, report)
+            return table
\ No newline at end of file